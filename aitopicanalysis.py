@@ -3,6 +3,15 @@ import pandas as pd
 import plotly.express as px
 from datetime import datetime, timedelta
 from db import get_cursor
+from querycache import cached
+from bucketcache import bucketcache
+from parallel import runparallel
+from bucketing import RESOLUTIONS, choosebucket, downsample
+from scorestats import summarysql, summaryfromrow, emptysummary
+import approximate
+from snapshot import activebackend
+from rollups import REDDITTEXT
+import livetail
 from utils import getlogger
 
 logger = getlogger("ai_topic_panel")
@@ -17,142 +26,302 @@ def parsedate(s, default):
     except:
         return default
 
+# returns the post tables that have the indexed search_text column from migration
+# 0001_topic_search_text, rechecked every few minutes so the panel picks it up after a migration
+@cached(ttl=300)
+def searchtables():
+    with get_cursor() as cur:
+        cur.execute("""
+            SELECT table_name FROM information_schema.columns
+            WHERE column_name = 'search_text' AND table_name IN ('chan_posts', 'reddit_posts');
+        """)
+        return {r[0] for r in cur.fetchall()}
+
+# the platforms getaitopics can scan, each with its post table and the key prefix of its series
+TOPICPLATFORMS = [
+    {"platform": "4chan", "option": "chan", "table": "chan_posts"},
+    {"platform": "Reddit", "option": "reddit", "table": "reddit_posts"},
+]
+
+# this function builds the join that tags every post with each topic it mentions. the topics
+# come in as an unnested (topic, pattern) list so one scan of the date range serves all of
+# them. when the table has the search_text column the match is a LIKE on the lower cased text
+# and an extra LIKE ANY prefilter lets the trigram index pick the candidate rows, otherwise it
+# is the leading wildcard ILIKE over the raw fields
+def topicjoin(table, topics):
+    patterns = [f"%{topic}%" for topic in topics]
+    if table in searchtables():
+        patterns = [pattern.lower() for pattern in patterns]
+        return ("p.search_text LIKE topics.pattern", "AND p.search_text LIKE ANY(%s)",
+                (topics, patterns), (patterns,))
+    if table == "chan_posts":
+        match = "p.content ILIKE topics.pattern"
+    else:
+        match = f"{REDDITTEXT} ILIKE topics.pattern"
+    return match, "", (topics, patterns), ()
+
+def topickey(platform, topic):
+    return ("topics", platform, None, topic, "toxicityscore")
+
+# this function runs one bucketed count and average toxicity query per platform for all topics
+# over a date range and returns the points of each topic keyed the way the bucket cache stores them.
+# with samplepercent the tables are read through TABLESAMPLE SYSTEM, the counts are scaled up to
+# estimates and every point gets the 95% intervals of its count and average toxicity
+def topicpoints(topics, platform, bucket, startdate, enddate, samplepercent=None):
+    backend = activebackend()
+    if backend is not None:
+        platforms = [source["platform"] for source in TOPICPLATFORMS if platform in (source["option"], "both")]
+        points = backend.topicpoints(platforms, topics, bucket, startdate, enddate)
+        return {topickey(name, topic): series for (name, topic), series in points.items()}
+    points = {}
+    sample, sampleparams = ("TABLESAMPLE SYSTEM (%s)", (samplepercent,)) if samplepercent else ("", ())
+    sources = [source for source in TOPICPLATFORMS if platform in (source["option"], "both")]
+    # topicjoin may query the schema on a cache miss, that happens before the cursor is opened so
+    # this never holds one pooled connection while waiting for a second
+    joins = {source["table"]: topicjoin(source["table"], topics) for source in sources}
+    with get_cursor() as cur:
+        for source in sources:
+            match, prefilter, joinparams, prefilterparams = joins[source["table"]]
+            cur.execute(f"""
+                SELECT topics.topic, date_trunc('{bucket}', p.created_at) AS bucket_ts,
+                       COUNT(*)::int AS count, AVG(p.toxicityscore) AS averagetoxicity,
+                       COUNT(p.toxicityscore)::int AS scored, STDDEV_SAMP(p.toxicityscore)::float AS sd
+                FROM {source['table']} p {sample}
+                JOIN unnest(%s::text[], %s::text[]) AS topics(topic, pattern) ON {match}
+                WHERE p.created_at BETWEEN %s AND %s {prefilter}
+                GROUP BY 1, 2
+                ORDER BY 1, 2;
+            """, sampleparams + joinparams + (startdate, enddate) + prefilterparams)
+            for topic in topics:
+                points[topickey(source["platform"], topic)] = []
+            for r in cur.fetchall():
+                point = {"t": r[1], "count": r[2], "averagetoxicity": float(r[3]) if r[3] else None}
+                if samplepercent:
+                    point["count"], point["countlow"], point["counthigh"] = approximate.countinterval(r[2], samplepercent)
+                    point["toxlow"], point["toxhigh"] = approximate.meaninterval(point["averagetoxicity"], r[5], r[4])
+                points[topickey(source["platform"], r[0])].append(point)
+    return points
+
 # this function will retrieves time bucketed counts and toxicity averages for each ai topic
 # across chan and redit by  scaning post content for keyword matches and aggregates
-# activity over the selected date window returning structured series for visualization
-def getaitopics(topics=None, platform="both", bucket="day", start=None, end=None):
+# activity over the selected date window returning structured series for visualization.
+# every query covers all selected topics at once so the cost stays flat as topics are added,
+# and the bucketed series go through the bucket cache so only buckets it hasn't stored are queried.
+# the post level toxicity of each topic and platform comes back as a summary computed in the
+# database (see scorestats), statsmode approximate reads the percentiles off the histogram.
+# with samplepercent everything is estimated from a TABLESAMPLE SYSTEM sample of that size,
+# those series skip the bucket cache which only holds exact buckets. bucket auto picks the
+# resolution from the width of the range. the snapshot backend matches the topics on the
+# snapshot search text and ignores samplepercent, its scans are local
+@cached(ttl=300)
+def getaitopics(topics=None, platform="both", bucket="day", start=None, end=None, statsmode="exact", samplepercent=None):
     enddate = parsedate(end, datetime.utcnow())
     startdate = parsedate(start, enddate - timedelta(days=defaultdays))
-    results = []
-    for topic in topics or defaulttopics:
-        fourchanpoints, redditpoints = [], []
-        fourchtoxicityraw, reddittoxicityraw = [], []
+    bucket = choosebucket(startdate, enddate, bucket)
+    topics = list(dict.fromkeys(topics or defaulttopics))
+    sources = [source for source in TOPICPLATFORMS if platform in (source["option"], "both")]
+    keys = [topickey(source["platform"], topic) for source in sources for topic in topics]
+    # the bucketed series and the summary of each platform are independent queries so they run
+    # concurrently, each on its own pooled connection
+    sample, sampleparams = ("TABLESAMPLE SYSTEM (%s)", (samplepercent,)) if samplepercent else ("", ())
+    def platformstats(source):
+        backend = activebackend()
+        if backend is not None:
+            return backend.topicstats(source["platform"], topics, startdate, enddate, exact=statsmode == "exact")
+        match, prefilter, joinparams, prefilterparams = topicjoin(source["table"], topics)
         with get_cursor() as cur:
-            if platform in ("chan", "both"):
-                cur.execute(f"""
-                    SELECT date_trunc('{bucket}', created_at) AS t, COUNT(*)::int AS count, AVG(toxicityscore) AS averagetoxicity
-                    FROM chan_posts
-                    WHERE content ILIKE %s AND created_at BETWEEN %s AND %s
-                    GROUP BY 1
-                    ORDER BY 1;
-                """, (f"%{topic}%", startdate, enddate))
-                rows = cur.fetchall()
-                fourchanpoints = [{"t": r[0], "count": r[1], "averagetoxicity": float(r[2]) if r[2] else None} for r in rows]
-                cur.execute("""
-                    SELECT toxicityscore
-                    FROM chan_posts
-                    WHERE content ILIKE %s AND created_at BETWEEN %s AND %s AND toxicityscore IS NOT NULL;
-                """, (f"%{topic}%", startdate, enddate))
-                fourchtoxicityraw = [float(r[0]) for r in cur.fetchall()]
-            if platform in ("reddit", "both"):
-                cur.execute(f"""
-                    SELECT date_trunc('{bucket}', created_at) AS t, COUNT(*)::int AS count, AVG(toxicityscore) AS averagetoxicity
-                    FROM reddit_posts
-                    WHERE ((data->>'body') ILIKE %s OR (data->>'title') ILIKE %s OR (data->>'selftext') ILIKE %s)
-                      AND created_at BETWEEN %s AND %s
-                    GROUP BY 1
-                    ORDER BY 1;
-                """, (f"%{topic}%", f"%{topic}%", f"%{topic}%", startdate, enddate))
-                rows = cur.fetchall()
-                redditpoints = [{"t": r[0], "count": r[1], "averagetoxicity": float(r[2]) if r[2] else None} for r in rows]
-                cur.execute("""
-                    SELECT toxicityscore
-                    FROM reddit_posts
-                    WHERE ((data->>'body') ILIKE %s OR (data->>'title') ILIKE %s OR (data->>'selftext') ILIKE %s)
-                      AND created_at BETWEEN %s AND %s AND toxicityscore IS NOT NULL;
-                """, (f"%{topic}%", f"%{topic}%", f"%{topic}%", startdate, enddate))
-                reddittoxicityraw = [float(r[0]) for r in cur.fetchall()]
-        results.append({"topic": topic, "chan": fourchanpoints, "reddit": redditpoints, 
-                       "chantoxraw": fourchtoxicityraw, "reddittoxraw": reddittoxicityraw})
+            cur.execute(summarysql(f"""
+                SELECT topics.topic AS grp, p.toxicityscore AS score
+                FROM {source['table']} p {sample}
+                JOIN unnest(%s::text[], %s::text[]) AS topics(topic, pattern) ON {match}
+                WHERE p.created_at BETWEEN %s AND %s AND p.toxicityscore IS NOT NULL {prefilter}
+            """, exact=statsmode == "exact"), sampleparams + joinparams + (startdate, enddate) + prefilterparams)
+            summaries = {(source["platform"], r[0]): summaryfromrow(r) for r in cur.fetchall()}
+        if samplepercent:
+            summaries = {key: approximate.scaledsummary(summary, samplepercent) for key, summary in summaries.items()}
+        return summaries
+    if samplepercent:
+        tasks = {"series": lambda: topicpoints(topics, platform, bucket, startdate, enddate, samplepercent)}
+    else:
+        tasks = {"series": lambda: bucketcache.fetchseries(keys, bucket, startdate, enddate,
+                                                           lambda substart, subend: topicpoints(topics, platform, bucket, substart, subend))}
+    for source in sources:
+        tasks[source["platform"]] = lambda source=source: platformstats(source)
+    queryresults = runparallel(tasks)
+    series = queryresults["series"]
+    toxicitystats = {}
+    for source in sources:
+        toxicitystats.update(queryresults[source["platform"]])
+    results = []
+    for topic in topics:
+        results.append({"topic": topic,
+                        "chan": series.get(topickey("4chan", topic), []),
+                        "reddit": series.get(topickey("Reddit", topic), []),
+                        "chanstats": toxicitystats.get(("4chan", topic), emptysummary()),
+                        "redditstats": toxicitystats.get(("Reddit", topic), emptysummary())})
     return results
 
 # function builds a summary table for all ai topic activity, it computes total post
 # volume, average toxicity, maximum toxicity, and median toxicity for each platforms topic
-# pair and producing a compact overview suitable for tabular display in the dashboard
+# pair and producing a compact overview suitable for tabular display in the dashboard.
+# the toxicity columns are post level statistics that the database already computed, sampled
+# data adds the interval of the average and its post totals are estimates
 def getsummarytable(toicdata):
     rows = []
     for topic in toicdata:
-        for platformname, datapoints in [("4chan", topic["chan"]), ("Reddit", topic["reddit"])]:
+        for platformname, datapoints, stats in [("4chan", topic["chan"], topic["chanstats"]),
+                                                ("Reddit", topic["reddit"], topic["redditstats"])]:
             if datapoints:
-                df = pd.DataFrame(datapoints)
-                totalnumberofposts = df["count"].sum()
-                averagetoxicity = df["averagetoxicity"].mean()
-                maximumtoxicity = df["averagetoxicity"].max()
-                toxocitymedian = df["averagetoxicity"].median()
-                rows.append({
+                totalnumberofposts = sum(point["count"] for point in datapoints)
+                averagetoxicity = stats["mean"]
+                maximumtoxicity = stats["max"]
+                toxocitymedian = stats["quantiles"][0.5]
+                row = {
                     "Topic": topic["topic"],
                     "Platform": platformname,
-                    "Total Posts": totalnumberofposts,
+                    "Total Posts": round(totalnumberofposts),
                     "Average Toxicity": round(averagetoxicity, 4) if averagetoxicity else None,
                     "Max Toxicity": round(maximumtoxicity, 4) if maximumtoxicity else None,
                     "Median Toxicity": round(toxocitymedian, 4) if toxocitymedian else None
-                })
+                }
+                if "meanlow" in stats and stats["meanlow"] is not None:
+                    row["Average Toxicity 95% interval"] = f"{stats['meanlow']:.4f} → {stats['meanhigh']:.4f}"
+                rows.append(row)
     return pd.DataFrame(rows)
 
 #  it will renders the complete ai topic analysis panel in streamlit by  gathering
 # user selections and  fetches topic-level activity and  plots post volume and toxicity trends
-# and displays summary statistics and distribution charts for both Reddit and 4chan
-def renderaitopic(startdate, enddate, platform="both"):
+# and displays summary statistics and distribution charts for both Reddit and 4chan.
+# in the approximate and progressive query modes the first answer comes from a sample
+def renderaitopic(startdate, enddate, platform="both", querymode="exact"):
     st.header("Ai topic frequency analysis")
     selectedtopic = st.sidebar.multiselect("Select ai topics", defaulttopics, default=defaulttopics)
     selectedtopicmetric = st.sidebar.selectbox("Toxicity metric", ["averagetoxicity"])
+    statsmode = st.sidebar.selectbox("Topic statistics", ["exact", "approximate"])
+    bucket = st.sidebar.selectbox("Aggregation", ["auto"] + RESOLUTIONS, index=0)
     if not selectedtopic:
         st.warning("Please select at least one topic.")
         return
-    toicdata = getaitopics(selectedtopic, platform, bucket="day",
-                               start=startdate.isoformat(), end=enddate.isoformat())
+    if st.sidebar.checkbox("Live tail", value=False, help="Follow the last hours as the crawlers insert posts"):
+        renderaitopiclive(selectedtopic, platform)
+        return
+    arguments = dict(topics=selectedtopic, platform=platform, bucket=bucket,
+                     start=startdate.isoformat(), end=enddate.isoformat(), statsmode=statsmode)
+    approximate.renderprogressive(querymode,
+                                  lambda: getaitopics(samplepercent=approximate.samplepercent, **arguments),
+                                  lambda: getaitopics(**arguments),
+                                  drawaitopics,
+                                  iscached=lambda: getaitopics.iscached(**arguments))
+
+# live tail of the topic charts, the bucketed counts and average toxicity of every topic over
+# the last hours are kept in memory by livetail and redrawn every LIVE_TAIL_REFRESH_SECONDS,
+# each redraw only matches the posts since the last one
+def renderaitopiclive(topics, platform):
+    if activebackend() is not None:
+        st.info("Live tail follows the database and isn't available with the snapshot backend.")
+        return
+    hours = st.sidebar.selectbox("Live window (hours)", livetail.LIVEWINDOWS, index=1)
+    window = timedelta(hours=hours)
+    now = datetime.utcnow()
+    bucket = choosebucket(now - window, now)
+    topics = list(dict.fromkeys(topics))
+    sources = [source for source in TOPICPLATFORMS if platform in (source["option"], "both")]
+    keys = [topickey(source["platform"], topic) for source in sources for topic in topics]
+    series = livetail.liveseries("aitopics", (topics, platform), keys, bucket, window,
+                                 lambda since, until: topicpoints(topics, platform, bucket, since, until))
+
+    @st.fragment(run_every=livetail.refreshseconds)
+    def drawlive():
+        try:
+            series.fold()
+        except Exception as e:
+            logger.error(f"live tail update failed: {e}")
+            st.warning("Live update failed, showing the last data received.")
+        st.caption(f"Live: posts per {bucket} over the last {hours} hours, updated {datetime.utcnow():%H:%M:%S} UTC")
+        for topic in topics:
+            frames = [pd.DataFrame(series.series(topickey(source["platform"], topic))).assign(platform=source["platform"])
+                      for source in sources]
+            frames = [frame for frame in frames if not frame.empty]
+            st.subheader(f"Topic: {topic}")
+            if not frames:
+                st.write("no posts in the live window")
+                continue
+            dataframrofall = pd.concat(frames, ignore_index=True)
+            colors = {"4chan": "#66c2a5", "Reddit": "#d62728"}
+            countfigure = px.line(dataframrofall, x="t", y="count", color="platform",
+                                  title=f"{topic} - Combined post count", color_discrete_map=colors)
+            st.plotly_chart(countfigure, use_container_width=True, key=f"live-topic-count-{topic}")
+            toxicityfigure = px.line(dataframrofall, x="t", y="averagetoxicity", color="platform",
+                                     title=f"{topic} - Combined average toxicity", color_discrete_map=colors)
+            st.plotly_chart(toxicityfigure, use_container_width=True, key=f"live-topic-toxicity-{topic}")
+
+    drawlive()
+
+# the chart frame of one topic, both platforms downsampled on the charted value y so the peaks
+# of that value survive. sampled points get their error bar columns
+def topicframe(topic, y, sampled):
+    cdata = []
+    for platformname, points in [("4chan", topic["chan"]), ("Reddit", topic["reddit"])]:
+        if points:
+            cdata.append(pd.DataFrame(downsample(points, y=y)).assign(platform=platformname))
+    if not cdata:
+        return None
+    dataframrofall = pd.concat(cdata, ignore_index=True)
+    if sampled and "counthigh" in dataframrofall:
+        dataframrofall["counterror"] = dataframrofall["counthigh"] - dataframrofall["count"]
+        dataframrofall["counterrorminus"] = dataframrofall["count"] - dataframrofall["countlow"]
+        dataframrofall["toxerror"] = dataframrofall["toxhigh"] - dataframrofall["averagetoxicity"]
+        dataframrofall["toxerrorminus"] = dataframrofall["averagetoxicity"] - dataframrofall["toxlow"]
+    return dataframrofall
+
+# draws the topic charts, the summary table and the distribution chart, sampled data gets
+# error bars with the 95% interval of every count and average. long series are downsampled for
+# the charts only, the summary table still totals every bucket
+def drawaitopics(toicdata, sampled=False):
+    mode = "sample" if sampled else "exact"
     for topic in toicdata:
         st.subheader(f"Topic: {topic['topic']}")
-        cdata = []
-        if topic["chan"]:
-            chandataframe = pd.DataFrame(topic["chan"])
-            chandataframe["platform"] = "4chan"
-            cdata.append(chandataframe)
-        if topic["reddit"]:
-            dataframreddit = pd.DataFrame(topic["reddit"])
-            dataframreddit["platform"] = "Reddit"
-            cdata.append(dataframreddit)
-        if cdata:
-            dataframrofall = pd.concat(cdata, ignore_index=True)
+        countframe = topicframe(topic, "count", sampled)
+        if countframe is not None:
+            toxicityframe = topicframe(topic, "averagetoxicity", sampled)
+            counterrors, toxicityerrors = {}, {}
+            if "counterror" in countframe:
+                counterrors = {"error_y": "counterror", "error_y_minus": "counterrorminus"}
+                toxicityerrors = {"error_y": "toxerror", "error_y_minus": "toxerrorminus"}
 
             totalcountfigure = px.line(
-                dataframrofall,
+                countframe,
                 x="t",
                 y="count",
                 color="platform",
                 title=f"{topic['topic']} - Combined post count",
-                color_discrete_map={"4chan": "#66c2a5", "Reddit": "#d62728"}
+                color_discrete_map={"4chan": "#66c2a5", "Reddit": "#d62728"},
+                **counterrors
             )
-            st.plotly_chart(totalcountfigure, use_container_width=True)
+            st.plotly_chart(totalcountfigure, use_container_width=True, key=f"topic-count-{topic['topic']}-{mode}")
             chanandreddittoxicfigure = px.line(
-                dataframrofall,
+                toxicityframe,
                 x="t",
                 y="averagetoxicity",
                 color="platform",
                 title=f"{topic['topic']} - Combined average toxicity",
-                color_discrete_map={"4chan": "#66c2a5", "Reddit": "#d62728"}
+                color_discrete_map={"4chan": "#66c2a5", "Reddit": "#d62728"},
+                **toxicityerrors
             )
-            st.plotly_chart(chanandreddittoxicfigure, use_container_width=True)
+            st.plotly_chart(chanandreddittoxicfigure, use_container_width=True, key=f"topic-toxicity-{topic['topic']}-{mode}")
     st.subheader("Summary statistics")
     summarytable = getsummarytable(toicdata)
     st.dataframe(summarytable, use_container_width=True)
     st.subheader("Toxicity distribution by topic and platform")
     alldata = []
     for topic in toicdata:
-        if topic.get("chantoxraw") and len(topic["chantoxraw"]) > 0:
-            avg = sum(topic["chantoxraw"]) / len(topic["chantoxraw"])
-            alldata.append({
-                "topic": topic["topic"],
-                "platform": "4chan",
-                "toxicity": avg
-            })
-        if topic.get("reddittoxraw") and len(topic["reddittoxraw"]) > 0:
-            avg = sum(topic["reddittoxraw"]) / len(topic["reddittoxraw"])
-            alldata.append({
-                "topic": topic["topic"],
-                "platform": "Reddit",
-                "toxicity": avg
-            })
+        for platformname, stats in [("4chan", topic["chanstats"]), ("Reddit", topic["redditstats"])]:
+            if stats["count"] > 0:
+                alldata.append({
+                    "topic": topic["topic"],
+                    "platform": platformname,
+                    "toxicity": stats["mean"]
+                })
     if alldata:
         dfall = pd.DataFrame(alldata)
         dfall["topicplatform"] = dfall["topic"] + " - " + dfall["platform"]
@@ -162,4 +331,4 @@ def renderaitopic(startdate, enddate, platform="both"):
                           color="platform",
                           color_discrete_map={"4chan": "#66c2a5", "Reddit": "#d62728"})
         figdist.update_layout(xaxis_tickangle=-45)
-        st.plotly_chart(figdist, use_container_width=True)
+        st.plotly_chart(figdist, use_container_width=True, key=f"topic-distribution-{mode}")
@@ -0,0 +1,240 @@
+import os
+import sys
+import json
+import gzip
+import math
+import hashlib
+import argparse
+from datetime import date, datetime
+from urllib.parse import urlsplit, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+import pandas as pd
+import temporal
+import toxicityovertime
+import aitopicanalysis
+from connpool import PoolTimeout
+from bucketing import RESOLUTIONS
+from snapshot import SCORECOLUMNS
+from utils import getlogger
+
+logger = getlogger("api")
+# the api has no authentication so it only listens on localhost unless API_HOST says otherwise,
+# remote clients reach it through the same ssh tunnel as the dashboard
+apihost = os.getenv("API_HOST", "127.0.0.1")
+apiport = int(os.getenv("API_PORT", "8502"))
+# the largest limit or topn a request may ask for
+maxlimit = 1000
+# how long clients may reuse a response without asking again, after that they revalidate
+# with If-None-Match and get a 304 while the data is unchanged
+apimaxage = int(os.getenv("API_MAX_AGE", "60"))
+# bodies smaller than this are sent uncompressed, gzip doesn't pay off on them
+gzipminbytes = 1024
+
+# the query string readers, a parameter given twice keeps its last value and list parameters
+# take repeated values, comma separated values or both
+def param(query, name, default=None):
+    values = query.get(name)
+    return values[-1] if values else default
+
+def listparam(query, name, default=None):
+    values = [v.strip() for raw in query.get(name, []) for v in raw.split(",") if v.strip()]
+    return values or default
+
+def intparam(query, name, default, low=1, high=maxlimit):
+    value = param(query, name)
+    try:
+        value = default if value is None else int(value)
+    except ValueError:
+        raise ValueError(f"{name} must be an integer")
+    if not low <= value <= high:
+        raise ValueError(f"{name} must be between {low} and {high}")
+    return value
+
+def floatparam(query, name, default, low=None, high=None):
+    value = param(query, name)
+    try:
+        value = default if value is None else float(value)
+    except ValueError:
+        raise ValueError(f"{name} must be a number")
+    if (low is not None and value < low) or (high is not None and value > high) or math.isnan(value):
+        raise ValueError(f"{name} must be between {low} and {high}")
+    return value
+
+# values that end up inside the sql text are checked against their allowed choices
+def choiceparam(query, name, choices, default):
+    value = param(query, name, default)
+    if value not in choices:
+        raise ValueError(f"{name} must be one of {', '.join(str(c) for c in choices if c is not None)}")
+    return value
+
+# dates are checked here because the query functions fall back to their default range on a
+# date they can't parse. the string is passed on as it is so the cache keys stay the same
+def dateparam(query, name):
+    value = param(query, name)
+    if value is not None:
+        try:
+            datetime.fromisoformat(value)
+        except ValueError:
+            raise ValueError(f"{name} must be an iso date like 2024-11-01 or 2024-11-01T12:00")
+    return value
+
+def temporalparts(query):
+    parts = tuple(listparam(query, "parts", list(temporal.TEMPORALPARTS)))
+    unknown = [part for part in parts if part not in temporal.TEMPORALPARTS]
+    if unknown:
+        raise ValueError(f"unknown parts {', '.join(unknown)}")
+    return parts
+
+def daterange(query):
+    return {"start": dateparam(query, "start"), "end": dateparam(query, "end")}
+
+# temporalquery sums the hourly rollups so it has no minute buckets
+ROLLUPBUCKETS = [bucket for bucket in RESOLUTIONS if bucket != "minute"]
+
+# the endpoints, every one is a panel query function and the reader that turns the query string
+# into its arguments. the readers raise ValueError on a bad parameter, that is answered with a
+# 400 before the function runs. the functions go through the same query cache the dashboard uses
+ENDPOINTS = {
+    "/api/postspertime": (temporal.getpostspertime, lambda q: dict(
+        daterange(q), bucket=choiceparam(q, "bucket", ["auto"] + RESOLUTIONS, "auto"))),
+    "/api/temporal": (temporal.temporalquery, lambda q: dict(
+        daterange(q), bucket=choiceparam(q, "bucket", ROLLUPBUCKETS, "day"), parts=temporalparts(q))),
+    "/api/topauthors": (temporal.gettopauthors, lambda q: dict(
+        daterange(q), limit=intparam(q, "limit", 20))),
+    "/api/authorpatterns": (temporal.authortimepattern, lambda q: dict(
+        daterange(q), topn=intparam(q, "topn", 10))),
+    "/api/authorlengths": (temporal.averagepostlenghtbyauthor, lambda q: dict(
+        daterange(q), limit=intparam(q, "limit", 20))),
+    "/api/communities": (toxicityovertime.getthecommunities, lambda q: {}),
+    "/api/toxicity": (toxicityovertime.gettoxicity, lambda q: dict(
+        daterange(q), platforms=listparam(q, "platforms", ["chan", "reddit"]), communities=listparam(q, "communities", []),
+        metric=choiceparam(q, "metric", SCORECOLUMNS, "toxicityscore"),
+        sampling=choiceparam(q, "sampling", [None] + list(toxicityovertime.SAMPLINGMETHODS), None),
+        samplepercent=floatparam(q, "samplepercent", 5.0, low=0.1, high=100.0))),
+    "/api/toxicitymetrics": (toxicityovertime.gettoxicityallmetrics, lambda q: dict(
+        daterange(q), platforms=listparam(q, "platforms", ["chan", "reddit"]), communities=listparam(q, "communities", []),
+        sampling=choiceparam(q, "sampling", [None] + list(toxicityovertime.SAMPLINGMETHODS), None),
+        samplepercent=floatparam(q, "samplepercent", 5.0, low=0.1, high=100.0))),
+    "/api/aitopics": (aitopicanalysis.getaitopics, lambda q: dict(
+        daterange(q), topics=listparam(q, "topics", aitopicanalysis.defaulttopics),
+        platform=choiceparam(q, "platform", ["both", "chan", "reddit"], "both"),
+        bucket=choiceparam(q, "bucket", ["auto"] + RESOLUTIONS, "auto"),
+        statsmode=choiceparam(q, "statsmode", ["exact", "approximate"], "exact"))),
+}
+
+# turns a query result into plain json values, dataframes become lists of records (with their
+# named index as a column), timestamps become iso strings and nan becomes null
+def jsonable(value):
+    if isinstance(value, pd.DataFrame):
+        frame = value.reset_index() if value.index.name else value
+        return [{str(k): jsonable(v) for k, v in record.items()} for record in frame.to_dict(orient="records")]
+    if isinstance(value, dict):
+        return {str(k): jsonable(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [jsonable(v) for v in value]
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    if isinstance(value, float) and math.isnan(value):
+        return None
+    if value is pd.NaT or value is pd.NA:
+        return None
+    return value
+
+class APIHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        path = url.path.rstrip("/")
+        if path == "/api":
+            self.sendjson(200, {"endpoints": sorted(ENDPOINTS)})
+            return
+        endpoint = ENDPOINTS.get(path)
+        if endpoint is None:
+            self.sendjson(404, {"error": f"unknown endpoint {url.path}"})
+            return
+        function, reader = endpoint
+        try:
+            arguments = reader(parse_qs(url.query))
+        except ValueError as e:
+            self.sendjson(400, {"error": str(e)})
+            return
+        try:
+            result = function(**arguments)
+        except PoolTimeout:
+            self.sendjson(503, {"error": "the database is busy, try again"}, {"Retry-After": "5"})
+            return
+        except Exception as e:
+            logger.error(f"{path} failed: {e}")
+            self.sendjson(500, {"error": "query failed"})
+            return
+        self.sendjson(200, {"data": result})
+
+    # sends a json body with a weak etag of its content, the etag is weak because the same
+    # content may go out gzipped or not. a request whose If-None-Match holds the etag gets an
+    # empty 304 instead
+    def sendjson(self, status, payload, headers=None):
+        body = json.dumps(jsonable(payload), separators=(",", ":")).encode()
+        headers = dict(headers or {})
+        if status == 200:
+            etag = 'W/"' + hashlib.sha256(body).hexdigest()[:32] + '"'
+            headers["ETag"] = etag
+            headers["Cache-Control"] = f"max-age={apimaxage}"
+            if etag in self.requestetags():
+                self.send_response(304)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.end_headers()
+                return
+        headers["Vary"] = "Accept-Encoding"
+        if len(body) >= gzipminbytes and "gzip" in self.headers.get("Accept-Encoding", ""):
+            body = gzip.compress(body)
+            headers["Content-Encoding"] = "gzip"
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    # the etags of If-None-Match, weak and strong ones compare the same for a GET
+    def requestetags(self):
+        etags = set()
+        for tag in self.headers.get("If-None-Match", "").split(","):
+            tag = tag.strip()
+            if tag:
+                etags.add(tag if tag.startswith("W/") else "W/" + tag)
+        return etags
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+# serves the api until interrupted, every request runs on its own thread and the queries share
+# the connection pool so concurrent requests wait in line for connections like the dashboard does
+def serve(port=None, host=None):
+    port = port or apiport
+    host = host or apihost
+    server = ThreadingHTTPServer((host, port), APIHandler)
+    server.daemon_threads = True
+    logger.info(f"serving the analytics api on {host}:{port}/api")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="serve the panel query functions as a json api")
+    parser.add_argument("--host", default=apihost)
+    parser.add_argument("--port", type=int, default=apiport)
+    args = parser.parse_args()
+    try:
+        serve(args.port, args.host)
+    except OSError as e:
+        logger.error(f"could not start the api on port {args.port}: {e}")
+        sys.exit(1)
@@ -0,0 +1,75 @@
+import os
+import math
+import streamlit as st
+from concurrent.futures import ThreadPoolExecutor
+from utils import getlogger
+
+logger = getlogger("approximate")
+# exact runs the full queries, approximate answers from a TABLESAMPLE SYSTEM sample of the post
+# tables and progressive draws the sampled answer first and replaces it with the exact one
+QUERYMODES = ["exact", "approximate", "progressive"]
+samplepercent = float(os.getenv("APPROX_SAMPLE_PERCENT", "2"))
+# normal quantile of the 95% intervals
+Z = 1.96
+# the exact refinements of progressive mode get their own few threads so sessions waiting on
+# them can't take every worker of parallel.executor from the panels running their queries. the
+# thread names share its prefix so runparallel inside a refinement runs its tasks inline
+refineworkers = int(os.getenv("APPROX_REFINE_WORKERS", "2"))
+refineexecutor = ThreadPoolExecutor(max_workers=refineworkers, thread_name_prefix="panelquery-refine")
+
+# estimated total and 95% interval of a count seen in a sample of percent of the table, every
+# row is in the sample with probability percent/100 so the count is binomial. SYSTEM samples
+# whole pages so rows that were written together are sampled together and the true interval is
+# somewhat wider, the crawlers write in time order so this mostly matters for short buckets
+def countinterval(count, percent):
+    fraction = percent / 100.0
+    estimate = count / fraction
+    half = Z * math.sqrt(count * (1 - fraction)) / fraction
+    return estimate, max(0.0, estimate - half), estimate + half
+
+# 95% interval of a sample mean from its standard deviation and the number of sampled values
+def meaninterval(mean, stddev, n):
+    if mean is None:
+        return None, None
+    if not stddev or n < 2:
+        return mean, mean
+    half = Z * stddev / math.sqrt(n)
+    return mean - half, mean + half
+
+# this function turns a score summary computed over a sample into estimates for the whole
+# range, the counts are scaled up with their intervals and the mean gets its interval. the
+# histogram keeps the sampled counts since the charts only use its shape
+def scaledsummary(summary, percent):
+    summary = dict(summary)
+    summary["sampled"] = {"percent": percent, "count": summary["count"], "rows": summary["rows"]}
+    summary["count"], summary["countlow"], summary["counthigh"] = countinterval(summary["count"], percent)
+    summary["rows"] = countinterval(summary["rows"], percent)[0]
+    summary["meanlow"], summary["meanhigh"] = meaninterval(summary["mean"], summary["stddev"], summary["sampled"]["count"])
+    return summary
+
+# this function draws a panel section in the chosen query mode, approximate and exact are the
+# functions returning the sampled and the exact data and draw renders one of them (it gets
+# sampled=True for the sampled one so it can show its intervals). in progressive mode the
+# exact query starts on the refinement executor at once, the sampled answer is drawn into a
+# placeholder meanwhile and replaced when the exact one is ready. an exact answer that is
+# already cached is drawn straight away
+def renderprogressive(querymode, approximate, exact, draw, iscached=None):
+    if querymode == "exact" or (querymode == "progressive" and iscached is not None and iscached()):
+        draw(exact(), sampled=False)
+        return
+    if querymode == "approximate":
+        draw(approximate(), sampled=True)
+        return
+    future = refineexecutor.submit(exact)
+    placeholder = st.empty()
+    with placeholder.container():
+        st.caption(f"Showing estimates from a {samplepercent:g}% sample, refining to exact results...")
+        draw(approximate(), sampled=True)
+    try:
+        result = future.result()
+    except Exception as e:
+        logger.error(f"exact refinement failed, keeping the estimates: {e}")
+        st.warning("Exact results failed to load, the estimates above are from a sample.")
+        return
+    with placeholder.container():
+        draw(result, sampled=False)
@@ -0,0 +1,209 @@
+import os
+import sys
+import time
+import argparse
+import threading
+from datetime import datetime, time as daytime, timedelta
+from db import get_cursor
+from rollups import ROLLUPSOURCES, rollupsource, lookbackhours, ensurerollupschema
+from columnar import fetchframe
+from utils import getlogger
+
+logger = getlogger("authorprofiles")
+# the author panels trigger a refresh on read but never more often than this
+refreshinterval = int(os.getenv("AUTHOR_PROFILE_REFRESH_SECONDS", "300"))
+
+# one row per platform, community, author and day with the posts of that day, the length sum
+# and count of their texts and hour_counts, the posts per hour of the day (slot 1 is midnight).
+# the author panels rank and pivot these rows instead of grouping every post of the range by
+# author and hour. authors without a name are stored under ''
+PROFILESCHEMA = """
+    CREATE TABLE IF NOT EXISTS author_daily_profile (
+        platform TEXT NOT NULL,
+        community TEXT NOT NULL,
+        author_name TEXT NOT NULL,
+        day DATE NOT NULL,
+        post_count INTEGER NOT NULL,
+        length_sum BIGINT NOT NULL,
+        length_count INTEGER NOT NULL,
+        hour_counts INTEGER[] NOT NULL,
+        PRIMARY KEY (platform, community, author_name, day)
+    );
+    CREATE INDEX IF NOT EXISTS author_daily_profile_platform_day_idx ON author_daily_profile (platform, day);
+"""
+HOURCOUNTS = ", ".join(f"COUNT(*) FILTER (WHERE EXTRACT(HOUR FROM created_at) = {hour})" for hour in range(24))
+HOURSUMS = ", ".join(f"SUM(p.hour_counts[{hour + 1}])::int AS h{hour}" for hour in range(24))
+
+refreshlock = threading.Lock()
+lastrefresh = 0.0
+schemaready = False
+
+def ensureprofileschema():
+    global schemaready
+    if schemaready:
+        return
+    ensurerollupschema()
+    with get_cursor(commit=True) as cur:
+        cur.execute(PROFILESCHEMA)
+    schemaready = True
+
+# this function rebuilds the profiles of one platform from the day of its watermark minus the
+# lookback onwards, those days are deleted and re-aggregated in one transaction like the hourly
+# rollups so a rerun is idempotent and readers never see a half refreshed day
+def refreshprofileplatform(platform, full=False):
+    source = rollupsource(platform)
+    name = f"author_daily_profile:{platform}"
+    with get_cursor(commit=True) as cur:
+        cur.execute("SELECT pg_advisory_xact_lock(hashtext(%s));", (name,))
+        cur.execute("SELECT watermark FROM rollup_watermarks WHERE name = %s;", (name,))
+        row = cur.fetchone()
+        since = None
+        if row is not None and not full:
+            since = datetime.combine((row[0] - timedelta(hours=lookbackhours)).date(), daytime.min)
+        if since is None:
+            cur.execute("DELETE FROM author_daily_profile WHERE platform = %s;", (platform,))
+            wherefilter, params = "", ()
+        else:
+            cur.execute("DELETE FROM author_daily_profile WHERE platform = %s AND day >= %s;", (platform, since.date()))
+            wherefilter, params = "WHERE created_at >= %s", (since,)
+        cur.execute(f"""
+            INSERT INTO author_daily_profile
+                (platform, community, author_name, day, post_count, length_sum, length_count, hour_counts)
+            SELECT %s,
+                   {source['community']} AS community,
+                   COALESCE({source['author']}, '') AS author,
+                   created_at::date AS post_day,
+                   COUNT(*)::int,
+                   COALESCE(SUM({source['length']}), 0)::bigint,
+                   COUNT({source['length']})::int,
+                   ARRAY[{HOURCOUNTS}]::int[]
+            FROM {source['table']}
+            {wherefilter}
+            GROUP BY community, author, post_day;
+        """, (platform,) + params)
+        inserted = cur.rowcount
+        cur.execute(f"SELECT MAX(created_at) FROM {source['table']} {wherefilter};", params)
+        newwatermark = cur.fetchone()[0]
+        if newwatermark is not None:
+            cur.execute("""
+                INSERT INTO rollup_watermarks (name, watermark, refreshed_at)
+                VALUES (%s, %s, now())
+                ON CONFLICT (name) DO UPDATE SET watermark = EXCLUDED.watermark, refreshed_at = now();
+            """, (name, newwatermark))
+    logger.info(f"refreshed {platform} author profiles from {since or 'the beginning'}: {inserted} daily rows, watermark {newwatermark}")
+    return newwatermark
+
+# this function refreshes the profiles of both platforms, with ifolderthan set the refresh is
+# skipped when another thread refreshed recently
+def refreshprofiles(full=False, ifolderthan=None):
+    global lastrefresh
+    ensureprofileschema()
+    with refreshlock:
+        if ifolderthan is not None and time.monotonic() - lastrefresh < ifolderthan:
+            return None
+        watermarks = {platform: refreshprofileplatform(platform, full=full) for platform in ROLLUPSOURCES}
+        lastrefresh = time.monotonic()
+    return watermarks
+
+refreshthread = None
+refreshthreadlock = threading.Lock()
+lastattempt = 0.0
+
+def backgroundrefresh():
+    try:
+        refreshprofiles(ifolderthan=refreshinterval)
+    except Exception as e:
+        logger.error(f"author profile refresh failed: {e}")
+
+# the author queries call this before reading the profiles, like rollups.refreshifstale the
+# refresh runs on a background thread and the reader reads the profiles as they are
+def refreshprofilesifstale():
+    global refreshthread, lastattempt
+    try:
+        ensureprofileschema()
+    except Exception as e:
+        logger.error(f"author profile schema check failed: {e}")
+        return
+    if time.monotonic() - max(lastrefresh, lastattempt) < refreshinterval or refreshlock.locked():
+        return
+    with refreshthreadlock:
+        if refreshthread is not None and refreshthread.is_alive():
+            return
+        lastattempt = time.monotonic()
+        refreshthread = threading.Thread(target=backgroundrefresh, name="author-profile-refresh", daemon=True)
+        refreshthread.start()
+
+# the where clause of one platform and optionally one community over whole days, profiles are
+# per day so a range covers the full days of its start and end
+def profilescope(platform, community, startdate, enddate):
+    sql = "p.platform = %s AND p.day BETWEEN %s AND %s"
+    params = (platform, startdate.date(), enddate.date())
+    if community is not None:
+        sql += " AND p.community = %s"
+        params += (community,)
+    return sql, params
+
+# this function returns the authors with the most posts as a dataframe of author_name and count
+def topauthors(platform, community, startdate, enddate, limit):
+    scope, params = profilescope(platform, community, startdate, enddate)
+    with get_cursor() as cur:
+        return fetchframe(cur, f"""
+            SELECT p.author_name, SUM(p.post_count)::int AS count
+            FROM author_daily_profile p
+            WHERE {scope}
+            GROUP BY p.author_name
+            ORDER BY count DESC
+            LIMIT %s
+        """, params + (limit,), dtypes={"author_name": "object", "count": "int64"})
+
+# this function returns the authors with the longest average post as a dataframe of author_name,
+# avg_len and count, authors that only posted empty texts come last
+def longestauthors(platform, community, startdate, enddate, limit):
+    scope, params = profilescope(platform, community, startdate, enddate)
+    with get_cursor() as cur:
+        return fetchframe(cur, f"""
+            SELECT p.author_name,
+                   (SUM(p.length_sum)::float / NULLIF(SUM(p.length_count), 0))::float AS avg_len,
+                   SUM(p.post_count)::int AS count
+            FROM author_daily_profile p
+            WHERE {scope}
+            GROUP BY p.author_name
+            ORDER BY avg_len DESC NULLS LAST
+            LIMIT %s
+        """, params + (limit,), dtypes={"author_name": "object", "avg_len": "float64", "count": "int64"})
+
+# this function returns the posts per hour of the day of the topn most active authors, leaving
+# out one author (the default name of the platform). the ranking and the pivot happen in the
+# database, the result is already the author by hour table the panel draws, ordered by activity
+def hourpattern(platform, community, startdate, enddate, topn, excluded):
+    scope, params = profilescope(platform, community, startdate, enddate)
+    with get_cursor() as cur:
+        frame = fetchframe(cur, f"""
+            WITH top AS (
+                SELECT p.author_name, SUM(p.post_count) AS total
+                FROM author_daily_profile p
+                WHERE {scope} AND p.author_name <> %s
+                GROUP BY p.author_name
+                ORDER BY total DESC
+                LIMIT %s
+            )
+            SELECT p.author_name, {HOURSUMS}
+            FROM author_daily_profile p
+            JOIN top ON top.author_name = p.author_name
+            WHERE {scope}
+            GROUP BY p.author_name, top.total
+            ORDER BY top.total DESC, p.author_name
+        """, params + (excluded, topn) + params, dtypes={"author_name": "object"})
+    frame = frame.set_index("author_name")
+    frame.columns = [int(column[1:]) for column in frame.columns]
+    return frame
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="refresh the per author daily profiles")
+    parser.add_argument("--full", action="store_true", help="rebuild every day instead of only the ones past the watermark")
+    args = parser.parse_args()
+    try:
+        refreshprofiles(full=args.full)
+    except Exception as e:
+        logger.error(f"author profile refresh failed: {e}")
+        sys.exit(1)
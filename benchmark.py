@@ -0,0 +1,264 @@
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+import tracemalloc
+from datetime import datetime, timedelta
+
+# the benchmark runs the panel functions against its own database, it drops and recreates the
+# post tables there so generate and run refuse to start without BENCH_DATABASE_URL or against
+# DATABASE_URL. db.py reads DATABASE_URL when it is imported so it is pointed at the benchmark
+# database before any of the panel modules is loaded, db.py only connects on the first query so
+# compare works without a database
+from dotenv import load_dotenv
+load_dotenv()
+BENCH_DATABASE_URL = os.getenv("BENCH_DATABASE_URL")
+DASHBOARD_DATABASE_URL = os.getenv("DATABASE_URL")
+if BENCH_DATABASE_URL:
+    os.environ["DATABASE_URL"] = BENCH_DATABASE_URL
+
+import pandas as pd
+from db import get_cursor
+from utils import getlogger
+from migrations import applymigrations
+import rollups
+from rollups import refreshrollups
+from communitycatalog import refreshcatalog
+import authorprofiles
+from authorprofiles import refreshprofiles
+from bucketcache import bucketcache
+from querycache import clearcache
+from snapshot import SCORECOLUMNS
+import temporal
+import toxicityovertime
+import aitopicanalysis
+
+logger = getlogger("benchmark")
+BOARDS = ["g", "pol", "b", "v", "a", "biz", "sci", "tv", "fit", "k"]
+SUBREDDITS = ["technology", "politics", "askreddit", "programming", "chatgpt", "worldnews",
+              "gaming", "machinelearning", "science", "news"]
+TOPICS = ["ChatGPT", "Claude", "Gemini", "LLaMA"]
+
+BENCHSCHEMA = f"""
+    DROP TABLE IF EXISTS chan_posts, reddit_posts, post_rollup_hourly, rollup_watermarks,
+                         community_catalog, author_daily_profile, schema_migrations CASCADE;
+    CREATE TABLE chan_posts (
+        id BIGSERIAL PRIMARY KEY,
+        board_name TEXT NOT NULL,
+        author_name TEXT,
+        content TEXT,
+        created_at TIMESTAMP NOT NULL,
+        {", ".join(f"{c} DOUBLE PRECISION" for c in SCORECOLUMNS)}
+    );
+    CREATE TABLE reddit_posts (
+        id BIGSERIAL PRIMARY KEY,
+        data JSONB NOT NULL,
+        created_at TIMESTAMP NOT NULL,
+        {", ".join(f"{c} DOUBLE PRECISION" for c in SCORECOLUMNS)}
+    );
+"""
+
+# the pick from a list is skewed with pow(random(), k) so the first boards, authors and topics
+# are far more common than the last ones, posts are spread evenly over the time span in insert
+# order like the crawlers write them and 5% of the scores are missing
+def skewedpick(values, power):
+    return f"(%({values})s::text[])[1 + floor(pow(random(), {power}) * array_length(%({values})s::text[], 1))::int]"
+
+SCOREVALUES = ", ".join("CASE WHEN random() < 0.05 THEN NULL ELSE pow(random(), 3) END" for _ in SCORECOLUMNS)
+POSTTEXT = f"""repeat('lorem ipsum ', (1 + pow(random(), 2) * 40)::int)
+               || CASE WHEN random() < %(topicrate)s THEN ' ' || {skewedpick('topics', 2)} || ' ' ELSE '' END"""
+POSTTIME = "%(start)s::timestamp + (i::float / %(total)s) * %(span)s::interval + random() * interval '1 minute'"
+
+CHANINSERT = f"""
+    INSERT INTO chan_posts (board_name, author_name, content, created_at, {", ".join(SCORECOLUMNS)})
+    SELECT {skewedpick('boards', 2)},
+           CASE WHEN random() < 0.6 THEN 'Anonymous' ELSE 'anon' || floor(pow(random(), 3) * %(authors)s)::int END,
+           {POSTTEXT},
+           {POSTTIME},
+           {SCOREVALUES}
+    FROM generate_series(%(first)s, %(last)s) AS i;
+"""
+REDDITINSERT = f"""
+    INSERT INTO reddit_posts (data, created_at, {", ".join(SCORECOLUMNS)})
+    SELECT jsonb_build_object(
+               'subreddit', sub,
+               'subreddit_name_prefixed', 'r/' || sub,
+               'author', CASE WHEN random() < 0.02 THEN 'AutoModerator' ELSE 'user' || floor(pow(random(), 3) * %(authors)s)::int END,
+               'title', CASE WHEN random() < 0.2 THEN 'a title' ELSE NULL END,
+               'body', {POSTTEXT},
+               'selftext', ''),
+           {POSTTIME},
+           {SCOREVALUES}
+    FROM (SELECT i, {skewedpick('subreddits', 2)} AS sub FROM generate_series(%(first)s, %(last)s) AS i) AS g;
+"""
+
+def checkbenchdatabase():
+    if not BENCH_DATABASE_URL:
+        sys.exit("set BENCH_DATABASE_URL to a scratch database, the benchmark drops its tables")
+    if BENCH_DATABASE_URL == DASHBOARD_DATABASE_URL:
+        sys.exit("BENCH_DATABASE_URL must not be the dashboard database")
+
+# the panel functions start a background refresh of the rollups and author profiles when theirs
+# is due, in a fresh process that would be the first timed call. they are refreshed here once
+# and the background refresh is switched off so it can't run during the measurements
+def settlerefreshes():
+    refreshrollups()
+    refreshprofiles()
+    rollups.refreshinterval = float("inf")
+    authorprofiles.refreshinterval = float("inf")
+
+# this function recreates the post tables in the benchmark database and fills them with rows
+# synthetic posts per platform spread over the last days, in batches so no single transaction
+# gets huge. the migrations, rollups, community catalog and author profiles are built the way production has them
+def generate(rows, days, authors, topicrate, batch):
+    end = datetime.utcnow()
+    start = end - timedelta(days=days)
+    with get_cursor(commit=True) as cur:
+        cur.execute(BENCHSCHEMA)
+    applymigrations()
+    for table, sql in (("chan_posts", CHANINSERT), ("reddit_posts", REDDITINSERT)):
+        for first in range(0, rows, batch):
+            last = min(rows, first + batch) - 1
+            began = time.perf_counter()
+            with get_cursor(commit=True) as cur:
+                cur.execute(sql, {"first": first, "last": last, "total": rows, "start": start,
+                                  "span": end - start, "authors": authors, "topicrate": topicrate,
+                                  "boards": BOARDS, "subreddits": SUBREDDITS, "topics": TOPICS})
+            logger.info(f"{table}: inserted rows {first}..{last} in {time.perf_counter() - began:.1f}s")
+    with get_cursor(commit=True) as cur:
+        cur.execute("ANALYZE chan_posts; ANALYZE reddit_posts;")
+    refreshrollups(full=True)
+    refreshcatalog()
+    refreshprofiles(full=True)
+
+# the public panel functions with the arguments they get from the dashboard, the caches are
+# bypassed so every run measures the database work
+def benchmarkcalls(start, end):
+    s, e = start.isoformat(), end.isoformat()
+    return {
+        "temporalquery": lambda: temporal.temporalquery.uncached(start=s, end=e),
+        "getpostspertime": lambda: temporal.getpostspertime.uncached(bucket="day", start=s, end=e),
+        "gettemporalsummary": lambda: temporal.gettemporalsummary(start=s, end=e),
+        "weekdayvsweekendstats": lambda: temporal.weekdayvsweekendstats(start=s, end=e),
+        "postlengthovertime": lambda: temporal.postlengthovertime(start=s, end=e),
+        "gettopauthors": lambda: temporal.gettopauthors.uncached(start=s, end=e, limit=30),
+        "authortimepattern": lambda: temporal.authortimepattern.uncached(start=s, end=e, topn=10),
+        "averagepostlenghtbyauthor": lambda: temporal.averagepostlenghtbyauthor.uncached(start=s, end=e, limit=30),
+        "getthecommunities": lambda: toxicityovertime.getthecommunities.uncached(),
+        "gettoxicity": lambda: toxicityovertime.gettoxicity.uncached(["chan", "reddit"], BOARDS[:3] + SUBREDDITS[:3], start=s, end=e),
+        "gettoxicityallmetrics": lambda: toxicityovertime.gettoxicityallmetrics.uncached(["chan", "reddit"], BOARDS[:3] + SUBREDDITS[:3], start=s, end=e),
+        "getaitopics": lambda: aitopicanalysis.getaitopics.uncached(TOPICS, "both", bucket="day", start=s, end=e),
+    }
+
+# rough number of rows a function handed back, dataframes count their rows and nested lists
+# count their leaf entries
+def countrows(value):
+    if isinstance(value, pd.DataFrame):
+        return len(value)
+    if isinstance(value, dict):
+        return sum(countrows(v) for v in value.values() if isinstance(v, (dict, list, pd.DataFrame)))
+    if isinstance(value, list):
+        return sum(countrows(v) or 1 for v in value)
+    return 0
+
+def percentile(values, q):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))]
+
+def resetcaches():
+    clearcache()
+    bucketcache.clear()
+
+# this function times every panel function for every range width, the timed runs don't trace
+# memory because tracemalloc slows python down, one extra traced run measures the peak instead
+def run(ranges, repeat, functions=None):
+    settlerefreshes()
+    end = datetime.utcnow()
+    results = []
+    for days in ranges:
+        start = end - timedelta(days=days)
+        for name, call in benchmarkcalls(start, end).items():
+            if functions and name not in functions:
+                continue
+            resetcaches()
+            call()
+            timings = []
+            for _ in range(repeat):
+                resetcaches()
+                began = time.perf_counter()
+                value = call()
+                timings.append((time.perf_counter() - began) * 1000)
+            resetcaches()
+            tracemalloc.start()
+            call()
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            entry = {"function": name, "range_days": days, "runs": repeat,
+                     "p50_ms": round(percentile(timings, 0.5), 2), "p95_ms": round(percentile(timings, 0.95), 2),
+                     "rows": countrows(value), "peak_python_mb": round(peak / 1024 / 1024, 2)}
+            logger.info(f"{name} {days}d p50 {entry['p50_ms']}ms p95 {entry['p95_ms']}ms rows {entry['rows']} peak {entry['peak_python_mb']}MB")
+            results.append(entry)
+    return results
+
+def tablesizes():
+    with get_cursor() as cur:
+        cur.execute("SELECT (SELECT COUNT(*) FROM chan_posts), (SELECT COUNT(*) FROM reddit_posts);")
+        chan, reddit = cur.fetchone()
+    return {"chan_posts": chan, "reddit_posts": reddit}
+
+def gitcommit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True).stdout.strip() or None
+    except Exception:
+        return None
+
+# prints how the p50 of every function and range moved between two result files
+def compare(oldpath, newpath):
+    with open(oldpath) as f:
+        old = {(r["function"], r["range_days"]): r for r in json.load(f)["results"]}
+    with open(newpath) as f:
+        new = json.load(f)["results"]
+    print(f"{'function':<28} {'days':>5} {'old p50':>10} {'new p50':>10} {'change':>8}")
+    for r in new:
+        before = old.get((r["function"], r["range_days"]))
+        if before is None:
+            continue
+        change = (r["p50_ms"] - before["p50_ms"]) / before["p50_ms"] * 100 if before["p50_ms"] else 0
+        print(f"{r['function']:<28} {r['range_days']:>5} {before['p50_ms']:>10} {r['p50_ms']:>10} {change:>7.1f}%")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="benchmark the dashboard query functions on synthetic data")
+    commands = parser.add_subparsers(dest="command", required=True)
+    gen = commands.add_parser("generate", help="recreate the benchmark tables with synthetic posts")
+    gen.add_argument("--rows", type=int, default=1_000_000, help="posts per platform")
+    gen.add_argument("--days", type=int, default=365, help="time span the posts are spread over")
+    gen.add_argument("--authors", type=int, default=100_000, help="distinct authors per platform")
+    gen.add_argument("--topic-rate", type=float, default=0.03, help="share of posts that mention an ai topic")
+    gen.add_argument("--batch", type=int, default=1_000_000, help="rows per insert transaction")
+    bench = commands.add_parser("run", help="time every panel function")
+    bench.add_argument("--ranges", default="1,7,30,90", help="comma separated date range widths in days")
+    bench.add_argument("--repeat", type=int, default=5, help="timed runs per function and range")
+    bench.add_argument("--functions", help="comma separated subset of functions to run")
+    bench.add_argument("--output", help="result file, defaults to benchmarks/bench-<timestamp>.json")
+    cmp = commands.add_parser("compare", help="compare two result files")
+    cmp.add_argument("old")
+    cmp.add_argument("new")
+    args = parser.parse_args()
+    if args.command in ("generate", "run"):
+        checkbenchdatabase()
+    if args.command == "generate":
+        generate(args.rows, args.days, args.authors, args.topic_rate, args.batch)
+    elif args.command == "run":
+        ranges = [int(d) for d in args.ranges.split(",")]
+        functions = args.functions.split(",") if args.functions else None
+        results = run(ranges, args.repeat, functions)
+        output = args.output or os.path.join("benchmarks", f"bench-{datetime.utcnow():%Y%m%d-%H%M%S}.json")
+        os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+        with open(output, "w") as f:
+            json.dump({"generated_at": datetime.utcnow().isoformat(), "commit": gitcommit(),
+                       "tables": tablesizes(), "results": results}, f, indent=2)
+        print(f"wrote {output}")
+    else:
+        compare(args.old, args.new)
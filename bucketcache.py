@@ -0,0 +1,115 @@
+import os
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from utils import getlogger
+
+logger = getlogger("bucketcache")
+# how many series (one platform, community, topic and metric at one bucket size) are kept,
+# the least recently used series is dropped first
+maxseries = int(os.getenv("BUCKET_CACHE_MAX_SERIES", "512"))
+# the crawlers insert late, a bucket that ended less than this many seconds ago may still grow
+# so it is queried again instead of stored. callers reading the rollups pass their watermark
+settleseconds = int(os.getenv("BUCKET_CACHE_SETTLE_SECONDS", "7200"))
+BUCKETWIDTHS = {
+    "minute": timedelta(minutes=1),
+    "hour": timedelta(hours=1),
+    "day": timedelta(days=1),
+    "week": timedelta(weeks=1),
+}
+
+# python version of date_trunc for the bucket sizes the panels use, weeks start on monday
+# like they do in postgres
+def truncate(ts, bucket):
+    if bucket == "minute":
+        return ts.replace(second=0, microsecond=0)
+    if bucket == "hour":
+        return ts.replace(minute=0, second=0, microsecond=0)
+    day = ts.replace(hour=0, minute=0, second=0, microsecond=0)
+    if bucket == "week":
+        return day - timedelta(days=day.weekday())
+    return day
+
+def bucketsinrange(bucket, start, end):
+    width = BUCKETWIDTHS[bucket]
+    current = truncate(start, bucket)
+    buckets = []
+    while current <= end:
+        buckets.append(current)
+        current += width
+    return buckets
+
+# this function groups sorted bucket starts into runs of consecutive buckets so every gap in
+# the cache costs one query instead of one per bucket
+def contiguousruns(buckets, bucket):
+    width = BUCKETWIDTHS[bucket]
+    runs = []
+    for b in buckets:
+        if runs and runs[-1][-1] + width == b:
+            runs[-1].append(b)
+        else:
+            runs.append([b])
+    return runs
+
+# bucket granular cache for time series. a bucket is stored once it is complete, meaning the
+# requested range covers it entirely and it ended before settled (now minus settleseconds unless
+# the caller knows better, like the rollup watermark), so a sliding window only queries the
+# buckets it has not seen yet plus the partial and recent buckets at its edges, the still open
+# current bucket is always one of those and so it is always refreshed. empty buckets are stored
+# as None so they don't count as missing
+class BucketCache:
+    def __init__(self, maxseries):
+        self.maxseries = maxseries
+        self.series = OrderedDict()
+        self.lock = threading.Lock()
+
+    def storedbuckets(self, key):
+        with self.lock:
+            stored = self.series.get(key)
+            if stored is None:
+                return {}
+            self.series.move_to_end(key)
+            return dict(stored)
+
+    def store(self, key, points):
+        with self.lock:
+            stored = self.series.setdefault(key, {})
+            stored.update(points)
+            self.series.move_to_end(key)
+            while len(self.series) > self.maxseries:
+                self.series.popitem(last=False)
+
+    # keys are the series to return, all of them share one date range and bucket size and
+    # fetch(substart, subend) must return {key: [points]} for that sub range where every point
+    # has its bucket start in "t". buckets missing for any key are fetched for all keys so one
+    # query per gap serves every series
+    def fetchseries(self, keys, bucket, start, end, fetch, settled=None):
+        width = BUCKETWIDTHS[bucket]
+        settled = datetime.utcnow() - timedelta(seconds=settleseconds) if settled is None else settled
+        fullkeys = {key: (bucket,) + tuple(key) for key in keys}
+        stored = {key: self.storedbuckets(fullkey) for key, fullkey in fullkeys.items()}
+        buckets = bucketsinrange(bucket, start, end)
+        def complete(b):
+            return b >= start and b + width <= end and b + width <= settled
+        missing = [b for b in buckets if not complete(b) or any(b not in stored[key] for key in keys)]
+        for run in contiguousruns(missing, bucket):
+            substart = max(start, run[0])
+            subend = min(end, run[-1] + width)
+            fetched = fetch(substart, subend)
+            runbuckets = set(run)
+            for key in keys:
+                points = {b: None for b in run}
+                for point in fetched.get(key, []):
+                    b = point["t"].replace(tzinfo=None)
+                    if b in runbuckets:
+                        points[b] = point
+                stored[key].update(points)
+                self.store(fullkeys[key], {b: p for b, p in points.items() if complete(b)})
+        logger.debug(f"{bucket} series {len(keys)}: {len(buckets) - len(missing)} cached buckets, {len(missing)} fetched")
+        return {key: [stored[key][b] for b in buckets if stored[key].get(b) is not None] for key in keys}
+
+    def clear(self):
+        with self.lock:
+            self.series.clear()
+
+bucketcache = BucketCache(maxseries)
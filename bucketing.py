@@ -0,0 +1,69 @@
+import os
+from bucketcache import BUCKETWIDTHS
+
+# the bucket sizes from finest to coarsest, every one of them is a date_trunc unit
+RESOLUTIONS = ["minute", "hour", "day", "week"]
+# auto bucketing picks the finest size that keeps a chart under this many points per series
+targetpoints = int(os.getenv("CHART_TARGET_POINTS", "500"))
+# a size the analyst picked is coarsened when the range would hold more buckets than this, the
+# buckets are queried and cached one by one so a year of minutes is never fetched
+maxbuckets = int(os.getenv("CHART_MAX_BUCKETS", "20000"))
+
+def bucketcount(start, end, bucket):
+    return int((end - start) / BUCKETWIDTHS[bucket]) + 1
+
+# this function returns the bucket size for a date range. auto (or no requested size) picks
+# the finest size with at most target buckets, a requested size is kept unless the range
+# would hold more than maxbuckets of it in which case the next coarser size that fits is used
+def choosebucket(start, end, requested="auto", target=None):
+    target = target or targetpoints
+    if requested in RESOLUTIONS:
+        candidates, limit = RESOLUTIONS[RESOLUTIONS.index(requested):], maxbuckets
+    else:
+        candidates, limit = RESOLUTIONS, target
+    for bucket in candidates:
+        if bucketcount(start, end, bucket) <= limit:
+            return bucket
+    return RESOLUTIONS[-1]
+
+def xvalue(point, x):
+    value = point[x]
+    return value.timestamp() if hasattr(value, "timestamp") else float(value)
+
+def yvalue(point, y):
+    return float(point.get(y) or 0)
+
+# largest triangle three buckets: keeps the first and last point and from every one of
+# threshold - 2 equal slices of the rest the point that spans the largest triangle with the
+# point kept before it and the average of the next slice. peaks and dips survive where plain
+# striding would drop them. returns the indices of the kept points
+def lttbindices(points, threshold, x="t", y="count"):
+    n = len(points)
+    if threshold >= n or threshold < 3:
+        return list(range(n))
+    every = (n - 2) / (threshold - 2)
+    kept = [0]
+    a = 0
+    for i in range(threshold - 2):
+        nextstart = int((i + 1) * every) + 1
+        nextend = min(int((i + 2) * every) + 1, n)
+        nextpoints = points[nextstart:nextend]
+        averagex = sum(xvalue(p, x) for p in nextpoints) / len(nextpoints)
+        averagey = sum(yvalue(p, y) for p in nextpoints) / len(nextpoints)
+        ax, ay = xvalue(points[a], x), yvalue(points[a], y)
+        best, bestarea = None, -1.0
+        for j in range(int(i * every) + 1, nextstart):
+            area = abs((ax - averagex) * (yvalue(points[j], y) - ay) - (ax - xvalue(points[j], x)) * (averagey - ay))
+            if area > bestarea:
+                best, bestarea = j, area
+        kept.append(best)
+        a = best
+    kept.append(n - 1)
+    return kept
+
+# this function downsamples a series of points for a chart, with at most threshold points it
+# is returned as it is. the points keep all their fields so other metrics of the same series
+# can be charted from the kept points
+def downsample(points, threshold=None, x="t", y="count"):
+    threshold = threshold or targetpoints
+    return [points[i] for i in lttbindices(points, threshold, x, y)]
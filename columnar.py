@@ -0,0 +1,29 @@
+import os
+import time
+import tempfile
+import pandas as pd
+import psycopg2.extensions
+
+# results up to this size are buffered in memory, larger ones spill to a temporary file
+spillbytes = int(os.getenv("COPY_SPILL_MB", "64")) * 1024 * 1024
+# the null marker of the copy stream, an empty string author stays an empty string this way
+NULLMARKER = "\\N"
+
+# this function runs a query through COPY ... TO STDOUT as csv and parses the stream straight
+# into typed dataframe columns, the rows never become python tuples and dicts on the way. the
+# query is bound with the cursor's own parameter quoting first because COPY takes no parameters.
+# dtypes maps column names to numpy/pandas dtypes, dates lists the timestamp columns. the cursor
+# comes from get_cursor so the copy, the parsing and the rows are recorded under the calling
+# function
+def fetchframe(cur, sql, params=None, dtypes=None, dates=()):
+    encoding = psycopg2.extensions.encodings.get(cur.connection.encoding, "utf-8")
+    query = cur.mogrify(sql.strip().rstrip(";"), params).decode(encoding)
+    copysql = f"COPY ({query}) TO STDOUT WITH (FORMAT csv, HEADER true, NULL '{NULLMARKER}')"
+    with tempfile.SpooledTemporaryFile(max_size=spillbytes, mode="w+b") as buffer:
+        cur.copy_expert(copysql, buffer)
+        buffer.seek(0)
+        began = time.perf_counter()
+        frame = pd.read_csv(buffer, encoding=encoding, dtype=dtypes, parse_dates=list(dates),
+                            keep_default_na=False, na_values=[NULLMARKER])
+    cur.recordfetch(began, len(frame))
+    return frame
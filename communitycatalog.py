@@ -0,0 +1,111 @@
+import sys
+import argparse
+from datetime import timedelta
+from db import get_cursor
+from rollups import ROLLUPSOURCES, lookbackhours, refreshrollups, ensurerollupschema, afterrefresh
+from utils import getlogger
+
+logger = getlogger("communitycatalog")
+
+# one row per platform and normalized community name with the hour of its first and last post
+# and its post count, the toxicity panel fills its community picker from here instead of running
+# SELECT DISTINCT over the post tables
+CATALOGSCHEMA = """
+    CREATE TABLE IF NOT EXISTS community_catalog (
+        platform TEXT NOT NULL,
+        community TEXT NOT NULL,
+        first_seen TIMESTAMP NOT NULL,
+        last_seen TIMESTAMP NOT NULL,
+        post_count BIGINT NOT NULL,
+        PRIMARY KEY (platform, community)
+    );
+"""
+
+schemaready = False
+
+def ensurecatalogschema():
+    global schemaready
+    if schemaready:
+        return
+    ensurerollupschema()
+    with get_cursor(commit=True) as cur:
+        cur.execute(CATALOGSCHEMA)
+    schemaready = True
+
+# this function brings the catalog of one platform up to date with the hourly rollups. only the
+# communities that have rollup hours past the catalog watermark are touched and their totals are
+# recomputed from their rollup rows, so rerunning it never double counts a post
+def refreshcatalogplatform(platform, full=False):
+    name = f"community_catalog:{platform}"
+    with get_cursor(commit=True) as cur:
+        cur.execute("SELECT pg_advisory_xact_lock(hashtext(%s));", (name,))
+        cur.execute("SELECT watermark FROM rollup_watermarks WHERE name = %s;", (name,))
+        row = cur.fetchone()
+        since = None if row is None or full else row[0] - timedelta(hours=lookbackhours)
+        touched = "" if since is None else """
+            AND community IN (
+                SELECT DISTINCT community FROM post_rollup_hourly
+                WHERE platform = %s AND bucket_hour >= %s
+            )"""
+        params = (platform,) if since is None else (platform, platform, since)
+        cur.execute(f"""
+            INSERT INTO community_catalog (platform, community, first_seen, last_seen, post_count)
+            SELECT platform, community, MIN(bucket_hour), MAX(bucket_hour), SUM(post_count)
+            FROM post_rollup_hourly
+            WHERE platform = %s AND community <> '' {touched}
+            GROUP BY platform, community
+            ON CONFLICT (platform, community) DO UPDATE SET
+                first_seen = EXCLUDED.first_seen,
+                last_seen = EXCLUDED.last_seen,
+                post_count = EXCLUDED.post_count;
+        """, params)
+        updated = cur.rowcount
+        cur.execute("SELECT MAX(bucket_hour) FROM post_rollup_hourly WHERE platform = %s;", (platform,))
+        newwatermark = cur.fetchone()[0]
+        if newwatermark is not None:
+            cur.execute("""
+                INSERT INTO rollup_watermarks (name, watermark, refreshed_at)
+                VALUES (%s, %s, now())
+                ON CONFLICT (name) DO UPDATE SET watermark = EXCLUDED.watermark, refreshed_at = now();
+            """, (name, newwatermark))
+    logger.info(f"refreshed {updated} {platform} communities in the catalog")
+    return updated
+
+# this function brings the rollups up to date and then refreshes the catalog of both platforms,
+# with full the rollups are rebuilt too. it runs the rollup refresh itself so the command line
+# doesn't exit before it is done
+def refreshcatalog(full=False):
+    ensurecatalogschema()
+    refreshrollups(full=full)
+    return {platform: refreshcatalogplatform(platform, full=full) for platform in ROLLUPSOURCES}
+
+# the catalog follows the rollups, every background rollup refresh of the dashboard brings it up
+# to date afterwards so reading the catalog never writes
+def refreshcatalogafterrollups():
+    ensurecatalogschema()
+    for platform in ROLLUPSOURCES:
+        refreshcatalogplatform(platform)
+
+afterrefresh.append(refreshcatalogafterrollups)
+
+# returns the catalog rows of a platform sorted by community name
+def catalogcommunities(platform):
+    ensurecatalogschema()
+    with get_cursor() as cur:
+        cur.execute("""
+            SELECT community, first_seen, last_seen, post_count
+            FROM community_catalog
+            WHERE platform = %s
+            ORDER BY community;
+        """, (platform,))
+        return [{"community": r[0], "first_seen": r[1], "last_seen": r[2], "post_count": r[3]} for r in cur.fetchall()]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="refresh the community catalog")
+    parser.add_argument("--full", action="store_true", help="rebuild the rollups and the whole catalog")
+    args = parser.parse_args()
+    try:
+        refreshcatalog(full=args.full)
+    except Exception as e:
+        logger.error(f"catalog refresh failed: {e}")
+        sys.exit(1)
@@ -0,0 +1,146 @@
+import time
+import threading
+from collections import deque
+import psycopg2
+import psycopg2.extensions
+from psycopg2.pool import PoolError
+from utils import getlogger
+
+logger = getlogger("connpool")
+
+class PoolTimeout(TimeoutError):
+    pass
+
+# a connection pool for threads that blocks instead of failing when every connection is in use.
+# waiters are served in arrival order through one condition variable, a waiter only takes a
+# connection when it is at the head of the queue so a late thread can't overtake one that has
+# been waiting longer. connections are checked before they are handed out and replaced when they
+# are broken, older than maxage or idle longer than maxidle. every connection gets the
+# statement_timeout at connect time so it survives the rollbacks between checkouts
+class FairConnectionPool:
+    def __init__(self, minconn, maxconn, dsn, maxwait=10, maxage=1800, maxidle=300, pingafter=5, statementtimeout=None):
+        if maxconn < 1 or minconn > maxconn:
+            raise ValueError(f"invalid pool size min={minconn} max={maxconn}")
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.dsn = dsn
+        self.maxwait = maxwait
+        self.maxage = maxage
+        self.maxidle = maxidle
+        self.pingafter = pingafter
+        self.statementtimeout = statementtimeout
+        self.condition = threading.Condition()
+        # idle connections as (connection, opened at, returned at), the most recently returned last
+        self.idle = deque()
+        self.openedat = {}
+        self.opened = 0
+        self.waiters = deque()
+        self.closed = False
+        for _ in range(minconn):
+            conn = self.connect()
+            self.opened += 1
+            self.idle.append((conn, self.openedat[id(conn)], time.monotonic()))
+
+    def connect(self):
+        options = {}
+        if self.statementtimeout:
+            options["options"] = f"-c statement_timeout={int(self.statementtimeout)}"
+        conn = psycopg2.connect(self.dsn, **options)
+        self.openedat[id(conn)] = time.monotonic()
+        return conn
+
+    def discard(self, conn):
+        self.openedat.pop(id(conn), None)
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    # true when a connection taken from the idle list can be handed out as it is, a connection
+    # that sat idle for a while is pinged because the server may have dropped it meanwhile
+    def usable(self, conn, openedat, returnedat):
+        now = time.monotonic()
+        if conn.closed or now - openedat > self.maxage or now - returnedat > self.maxidle:
+            return False
+        if conn.info.transaction_status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            return False
+        if now - returnedat > self.pingafter:
+            try:
+                with conn.cursor() as cur:
+                    cur.execute("SELECT 1")
+                conn.rollback()
+            except psycopg2.Error:
+                return False
+        return True
+
+    # this function hands out a connection, it waits up to timeout seconds (the pool's maxwait by
+    # default) for its turn and raises PoolTimeout when none became free in time
+    def getconn(self, timeout=None):
+        timeout = self.maxwait if timeout is None else timeout
+        deadline = time.monotonic() + timeout
+        ticket = object()
+        with self.condition:
+            if self.closed:
+                raise PoolError("connection pool is closed")
+            self.waiters.append(ticket)
+            try:
+                while not (self.waiters[0] is ticket and (self.idle or self.opened < self.maxconn)):
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise PoolTimeout(f"no database connection available after {timeout} seconds "
+                                          f"({self.opened - len(self.idle)}/{self.maxconn} in use, {len(self.waiters)} waiting)")
+                    self.condition.wait(remaining)
+            finally:
+                self.waiters.remove(ticket)
+                # the next waiter may be able to go now that this one left the head of the queue
+                self.condition.notify_all()
+            entry = self.idle.pop() if self.idle else None
+            if entry is None:
+                self.opened += 1
+        # checking and connecting happen outside the lock so a slow server doesn't hold up the
+        # threads returning connections. the slot is ours either way, a bad idle connection is
+        # replaced by a new one in the same slot
+        try:
+            if entry is not None:
+                if self.usable(*entry):
+                    return entry[0]
+                logger.debug("replacing a stale or broken pooled connection")
+                self.discard(entry[0])
+            return self.connect()
+        except Exception:
+            with self.condition:
+                self.opened -= 1
+                self.condition.notify_all()
+            raise
+
+    # returns a connection to the pool, it is closed instead when close is set, when it is broken
+    # or too old, or when the pool has been closed. a connection still in a transaction (every
+    # read only checkout leaves one open) is rolled back first, outside the lock, so it goes back
+    # idle and the next checkout can reuse it
+    def putconn(self, conn, close=False):
+        if not close and not conn.closed and conn.info.transaction_status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                close = True
+        with self.condition:
+            if close or self.closed or conn.closed or time.monotonic() - self.openedat.get(id(conn), 0) > self.maxage:
+                self.discard(conn)
+                self.opened -= 1
+            else:
+                self.idle.append((conn, self.openedat[id(conn)], time.monotonic()))
+            self.condition.notify_all()
+
+    def stats(self):
+        with self.condition:
+            return {"opened": self.opened, "idle": len(self.idle), "in_use": self.opened - len(self.idle),
+                    "waiting": len(self.waiters), "max": self.maxconn}
+
+    def closeall(self):
+        with self.condition:
+            self.closed = True
+            while self.idle:
+                conn, _, _ = self.idle.pop()
+                self.discard(conn)
+                self.opened -= 1
+            self.condition.notify_all()
@@ -1,12 +1,14 @@
 import os
 import time
+import threading
 import psycopg2
-from psycopg2 import pool
 from psycopg2.extras import Json
 from psycopg2.extensions import register_adapter
 from contextlib import contextmanager
 from dotenv import load_dotenv
 from utils import getlogger
+from connpool import FairConnectionPool, PoolTimeout
+from querymetrics import querymetrics, InstrumentedCursor, callername, startmetricsserver
 
 # loading the environment variables
 load_dotenv()
@@ -17,57 +19,81 @@ DATABASE_URL = os.getenv("DATABASE_URL")
 # this code sets up a PostgreSQL connection pool which lets the app reuse database connections 
 # instead of making a new one for each query. This method is very helpful when the program runs 
 # more than one Faktory job at the same time because it stops the database from getting too many 
-# connection requests. The ThreadedConnectionPool keeps a number of active connections open. 
+# connection requests. The pool keeps a number of active connections open. 
 # The minconn setting tells the pool how many open connections to keep ready, 
 # and the maxconn setting tells the pool how many connections can be open at the same time.
-connection_pool = pool.ThreadedConnectionPool(
-    minconn=int(os.getenv("DB_MIN_CONN")),
-    maxconn=int(os.getenv("DB_MAX_CONN")),
-    dsn=DATABASE_URL
-)
-logger.info(f"database connection pool created with min={connection_pool.minconn}, max={connection_pool.maxconn}")
+# when every connection is busy a thread waits in line for the next free one (up to
+# DB_POOL_MAX_WAIT seconds), connections are recycled after DB_POOL_MAX_AGE seconds or
+# DB_POOL_MAX_IDLE seconds unused, and DB_STATEMENT_TIMEOUT_MS caps every statement
+def optionalint(name):
+    value = os.getenv(name)
+    return int(value) if value else None
+
+# the pool is created by the first get_cursor call instead of at import, so importing a panel
+# module costs no connections and a dashboard rerun that hits the query cache never waits on
+# the database. DB_MIN_CONN defaults to 1 and DB_MAX_CONN to 10
+connection_pool = None
+poollock = threading.Lock()
+
+def getpool():
+    global connection_pool
+    if connection_pool is None:
+        with poollock:
+            if connection_pool is None:
+                began = time.perf_counter()
+                connection_pool = FairConnectionPool(
+                    minconn=int(os.getenv("DB_MIN_CONN") or "1"),
+                    maxconn=int(os.getenv("DB_MAX_CONN") or "10"),
+                    dsn=DATABASE_URL,
+                    maxwait=float(os.getenv("DB_POOL_MAX_WAIT", "10")),
+                    maxage=float(os.getenv("DB_POOL_MAX_AGE", "1800")),
+                    maxidle=float(os.getenv("DB_POOL_MAX_IDLE", "300")),
+                    pingafter=float(os.getenv("DB_POOL_PING_AFTER", "5")),
+                    statementtimeout=optionalint("DB_STATEMENT_TIMEOUT_MS"),
+                )
+                logger.info(f"database connection pool created with min={connection_pool.minconn}, "
+                            f"max={connection_pool.maxconn} in {time.perf_counter() - began:.3f}s")
+    return connection_pool
+
+startmetricsserver()
 # context manager to get a DB cursor from the pool.
 # automatically commits on success or rolls back on error.
-# added timeout and retry mechanism in case the pool is exhausted
+# waits up to timeout seconds (DB_POOL_MAX_WAIT by default) for a connection when the pool is
+# exhausted, waiting threads are served in the order they asked
+# every cursor is instrumented, the pool wait and the execute and fetch times of its queries are
+# recorded under the function that asked for it (see querymetrics)
 @contextmanager
-def get_cursor(commit=False, timeout=10, retry_delay=1):
-    start_time = time.time()
+def get_cursor(commit=False, timeout=None):
+    caller = callername()
+    wait_start = time.perf_counter()
     conn = None
     cur = None
-    attempts = 0
-    while True:
-        try:
-            conn = connection_pool.getconn()
-            break
-        except psycopg2.pool.PoolError:
-            attempts += 1
-            elapsed = time.time() - start_time
-            if elapsed >= timeout:
-                try:
-                    available = len(connection_pool._pool)
-                    busy = connection_pool.maxconn - available
-                    logger.error(
-                        f"CRITICAL: pool exhausted after {timeout}s and {attempts} attempts. "
-                        f"pool status: {busy}/{connection_pool.maxconn} connections in use"
-                    )
-                except:
-                    logger.error(f"CRITICAL: pool exhausted after {timeout}s and {attempts} attempts")
-                raise TimeoutError(f"no database connection available after {timeout} seconds")
-            if attempts % 5 == 0:
-                logger.warning(f"pool busy-> attempt {attempts} elapsed {elapsed:.1f}s")
-            time.sleep(retry_delay)
+    broken = False
+    pool = getpool()
+    try:
+        conn = pool.getconn(timeout)
+    except PoolTimeout as e:
+        logger.error(f"CRITICAL: {e}")
+        raise
+    querymetrics.observe("pool_wait", caller, time.perf_counter() - wait_start)
     try:
-        cur = conn.cursor()
+        cur = conn.cursor(cursor_factory=InstrumentedCursor)
+        cur.caller = caller
         yield cur
         if commit:
             conn.commit()
     except Exception as e:
-        if conn:
+        try:
             conn.rollback()
+        except psycopg2.Error:
+            broken = True
         raise e
     finally:
         if cur:
-            cur.close()
-        if conn:
-            connection_pool.putconn(conn)
-            logger.debug("returned database connection to pool")
\ No newline at end of file
+            try:
+                cur.close()
+            except psycopg2.Error:
+                broken = True
+        pool.putconn(conn, close=broken)
+        logger.debug("returned database connection to pool")
+        querymetrics.maybewrite()
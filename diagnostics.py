@@ -0,0 +1,33 @@
+import streamlit as st
+import pandas as pd
+from querymetrics import querymetrics
+from querycache import cachestats
+
+# this function renders the hidden diagnostics panel, it shows the query instrumentation of
+# this process per calling function and per statement, the query cache counters and the raw
+# prometheus text that METRICS_PORT and METRICS_FILE expose
+def renderdiagnostics():
+    st.header("Diagnostics")
+    snapshot = querymetrics.snapshot()
+    st.subheader("Queries by function")
+    if snapshot["functions"]:
+        st.dataframe(pd.DataFrame(snapshot["functions"]), use_container_width=True)
+    else:
+        st.info("No queries recorded yet.")
+    st.subheader("Slowest statements")
+    if snapshot["statements"]:
+        statements = pd.DataFrame(snapshot["statements"])
+        statements["avg_s"] = statements["seconds"] / statements["calls"]
+        st.dataframe(statements[["function", "fingerprint", "calls", "seconds", "avg_s", "max", "text"]].head(50),
+                     use_container_width=True)
+    st.subheader("Query cache")
+    stats = cachestats()
+    column1, column2 = st.columns(2)
+    with column1:
+        st.metric("Cached entries", stats["entries"])
+    with column2:
+        st.metric("Cache size (MB)", f"{stats['bytes'] / 1024 / 1024:.1f} / {stats['maxbytes'] / 1024 / 1024:.0f}")
+    if stats["functions"]:
+        st.dataframe(pd.DataFrame.from_dict(stats["functions"], orient="index"), use_container_width=True)
+    with st.expander("Prometheus metrics"):
+        st.code(querymetrics.render(), language="text")
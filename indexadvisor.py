@@ -0,0 +1,248 @@
+import re
+import sys
+import json
+import argparse
+from datetime import datetime, timedelta
+from db import get_cursor
+from migrations import MIGRATIONS, applymigrations, appliedmigrations
+from utils import getlogger
+
+logger = getlogger("indexadvisor")
+defaultdays = 30
+
+# the access patterns of the panel functions, every entry is the shape of the query a function
+# runs (its filters and groupings with representative parameters) and the indexes meant to
+# serve it. the advisor explains each one before and after creating those indexes
+ACCESSPATTERNS = [
+    {
+        "function": "temporalquery",
+        "pattern": "rollups of /g/ by hour range",
+        "indexes": ["post_rollup_hourly_pkey"],
+        "sql": """
+            SELECT date_trunc('day', bucket_hour), SUM(post_count) FROM post_rollup_hourly
+            WHERE platform = '4chan' AND community = 'g' AND bucket_hour >= %s AND bucket_hour < %s
+            GROUP BY 1
+        """,
+        "params": lambda start, end: (start, end),
+    },
+    {
+        "function": "temporalquery",
+        "pattern": "rollups of all of reddit by hour range",
+        "indexes": ["post_rollup_hourly_platform_bucket_idx"],
+        "sql": """
+            SELECT date_trunc('day', bucket_hour), SUM(post_count) FROM post_rollup_hourly
+            WHERE platform = 'Reddit' AND bucket_hour >= %s AND bucket_hour < %s
+            GROUP BY 1
+        """,
+        "params": lambda start, end: (start, end),
+    },
+    {
+        "function": "refreshrollups",
+        "pattern": "chan posts past the watermark",
+        "indexes": ["chan_posts_created_brin_idx"],
+        "sql": """
+            SELECT LOWER(board_name), date_trunc('hour', created_at), COUNT(*) FROM chan_posts
+            WHERE created_at >= %s GROUP BY 1, 2
+        """,
+        "params": lambda start, end: (end - timedelta(hours=2),),
+    },
+    {
+        "function": "refreshrollups",
+        "pattern": "reddit posts past the watermark",
+        "indexes": ["reddit_posts_created_brin_idx"],
+        "sql": """
+            SELECT subreddit_key, date_trunc('hour', created_at), COUNT(*) FROM reddit_posts
+            WHERE created_at >= %s GROUP BY 1, 2
+        """,
+        "params": lambda start, end: (end - timedelta(hours=2),),
+    },
+    {
+        "function": "gettoxicity",
+        "pattern": "boards by key and date range",
+        "indexes": ["chan_posts_board_key_created_idx"],
+        "sql": """
+            SELECT LOWER(board_name), AVG(toxicityscore) FROM chan_posts
+            WHERE LOWER(board_name) = ANY(%s) AND created_at BETWEEN %s AND %s GROUP BY 1
+        """,
+        "params": lambda start, end: (["g", "pol"], start, end),
+    },
+    {
+        "function": "gettoxicity",
+        "pattern": "subreddits by key and date range",
+        "indexes": ["reddit_posts_subreddit_key_created_idx"],
+        "sql": """
+            SELECT subreddit_key, AVG(toxicityscore) FROM reddit_posts
+            WHERE subreddit_key = ANY(%s) AND created_at BETWEEN %s AND %s GROUP BY 1
+        """,
+        "params": lambda start, end: (["technology", "politics"], start, end),
+    },
+    {
+        "function": "getaitopics",
+        "pattern": "chan topic match in date range",
+        "indexes": ["chan_posts_search_text_trgm_idx", "chan_posts_created_brin_idx"],
+        "sql": """
+            SELECT COUNT(*) FROM chan_posts
+            WHERE created_at BETWEEN %s AND %s AND search_text LIKE ANY(%s)
+        """,
+        "params": lambda start, end: (start, end, ["%chatgpt%", "%claude%"]),
+    },
+    {
+        "function": "getaitopics",
+        "pattern": "reddit topic match in date range",
+        "indexes": ["reddit_posts_search_text_trgm_idx", "reddit_posts_created_brin_idx"],
+        "sql": """
+            SELECT COUNT(*) FROM reddit_posts
+            WHERE created_at BETWEEN %s AND %s AND search_text LIKE ANY(%s)
+        """,
+        "params": lambda start, end: (start, end, ["%chatgpt%", "%claude%"]),
+    },
+    {
+        "function": "refreshprofiles",
+        "pattern": "reddit posts past the profile watermark",
+        "indexes": ["reddit_posts_created_brin_idx"],
+        "sql": """
+            SELECT subreddit_key, author_name, created_at::date, COUNT(*) FROM reddit_posts
+            WHERE created_at >= %s GROUP BY 1, 2, 3
+        """,
+        "params": lambda start, end: (end - timedelta(days=1),),
+    },
+    {
+        "function": "gettopauthors",
+        "pattern": "/g/ author profiles in day range",
+        "indexes": ["author_daily_profile_pkey"],
+        "sql": """
+            SELECT author_name, SUM(post_count) FROM author_daily_profile
+            WHERE platform = '4chan' AND community = 'g' AND day BETWEEN %s AND %s
+            GROUP BY author_name ORDER BY 2 DESC LIMIT 20
+        """,
+        "params": lambda start, end: (start.date(), end.date()),
+    },
+    {
+        "function": "gettopauthors",
+        "pattern": "reddit author profiles in day range",
+        "indexes": ["author_daily_profile_platform_day_idx"],
+        "sql": """
+            SELECT author_name, SUM(post_count) FROM author_daily_profile
+            WHERE platform = 'Reddit' AND day BETWEEN %s AND %s
+            GROUP BY author_name ORDER BY 2 DESC LIMIT 20
+        """,
+        "params": lambda start, end: (start.date(), end.date()),
+    },
+]
+
+# walks an EXPLAIN (FORMAT JSON) plan and collects the node types and index names it uses
+def plannodes(plan, nodes=None, indexes=None):
+    nodes = [] if nodes is None else nodes
+    indexes = set() if indexes is None else indexes
+    nodes.append(plan.get("Node Type"))
+    if plan.get("Index Name"):
+        indexes.add(plan["Index Name"])
+    for child in plan.get("Plans", []):
+        plannodes(child, nodes, indexes)
+    return nodes, indexes
+
+# this function explains every access pattern and returns its estimated total cost, the plan
+# node types and the indexes the planner picked. a pattern that can't be planned (for example
+# because a column from a pending migration is missing) is reported with its error
+def explainpatterns(start, end):
+    report = []
+    for pattern in ACCESSPATTERNS:
+        entry = {"function": pattern["function"], "pattern": pattern["pattern"], "expected": pattern["indexes"]}
+        try:
+            with get_cursor() as cur:
+                cur.execute("EXPLAIN (FORMAT JSON) " + pattern["sql"], pattern["params"](start, end))
+                plan = cur.fetchone()[0][0]["Plan"]
+            nodes, indexes = plannodes(plan)
+            entry.update({"cost": plan["Total Cost"], "nodes": nodes, "indexes": sorted(indexes)})
+        except Exception as e:
+            entry.update({"cost": None, "error": str(e).strip()})
+        report.append(entry)
+    return report
+
+def existingindexes():
+    with get_cursor() as cur:
+        cur.execute("""
+            SELECT indexname FROM pg_indexes
+            WHERE tablename IN ('chan_posts', 'reddit_posts', 'post_rollup_hourly', 'author_daily_profile');
+        """)
+        return {r[0] for r in cur.fetchall()}
+
+INDEXNAME = re.compile(r"CREATE INDEX IF NOT EXISTS (\w+)", re.IGNORECASE)
+# statements the advisor never runs on its own, they rewrite the post tables or change what
+# happens on every insert and belong to a planned run of migrations.py
+REWRITES = re.compile(r"\b(ALTER TABLE|CREATE TRIGGER|CREATE EXTENSION)\b", re.IGNORECASE)
+
+# this function picks the pending migrations that create one of the missing indexes, those
+# that only add indexes and tables can be applied here while the ones that also rewrite a
+# table are returned separately to be run by hand
+def indexmigrations(missing, done):
+    applicable, manual = [], []
+    for migration in MIGRATIONS:
+        if migration["name"] in done:
+            continue
+        creates = {name for statement in migration["statements"] for name in INDEXNAME.findall(statement)}
+        if not creates & set(missing):
+            continue
+        if any(REWRITES.search(statement) for statement in migration["statements"]):
+            manual.append(migration["name"])
+        else:
+            applicable.append(migration["name"])
+    return applicable, manual
+
+# this function runs the advisor, it explains every pattern, applies the pending migrations that
+# create the recommended indexes when apply is set and explains again so each pattern gets its
+# before and after cost. the migrations are idempotent so running the advisor twice is safe
+def advise(start=None, end=None, apply=False):
+    end = end or datetime.utcnow()
+    start = start or end - timedelta(days=defaultdays)
+    before = explainpatterns(start, end)
+    present = existingindexes()
+    missing = sorted({name for pattern in ACCESSPATTERNS for name in pattern["indexes"]} - present)
+    applicable, manual = indexmigrations(missing, appliedmigrations())
+    applied = []
+    if apply and applicable:
+        applied = applymigrations(applicable)
+    after = explainpatterns(start, end) if applied else before
+    patterns = []
+    for b, a in zip(before, after):
+        patterns.append({
+            "function": b["function"],
+            "pattern": b["pattern"],
+            "expected_indexes": b["expected"],
+            "before_cost": b.get("cost"),
+            "after_cost": a.get("cost"),
+            "before_indexes": b.get("indexes", []),
+            "after_indexes": a.get("indexes", []),
+            "error": a.get("error") or b.get("error"),
+        })
+    return {"start": start.isoformat(), "end": end.isoformat(), "missing_indexes": missing,
+            "applied_migrations": applied, "manual_migrations": manual, "patterns": patterns}
+
+def formatcost(cost):
+    return "-" if cost is None else f"{cost:,.0f}"
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="explain the panel queries and create the indexes they need")
+    parser.add_argument("--apply", action="store_true", help="apply the pending migrations that only add the missing indexes and explain again")
+    parser.add_argument("--days", type=int, default=defaultdays, help="width of the date range the queries are explained for")
+    parser.add_argument("--json", help="also write the report to this file")
+    args = parser.parse_args()
+    try:
+        end = datetime.utcnow()
+        report = advise(start=end - timedelta(days=args.days), end=end, apply=args.apply)
+    except Exception as e:
+        logger.error(f"index advisor failed: {e}")
+        sys.exit(1)
+    if report["missing_indexes"]:
+        print("missing indexes: " + ", ".join(report["missing_indexes"]))
+    for name in report["applied_migrations"]:
+        print(f"applied migration {name}")
+    for name in report["manual_migrations"]:
+        print(f"migration {name} rewrites tables, apply it with migrations.py {name}")
+    print(f"{'function':<20} {'pattern':<42} {'before':>14} {'after':>14}  indexes")
+    for p in report["patterns"]:
+        used = ", ".join(p["after_indexes"]) or (p["error"] or "sequential scan").splitlines()[0]
+        print(f"{p['function']:<20} {p['pattern']:<42} {formatcost(p['before_cost']):>14} {formatcost(p['after_cost']):>14}  {used}")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
@@ -0,0 +1,230 @@
+import os
+import sys
+import time
+import argparse
+import select
+import threading
+from datetime import datetime, timedelta
+import psycopg2
+from db import DATABASE_URL, get_cursor
+from utils import getlogger
+
+logger = getlogger("livetail")
+# how often the live charts redraw, every redraw folds in the posts since the last one
+refreshseconds = int(os.getenv("LIVE_TAIL_REFRESH_SECONDS", "10"))
+# poll queries for new posts on every redraw, notify only queries after an insert trigger
+# announced new posts and falls back to polling while the listener isn't connected. the
+# triggers are only installed in notify mode so other deployments keep a plain insert path
+livemode = os.getenv("LIVE_TAIL_MODE", "poll")
+# the buckets of this many seconds before the watermark are re-aggregated on every fold so posts
+# the crawlers insert with a slightly older created_at still land in their bucket
+lookbackseconds = int(os.getenv("LIVE_TAIL_LOOKBACK_SECONDS", "120"))
+# sessions showing the same live view share one aggregate, it is folded at most this often and
+# dropped after idleseconds without a viewer
+minfoldseconds = float(os.getenv("LIVE_TAIL_MIN_FOLD_SECONDS", "2"))
+idleseconds = 600
+# the live windows the panels offer, in hours
+LIVEWINDOWS = [1, 6, 24]
+CHANNEL = "new_posts"
+
+# statement level insert triggers on both post tables that announce new posts on the new_posts
+# channel with the table name as payload, a batch insert of the crawlers sends one notification.
+# they change the crawlers' insert path and need the owner of the tables so the dashboard never
+# creates them, python livetail.py install adds them and python livetail.py uninstall removes them
+NOTIFYTRIGGERS = ["chan_posts_notify_new_posts", "reddit_posts_notify_new_posts"]
+NOTIFYSCHEMA = f"""
+    CREATE OR REPLACE FUNCTION notify_new_posts() RETURNS trigger AS $$
+    BEGIN
+        PERFORM pg_notify('{CHANNEL}', TG_TABLE_NAME);
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql;
+    DROP TRIGGER IF EXISTS chan_posts_notify_new_posts ON chan_posts;
+    CREATE TRIGGER chan_posts_notify_new_posts AFTER INSERT ON chan_posts
+        FOR EACH STATEMENT EXECUTE FUNCTION notify_new_posts();
+    DROP TRIGGER IF EXISTS reddit_posts_notify_new_posts ON reddit_posts;
+    CREATE TRIGGER reddit_posts_notify_new_posts AFTER INSERT ON reddit_posts
+        FOR EACH STATEMENT EXECUTE FUNCTION notify_new_posts();
+"""
+DROPNOTIFYSCHEMA = """
+    DROP TRIGGER IF EXISTS chan_posts_notify_new_posts ON chan_posts;
+    DROP TRIGGER IF EXISTS reddit_posts_notify_new_posts ON reddit_posts;
+    DROP FUNCTION IF EXISTS notify_new_posts();
+"""
+
+def notifytriggersinstalled(cur):
+    cur.execute("SELECT COUNT(*) FROM pg_trigger WHERE tgname = ANY(%s);", (NOTIFYTRIGGERS,))
+    return cur.fetchone()[0] == len(NOTIFYTRIGGERS)
+
+# start of the date_trunc bucket a timestamp falls in, weeks start on monday like in postgres
+def floorbucket(value, bucket):
+    if bucket == "minute":
+        return value.replace(second=0, microsecond=0)
+    if bucket == "hour":
+        return value.replace(minute=0, second=0, microsecond=0)
+    day = value.replace(hour=0, minute=0, second=0, microsecond=0)
+    return day - timedelta(days=day.weekday()) if bucket == "week" else day
+
+# this class listens on the new_posts channel on its own connection, LISTEN needs a session
+# that stays open so it doesn't use the pool. version goes up with every notification and the
+# live series compare it with the version of their last fold. a dropped connection is retried
+# every few seconds, connected tells the series whether they can rely on the notifications.
+# without the triggers nothing is ever announced, the listener then stays disconnected so the
+# series keep polling and it checks again every missingretry seconds
+class PostListener:
+    missingretry = 300
+
+    def __init__(self, dsn):
+        self.dsn = dsn
+        self.version = 0
+        self.connected = False
+        self.thread = threading.Thread(target=self.run, name="livetail-listener", daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while True:
+            conn = None
+            retry = 5
+            try:
+                conn = psycopg2.connect(self.dsn)
+                conn.autocommit = True
+                with conn.cursor() as cur:
+                    installed = notifytriggersinstalled(cur)
+                if installed:
+                    self.listen(conn)
+                else:
+                    logger.error("the new post notification triggers are missing, polling until "
+                                 "they are installed with python livetail.py install")
+                    retry = self.missingretry
+            except Exception as e:
+                logger.error(f"new post listener failed, polling until it reconnects: {e}")
+            finally:
+                self.connected = False
+                if conn is not None:
+                    try:
+                        conn.close()
+                    except Exception:
+                        pass
+            time.sleep(retry)
+
+    def listen(self, conn):
+        with conn.cursor() as cur:
+            cur.execute(f"LISTEN {CHANNEL};")
+        self.connected = True
+        # anything inserted while the listener was away counts as new
+        self.version += 1
+        logger.info(f"listening for new posts on {CHANNEL}")
+        while True:
+            if select.select([conn], [], [], 30) == ([], [], []):
+                continue
+            conn.poll()
+            if conn.notifies:
+                conn.notifies.clear()
+                self.version += 1
+
+listener = None
+listenerlock = threading.Lock()
+
+def getlistener():
+    global listener
+    if livemode != "notify":
+        return None
+    with listenerlock:
+        if listener is None:
+            listener = PostListener(DATABASE_URL)
+    return listener
+
+# this class keeps the bucketed points of a sliding window in memory. the first fold queries the
+# whole window, every later one only the buckets from the watermark (the end of the last fold)
+# minus the lookback, those buckets are replaced and the ones that slid out of the window are
+# dropped. fetch(start, end) returns {key: points} with every point carrying its bucket as t,
+# the same shape temporal.rawbuckets and aitopicanalysis.topicpoints return
+class LiveSeries:
+    def __init__(self, keys, bucket, window, fetch):
+        self.keys = list(keys)
+        self.bucket = bucket
+        self.window = window
+        self.fetch = fetch
+        self.points = {key: {} for key in self.keys}
+        self.watermark = None
+        self.version = None
+        self.lastfold = 0.0
+        self.lastused = time.monotonic()
+        self.folding = False
+        self.lock = threading.Lock()
+
+    # folds in the new posts and returns True when it queried. with a connected notify listener
+    # the query is skipped until a notification came in, the window still slides. the query runs
+    # outside the lock so sessions reading the view meanwhile get the points of the last fold,
+    # and a session arriving while another one folds doesn't query again
+    def fold(self):
+        end = datetime.utcnow()
+        start = floorbucket(end - self.window, self.bucket)
+        since = None
+        with self.lock:
+            self.lastused = time.monotonic()
+            if not self.folding and time.monotonic() - self.lastfold >= minfoldseconds:
+                postlistener = getlistener()
+                version = postlistener.version if postlistener is not None else None
+                stale = postlistener is None or not postlistener.connected or version != self.version
+                if self.watermark is None or stale:
+                    since = start
+                    if self.watermark is not None:
+                        since = max(start, floorbucket(self.watermark - timedelta(seconds=lookbackseconds), self.bucket))
+                    self.folding = True
+        if since is not None:
+            try:
+                fetched = self.fetch(since, end)
+            except Exception:
+                with self.lock:
+                    self.folding = False
+                raise
+            with self.lock:
+                for key in self.keys:
+                    series = self.points[key]
+                    for t in [t for t in series if t >= since]:
+                        del series[t]
+                    for point in fetched.get(key, []):
+                        series[point["t"]] = point
+                self.watermark, self.version, self.folding = end, version, False
+                self.lastfold = time.monotonic()
+        with self.lock:
+            for series in self.points.values():
+                for t in [t for t in series if t < start]:
+                    del series[t]
+        return since is not None
+
+    def series(self, key):
+        with self.lock:
+            return [self.points[key][t] for t in sorted(self.points[key])]
+
+registry = {}
+registrylock = threading.Lock()
+
+# this function returns the live series of a view, shared by every session that shows the same
+# name and arguments. views nobody looked at for idleseconds are dropped
+def liveseries(name, arguments, keys, bucket, window, fetch):
+    key = (name, repr(arguments), bucket, window)
+    now = time.monotonic()
+    with registrylock:
+        for stale in [k for k, series in registry.items() if now - series.lastused > idleseconds]:
+            del registry[stale]
+        if key not in registry:
+            registry[key] = LiveSeries(keys, bucket, window, fetch)
+        return registry[key]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="manage the new post notification triggers of LIVE_TAIL_MODE=notify")
+    parser.add_argument("action", choices=["install", "uninstall"])
+    args = parser.parse_args()
+    try:
+        with get_cursor(commit=True) as cur:
+            if args.action == "install":
+                cur.execute(NOTIFYSCHEMA)
+                logger.info("installed the new post notification triggers")
+            else:
+                cur.execute(DROPNOTIFYSCHEMA)
+                logger.info("removed the new post notification triggers")
+    except Exception as e:
+        logger.error(f"could not {args.action} the notification triggers: {e}")
+        sys.exit(1)
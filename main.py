@@ -1,16 +1,41 @@
+import time
+scriptstart = time.perf_counter()
+import os
+import sys
+import importlib
 import streamlit as st
 from datetime import datetime, timedelta
-from temporal import rendertemporal
-from toxicityovertime import rendertoxicity
-from aitopicanalysis import renderaitopic
+from utils import getlogger
+from approximate import QUERYMODES
 
+logger = getlogger("main")
 defaultdays = 30
+# the panels and the module and function that render them, only the module of the selected
+# panel is imported so a cold start doesn't pay for plotly, the caches and the database layer
+# of panels nobody opened. streamlit keeps imported modules between reruns so each module is
+# imported once per process
+PANELS = {
+    "Temporal Activity": ("temporal", "rendertemporal"),
+    "Toxicity Over Time": ("toxicityovertime", "rendertoxicity"),
+    "AI Topic Toxicity": ("aitopicanalysis", "renderaitopic"),
+    "Diagnostics": ("diagnostics", "renderdiagnostics"),
+}
+# the panels that scan the post tables and can answer from a sample first, the temporal panel
+# reads the hourly rollups and is always exact
+SAMPLEDPANELS = {"Toxicity Over Time", "AI Topic Toxicity"}
+importseconds = time.perf_counter() - scriptstart
 st.set_page_config(page_title="Dashboard", layout="wide")
 # this is the sidebar
 st.sidebar.title("Dashboard")
+panels = ["Temporal Activity", "Toxicity Over Time", "AI Topic Toxicity"]
+# the diagnostics panel is hidden unless DASHBOARD_DIAGNOSTICS=1 or the url has ?diagnostics=1
+if os.getenv("DASHBOARD_DIAGNOSTICS") == "1" or st.query_params.get("diagnostics") == "1":
+    panels.append("Diagnostics")
+# startup timing is shown with DASHBOARD_STARTUP_TIMING=1 or ?timing=1
+showtiming = os.getenv("DASHBOARD_STARTUP_TIMING") == "1" or st.query_params.get("timing") == "1"
 panel = st.sidebar.selectbox(
     "Choose panel",
-    ["Temporal Activity", "Toxicity Over Time", "AI Topic Toxicity"]
+    panels
 )
 #filters to choose the sart date adn end date
 startdate = st.sidebar.date_input(
@@ -18,11 +43,34 @@ startdate = st.sidebar.date_input(
     datetime.utcnow() - timedelta(days=defaultdays)
 )
 enddate = st.sidebar.date_input("End date", datetime.utcnow())
+# exact waits for the full queries, approximate answers from a sample of the tables and
+# progressive shows the sampled answer first and refines it to the exact one
+querymode = "exact"
+if panel in SAMPLEDPANELS:
+    querymode = st.sidebar.radio("Query mode", QUERYMODES, index=0, horizontal=True)
 # all side panels for the interactivity
-if panel == "Temporal Activity":
-    rendertemporal(startdate=startdate, enddate=enddate)
-elif panel == "Toxicity Over Time":
-    rendertoxicity(startdate=startdate, enddate=enddate)
-elif panel == "AI Topic Toxicity":
-    renderaitopic(startdate, enddate)
-    
\ No newline at end of file
+modulename, functionname = PANELS[panel]
+coldimport = modulename not in sys.modules
+importstart = time.perf_counter()
+render = getattr(importlib.import_module(modulename), functionname)
+panelimportseconds = time.perf_counter() - importstart
+renderstart = time.perf_counter()
+if panel == "Diagnostics":
+    render()
+elif panel in SAMPLEDPANELS:
+    render(startdate=startdate, enddate=enddate, querymode=querymode)
+else:
+    render(startdate=startdate, enddate=enddate)
+# this is the startup timing, how long this run spent importing the dashboard itself, importing
+# the panel module (only a cold import of a panel costs anything) and rendering. the first run
+# of a process is the cold start, later runs show the rerun overhead
+if showtiming:
+    renderseconds = time.perf_counter() - renderstart
+    totalseconds = time.perf_counter() - scriptstart
+    logger.info(f"run of {panel}: imports {importseconds:.3f}s, panel import {panelimportseconds:.3f}s "
+                f"({'cold' if coldimport else 'cached'}), render {renderseconds:.3f}s, total {totalseconds:.3f}s")
+    with st.sidebar.expander("Startup timing", expanded=True):
+        st.write(f"Dashboard imports: {importseconds * 1000:.0f} ms")
+        st.write(f"Panel import: {panelimportseconds * 1000:.0f} ms ({'cold' if coldimport else 'already loaded'})")
+        st.write(f"Render: {renderseconds * 1000:.0f} ms")
+        st.write(f"Total: {totalseconds * 1000:.0f} ms")
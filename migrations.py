@@ -0,0 +1,129 @@
+import sys
+import argparse
+from db import get_cursor
+from rollups import REDDITCOMMUNITYKEY, ROLLUPSCHEMA
+from authorprofiles import PROFILESCHEMA
+from utils import getlogger
+
+logger = getlogger("migrations")
+
+# schema changes the dashboard relies on, applied in order and recorded in schema_migrations
+# so running them again is a no-op. the statements are idempotent on their own as well so a
+# half applied migration can simply be rerun. adding a stored generated column rewrites the
+# table under an exclusive lock, run these at a quiet time on the big post tables
+MIGRATIONS = [
+    {
+        # lower cased text the ai topic panel searches in, with trigram gin indexes so the
+        # '%topic%' patterns don't need a full scan. the reddit fields are joined with a newline
+        # so a topic can't match across the end of the body and the start of the title
+        "name": "0001_topic_search_text",
+        "statements": [
+            "CREATE EXTENSION IF NOT EXISTS pg_trgm;",
+            """ALTER TABLE chan_posts ADD COLUMN IF NOT EXISTS search_text TEXT
+                   GENERATED ALWAYS AS (lower(COALESCE(content, ''))) STORED;""",
+            "CREATE INDEX IF NOT EXISTS chan_posts_search_text_trgm_idx ON chan_posts USING gin (search_text gin_trgm_ops);",
+            """ALTER TABLE reddit_posts ADD COLUMN IF NOT EXISTS search_text TEXT
+                   GENERATED ALWAYS AS (lower(
+                       COALESCE(data->>'body', '') || E'\\n' ||
+                       COALESCE(data->>'title', '') || E'\\n' ||
+                       COALESCE(data->>'selftext', ''))) STORED;""",
+            "CREATE INDEX IF NOT EXISTS reddit_posts_search_text_trgm_idx ON reddit_posts USING gin (search_text gin_trgm_ops);",
+        ],
+    },
+    {
+        # community lookups by normalized key. chan_posts gets an expression index on the lower
+        # cased board name, the same key the rollups and the catalog use, so the board names the
+        # crawlers store are left as they are. reddit's key is indexed by 0003 on its typed column
+        "name": "0002_community_keys",
+        "statements": [
+            "CREATE INDEX IF NOT EXISTS chan_posts_board_key_created_idx ON chan_posts (LOWER(board_name), created_at);",
+        ],
+    },
+    {
+        # typed copies of the reddit json fields the panels read on every scan so they stop
+        # detoasting data per row. text_length keeps the length of the plain concatenation the
+        # panels always used, the text itself is already stored by 0001 as search_text
+        "name": "0003_reddit_typed_columns",
+        "statements": [
+            f"""ALTER TABLE reddit_posts
+                   ADD COLUMN IF NOT EXISTS subreddit_key TEXT GENERATED ALWAYS AS ({REDDITCOMMUNITYKEY}) STORED,
+                   ADD COLUMN IF NOT EXISTS author_name TEXT GENERATED ALWAYS AS (data->>'author') STORED,
+                   ADD COLUMN IF NOT EXISTS text_length INTEGER GENERATED ALWAYS AS (LENGTH(
+                       COALESCE(data->>'body', '') ||
+                       COALESCE(data->>'title', '') ||
+                       COALESCE(data->>'selftext', ''))) STORED;""",
+            "CREATE INDEX IF NOT EXISTS reddit_posts_subreddit_key_created_idx ON reddit_posts (subreddit_key, created_at);",
+            "CREATE INDEX IF NOT EXISTS reddit_posts_author_created_idx ON reddit_posts (author_name, created_at);",
+        ],
+    },
+    {
+        # indexes for the access patterns recorded in indexadvisor.py. the post tables are
+        # appended in created_at order so a tiny brin index covers every plain date range scan,
+        # and the reddit scope of the rollups filters on platform and hour without a community
+        "name": "0004_panel_indexes",
+        "statements": [
+            ROLLUPSCHEMA,
+            "CREATE INDEX IF NOT EXISTS chan_posts_created_brin_idx ON chan_posts USING brin (created_at);",
+            "CREATE INDEX IF NOT EXISTS reddit_posts_created_brin_idx ON reddit_posts USING brin (created_at);",
+            "CREATE INDEX IF NOT EXISTS post_rollup_hourly_platform_bucket_idx ON post_rollup_hourly (platform, bucket_hour);",
+            "ANALYZE chan_posts;",
+            "ANALYZE reddit_posts;",
+            "ANALYZE post_rollup_hourly;",
+        ],
+    },
+    {
+        # the per author daily profiles the author panels read, filled by authorprofiles.py
+        "name": "0005_author_daily_profile",
+        "statements": [
+            PROFILESCHEMA,
+        ],
+    },
+]
+
+def ensuremigrationtable(cur):
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            name TEXT PRIMARY KEY,
+            applied_at TIMESTAMP NOT NULL DEFAULT now()
+        );
+    """)
+
+def appliedmigrations():
+    with get_cursor(commit=True) as cur:
+        ensuremigrationtable(cur)
+        cur.execute("SELECT name FROM schema_migrations;")
+        return {r[0] for r in cur.fetchall()}
+
+# this function applies every pending migration in its own transaction, names limits the run
+# to some of them. it returns the names that were applied
+def applymigrations(names=None):
+    done = appliedmigrations()
+    applied = []
+    for migration in MIGRATIONS:
+        if migration["name"] in done or (names and migration["name"] not in names):
+            continue
+        logger.info(f"applying migration {migration['name']}")
+        with get_cursor(commit=True) as cur:
+            for statement in migration["statements"]:
+                cur.execute(statement)
+            cur.execute("INSERT INTO schema_migrations (name) VALUES (%s) ON CONFLICT DO NOTHING;", (migration["name"],))
+        applied.append(migration["name"])
+    if not applied:
+        logger.info("schema is up to date")
+    return applied
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="apply the dashboard schema migrations")
+    parser.add_argument("names", nargs="*", help="only apply these migrations")
+    parser.add_argument("--list", action="store_true", help="show the migrations and whether they are applied")
+    args = parser.parse_args()
+    try:
+        if args.list:
+            done = appliedmigrations()
+            for migration in MIGRATIONS:
+                print(f"{'applied' if migration['name'] in done else 'pending'}  {migration['name']}")
+        else:
+            applymigrations(args.names or None)
+    except Exception as e:
+        logger.error(f"migration failed: {e}")
+        sys.exit(1)
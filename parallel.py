@@ -0,0 +1,29 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from utils import getlogger
+
+logger = getlogger("parallel")
+# one executor for the whole process sized like the connection pool, more threads would only
+# queue up inside get_cursor waiting for a connection. its threads start on the first submit
+maxworkers = int(os.getenv("DB_MAX_CONN") or "10")
+executor = ThreadPoolExecutor(max_workers=maxworkers, thread_name_prefix="panelquery")
+
+# this function runs independent query functions concurrently and returns their results by
+# name once all of them are done, so a panel waits for its slowest query instead of the sum of
+# all of them. the first failing task re-raises its error here. the tasks only query the
+# database, anything that draws with streamlit has to stay on the script thread. a task that
+# calls runparallel itself gets its subtasks run inline, waiting on the same executor from one
+# of its threads could deadlock once every worker is waiting
+def runparallel(tasks):
+    if len(tasks) <= 1 or threading.current_thread().name.startswith("panelquery"):
+        return {name: task() for name, task in tasks.items()}
+    futures = {name: executor.submit(task) for name, task in tasks.items()}
+    results = {}
+    for name, future in futures.items():
+        try:
+            results[name] = future.result()
+        except Exception as e:
+            logger.error(f"panel query {name} failed: {e}")
+            raise
+    return results
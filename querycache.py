@@ -0,0 +1,174 @@
+import os
+import sys
+import copy
+import time
+import inspect
+import threading
+import functools
+from collections import OrderedDict
+from datetime import date, datetime
+import pandas as pd
+from utils import getlogger
+
+logger = getlogger("querycache")
+# upper bound for the estimated size of all cached results, the least recently used entries
+# are evicted once it is exceeded
+maxbytes = int(float(os.getenv("QUERY_CACHE_MAX_MB", "256")) * 1024 * 1024)
+cachedisabled = os.getenv("QUERY_CACHE_DISABLED", "0") == "1"
+
+# this function turns call arguments into something hashable and stable, lists keep their
+# order because the panels render communities and topics in the order they were picked
+def normalizevalue(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    if isinstance(value, str):
+        return value.strip()
+    if isinstance(value, (list, tuple)):
+        return tuple(normalizevalue(v) for v in value)
+    if isinstance(value, (set, frozenset)):
+        return tuple(sorted(normalizevalue(v) for v in value))
+    if isinstance(value, dict):
+        return tuple(sorted((k, normalizevalue(v)) for k, v in value.items()))
+    return value
+
+# rough size of a cached result, good enough to keep the cache inside its memory budget
+def estimatesize(value):
+    if isinstance(value, pd.DataFrame):
+        return int(value.memory_usage(deep=True).sum())
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum(estimatesize(k) + estimatesize(v) for k, v in value.items())
+    if isinstance(value, (list, tuple, set)):
+        return sys.getsizeof(value) + sum(estimatesize(v) for v in value)
+    return sys.getsizeof(value)
+
+# one cache for the whole process, streamlit runs every session in the same process so all
+# analysts looking at the same range share the entries. entries are stored as private copies
+# and every hit hands out a fresh copy so a panel mutating its dataframe can't corrupt the cache
+class QueryCache:
+    def __init__(self, maxbytes):
+        self.maxbytes = maxbytes
+        self.entries = OrderedDict()
+        self.totalbytes = 0
+        self.lock = threading.Lock()
+        self.inflight = {}
+        self.stats = {}
+
+    def functionstats(self, name):
+        return self.stats.setdefault(name, {"hits": 0, "misses": 0, "evictions": 0})
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return False, None
+            value, size, expires = entry
+            if expires < time.monotonic():
+                del self.entries[key]
+                self.totalbytes -= size
+                return False, None
+            self.entries.move_to_end(key)
+            return True, value
+
+    def put(self, key, value, ttl):
+        size = estimatesize(value)
+        if size > self.maxbytes:
+            logger.debug(f"result for {key[0]} is {size} bytes, too large to cache")
+            return
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.totalbytes -= old[1]
+            self.entries[key] = (value, size, time.monotonic() + ttl)
+            self.totalbytes += size
+            while self.totalbytes > self.maxbytes and self.entries:
+                evictedkey, (_, evictedsize, _) = self.entries.popitem(last=False)
+                self.totalbytes -= evictedsize
+                self.functionstats(evictedkey[0])["evictions"] += 1
+
+    # returns the cached value or computes it, concurrent callers asking for the same key
+    # wait for the first one instead of running the same query in parallel
+    def getorcompute(self, key, ttl, compute):
+        name = key[0]
+        while True:
+            found, value = self.get(key)
+            if found:
+                with self.lock:
+                    self.functionstats(name)["hits"] += 1
+                return copy.deepcopy(value)
+            with self.lock:
+                waiter = self.inflight.get(key)
+                if waiter is None:
+                    waiter = threading.Event()
+                    self.inflight[key] = waiter
+                    self.functionstats(name)["misses"] += 1
+                    break
+            waiter.wait()
+        try:
+            value = compute()
+            self.put(key, copy.deepcopy(value), ttl)
+            return value
+        finally:
+            with self.lock:
+                self.inflight.pop(key, None)
+            waiter.set()
+
+    def discard(self, key):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None:
+                self.totalbytes -= entry[1]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.totalbytes = 0
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "entries": len(self.entries),
+                "bytes": self.totalbytes,
+                "maxbytes": self.maxbytes,
+                "functions": copy.deepcopy(self.stats),
+            }
+
+querycache = QueryCache(maxbytes)
+
+# decorator for the panel query functions, the key is the function name plus its bound and
+# normalized arguments so positional and keyword calls share entries. calls that pass any
+# of bypassargs (like a precomputed result) skip the cache
+def cached(ttl, bypassargs=()):
+    def decorator(func):
+        signature = inspect.signature(func)
+        def cachekey(args, kwargs):
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            if cachedisabled or any(bound.arguments.get(name) is not None for name in bypassargs):
+                return None
+            return (func.__qualname__,) + tuple((name, normalizevalue(value)) for name, value in bound.arguments.items())
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            key = cachekey(args, kwargs)
+            if key is None:
+                return func(*args, **kwargs)
+            return querycache.getorcompute(key, ttl, lambda: func(*args, **kwargs))
+        # true when a call with these arguments would be answered from the cache right now
+        def iscached(*args, **kwargs):
+            key = cachekey(args, kwargs)
+            return key is not None and querycache.get(key)[0]
+        # drops the entry of a call with these arguments so the next call queries again
+        def invalidate(*args, **kwargs):
+            key = cachekey(args, kwargs)
+            if key is not None:
+                querycache.discard(key)
+        wrapper.uncached = func
+        wrapper.iscached = iscached
+        wrapper.invalidate = invalidate
+        return wrapper
+    return decorator
+
+def cachestats():
+    return querycache.snapshot()
+
+def clearcache():
+    querycache.clear()
@@ -0,0 +1,253 @@
+import os
+import re
+import sys
+import time
+import hashlib
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import psycopg2.extensions
+from utils import getlogger
+
+logger = getlogger("querymetrics")
+# prometheus style histogram bounds, seconds for the timings and rows for the fetch sizes
+SECONDBUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+ROWBUCKETS = (1, 10, 100, 1000, 10000, 100000, 1000000)
+# the metrics are written to this file every few seconds when it is set
+metricsfile = os.getenv("METRICS_FILE")
+metricsfileinterval = float(os.getenv("METRICS_FILE_INTERVAL", "10"))
+# the metrics endpoint shows query fingerprints and callers, it listens on localhost unless
+# METRICS_HOST is set (e.g. 0.0.0.0 for a prometheus on another machine)
+metricshost = os.getenv("METRICS_HOST", "127.0.0.1")
+repodir = os.path.dirname(os.path.abspath(__file__))
+# frames in these modules are plumbing, the query is attributed to the first frame outside them
+PLUMBINGFILES = {"db.py", "querymetrics.py", "querycache.py", "bucketcache.py"}
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+
+    def cumulative(self):
+        total, result = 0, []
+        for n in self.counts:
+            total += n
+            result.append(total)
+        return result
+
+    # estimates a quantile from the buckets, good enough for a diagnostics table
+    def quantile(self, q):
+        if not self.count:
+            return None
+        target = q * self.count
+        for bound, seen in zip(self.buckets, self.cumulative()):
+            if seen >= target:
+                return bound
+        return float("inf")
+
+# this function returns the name of the dashboard function that asked for the cursor, the
+# first frame from a file of this repo that isn't plumbing. nested helpers and lambdas are
+# attributed to the function they are defined in
+def callername():
+    frame = sys._getframe(1)
+    while frame is not None:
+        filename = frame.f_code.co_filename
+        if filename.startswith(repodir) and os.path.basename(filename) not in PLUMBINGFILES:
+            code = frame.f_code
+            return getattr(code, "co_qualname", code.co_name).split(".")[0]
+        frame = frame.f_back
+    return "unknown"
+
+# normalized statement text and a short hash of it, literals and numbers are replaced so the
+# same query with different interpolated values shares a fingerprint
+def fingerprint(query):
+    if isinstance(query, bytes):
+        query = query.decode("utf-8", "replace")
+    text = re.sub(r"'(?:[^']|'')*'", "?", str(query))
+    text = re.sub(r"\b\d+(\.\d+)?\b", "?", text)
+    text = re.sub(r"\s+", " ", text).strip()
+    return hashlib.md5(text.encode()).hexdigest()[:12], text
+
+class QueryMetrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.functions = {}
+        self.statements = {}
+        self.lastwrite = 0.0
+
+    def function(self, name):
+        metrics = self.functions.get(name)
+        if metrics is None:
+            metrics = {"pool_wait": Histogram(SECONDBUCKETS), "execute": Histogram(SECONDBUCKETS),
+                       "fetch": Histogram(SECONDBUCKETS), "rows": Histogram(ROWBUCKETS)}
+            self.functions[name] = metrics
+        return metrics
+
+    def observe(self, kind, caller, value):
+        with self.lock:
+            self.function(caller)[kind].observe(value)
+
+    def observestatement(self, caller, query, seconds):
+        key, text = fingerprint(query)
+        with self.lock:
+            self.function(caller)["execute"].observe(seconds)
+            statement = self.statements.get((caller, key))
+            if statement is None:
+                statement = {"function": caller, "fingerprint": key, "text": text[:500], "calls": 0, "seconds": 0.0, "max": 0.0}
+                self.statements[(caller, key)] = statement
+            statement["calls"] += 1
+            statement["seconds"] += seconds
+            statement["max"] = max(statement["max"], seconds)
+
+    def snapshot(self):
+        with self.lock:
+            functions = []
+            for name, metrics in sorted(self.functions.items()):
+                functions.append({
+                    "function": name,
+                    "queries": metrics["execute"].count,
+                    "execute_total_s": round(metrics["execute"].sum, 3),
+                    "execute_p95_s": metrics["execute"].quantile(0.95),
+                    "fetch_total_s": round(metrics["fetch"].sum, 3),
+                    "pool_wait_total_s": round(metrics["pool_wait"].sum, 3),
+                    "pool_wait_p95_s": metrics["pool_wait"].quantile(0.95),
+                    "rows_fetched": int(metrics["rows"].sum),
+                })
+            statements = sorted((dict(s) for s in self.statements.values()), key=lambda s: s["seconds"], reverse=True)
+        return {"functions": functions, "statements": statements}
+
+    # prometheus text exposition of every histogram and statement counter
+    def render(self):
+        lines = []
+        names = {
+            "pool_wait": ("dashboard_pool_wait_seconds", "time spent waiting for a pooled connection"),
+            "execute": ("dashboard_query_execute_seconds", "time spent in cursor.execute"),
+            "fetch": ("dashboard_query_fetch_seconds", "time spent fetching results"),
+            "rows": ("dashboard_query_rows", "rows returned per fetch call"),
+        }
+        with self.lock:
+            for kind, (metric, description) in names.items():
+                lines.append(f"# HELP {metric} {description}")
+                lines.append(f"# TYPE {metric} histogram")
+                for name, metrics in sorted(self.functions.items()):
+                    histogram = metrics[kind]
+                    label = f'function="{escapelabel(name)}"'
+                    for bound, seen in zip(histogram.buckets, histogram.cumulative()):
+                        lines.append(f'{metric}_bucket{{{label},le="{bound}"}} {seen}')
+                    lines.append(f'{metric}_bucket{{{label},le="+Inf"}} {histogram.count}')
+                    lines.append(f"{metric}_sum{{{label}}} {histogram.sum}")
+                    lines.append(f"{metric}_count{{{label}}} {histogram.count}")
+            lines.append("# HELP dashboard_statement_calls_total executions per statement fingerprint")
+            lines.append("# TYPE dashboard_statement_calls_total counter")
+            for s in self.statements.values():
+                lines.append(f'dashboard_statement_calls_total{{function="{escapelabel(s["function"])}",fingerprint="{s["fingerprint"]}"}} {s["calls"]}')
+            lines.append("# HELP dashboard_statement_seconds_total execute time per statement fingerprint")
+            lines.append("# TYPE dashboard_statement_seconds_total counter")
+            for s in self.statements.values():
+                lines.append(f'dashboard_statement_seconds_total{{function="{escapelabel(s["function"])}",fingerprint="{s["fingerprint"]}"}} {s["seconds"]}')
+        return "\n".join(lines) + "\n"
+
+    # writes the exposition to METRICS_FILE at most every few seconds, through a temporary file
+    # so a scraper never reads half a file
+    def maybewrite(self):
+        if not metricsfile or time.monotonic() - self.lastwrite < metricsfileinterval:
+            return
+        self.lastwrite = time.monotonic()
+        try:
+            tmp = metricsfile + ".tmp"
+            with open(tmp, "w") as f:
+                f.write(self.render())
+            os.replace(tmp, metricsfile)
+        except OSError as e:
+            logger.warning(f"could not write metrics to {metricsfile}: {e}")
+
+def escapelabel(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+querymetrics = QueryMetrics()
+
+# cursor class handed out by db.get_cursor, it times every execute and fetch and counts the
+# fetched rows under the function that asked for the cursor
+class InstrumentedCursor(psycopg2.extensions.cursor):
+    caller = "unknown"
+
+    def execute(self, query, vars=None):
+        began = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            querymetrics.observestatement(self.caller, query, time.perf_counter() - began)
+
+    def copy_expert(self, sql, file, size=8192):
+        began = time.perf_counter()
+        try:
+            return super().copy_expert(sql, file, size)
+        finally:
+            querymetrics.observestatement(self.caller, sql, time.perf_counter() - began)
+
+    def recordfetch(self, began, rows):
+        querymetrics.observe("fetch", self.caller, time.perf_counter() - began)
+        querymetrics.observe("rows", self.caller, rows)
+
+    def fetchone(self):
+        began = time.perf_counter()
+        row = super().fetchone()
+        self.recordfetch(began, 0 if row is None else 1)
+        return row
+
+    def fetchmany(self, size=None):
+        began = time.perf_counter()
+        rows = super().fetchmany() if size is None else super().fetchmany(size)
+        self.recordfetch(began, len(rows))
+        return rows
+
+    def fetchall(self):
+        began = time.perf_counter()
+        rows = super().fetchall()
+        self.recordfetch(began, len(rows))
+        return rows
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = querymetrics.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+metricsserver = None
+metricsserverlock = threading.Lock()
+
+# starts the /metrics endpoint on METRICS_PORT once per process, streamlit reruns the scripts
+# but the module is only imported once so the server isn't started twice
+def startmetricsserver(port=None):
+    global metricsserver
+    port = port or os.getenv("METRICS_PORT")
+    if not port:
+        return None
+    with metricsserverlock:
+        if metricsserver is None:
+            try:
+                metricsserver = ThreadingHTTPServer((metricshost, int(port)), MetricsHandler)
+            except OSError as e:
+                logger.warning(f"could not start the metrics endpoint on port {port}: {e}")
+                return None
+            threading.Thread(target=metricsserver.serve_forever, daemon=True).start()
+            logger.info(f"serving query metrics on {metricshost}:{port}/metrics")
+    return metricsserver
@@ -0,0 +1,243 @@
+import os
+import sys
+import time
+import argparse
+import threading
+from datetime import datetime, timedelta
+from db import get_cursor
+from querycache import cached
+from utils import getlogger
+
+logger = getlogger("rollups")
+# every rollup refresh re-aggregates this many hours behind the watermark so posts that the
+# crawlers insert a little late still land in the right hourly bucket
+lookbackhours = int(os.getenv("ROLLUP_LOOKBACK_HOURS", "2"))
+# the dashboard triggers a refresh on read but never more often than this
+refreshinterval = int(os.getenv("ROLLUP_REFRESH_SECONDS", "60"))
+
+# hourly rollup of both post tables, one row per platform, community and hour. the temporal
+# panel answers day, week, weekday and length questions by summing these rows instead of
+# scanning chan_posts and reddit_posts. tox_count is the number of non null toxicity scores
+# and length_count the number of non null texts so both AVG(x) and AVG(COALESCE(x,0)) can be
+# rebuilt exactly from the sums
+ROLLUPSCHEMA = """
+    CREATE TABLE IF NOT EXISTS post_rollup_hourly (
+        platform TEXT NOT NULL,
+        community TEXT NOT NULL,
+        bucket_hour TIMESTAMP NOT NULL,
+        post_count INTEGER NOT NULL,
+        tox_sum DOUBLE PRECISION NOT NULL,
+        tox_count INTEGER NOT NULL,
+        length_sum BIGINT NOT NULL,
+        length_count INTEGER NOT NULL,
+        PRIMARY KEY (platform, community, bucket_hour)
+    );
+    CREATE INDEX IF NOT EXISTS post_rollup_hourly_bucket_idx ON post_rollup_hourly (bucket_hour);
+    CREATE TABLE IF NOT EXISTS rollup_watermarks (
+        name TEXT PRIMARY KEY,
+        watermark TIMESTAMP NOT NULL,
+        refreshed_at TIMESTAMP NOT NULL DEFAULT now()
+    );
+"""
+
+# normalized subreddit of a reddit post, lower cased and without the r/ prefix. it is the same
+# normalization getthecommunities uses and migration 0003_reddit_typed_columns stores it in the
+# subreddit_key column that the queries read
+REDDITCOMMUNITYKEY = """LOWER(COALESCE(
+                          NULLIF(data->>'subreddit', ''),
+                          regexp_replace(data->>'subreddit_name_prefixed', '^r/', ''),
+                          ''))"""
+
+# the typed reddit columns of migration 0003_reddit_typed_columns and the json expressions they
+# are generated from. the queries read the columns once the migration is applied and fall back
+# to the expressions on a database that doesn't have them yet
+REDDITCOLUMNS = {
+    "subreddit_key": REDDITCOMMUNITYKEY,
+    "author_name": "(data->>'author')",
+    "text_length": """LENGTH(COALESCE(data->>'body', '') ||
+                            COALESCE(data->>'title', '') ||
+                            COALESCE(data->>'selftext', ''))""",
+}
+
+# the text of a reddit post, the fields joined with newlines so a topic can't match across the
+# end of one and the start of the next. migration 0001_topic_search_text stores it lower cased
+# as search_text, this is what the topic search and the snapshot export read without it
+REDDITTEXT = """(COALESCE(data->>'body', '') || E'\\n' ||
+                 COALESCE(data->>'title', '') || E'\\n' ||
+                 COALESCE(data->>'selftext', ''))"""
+
+# the typed columns reddit_posts has, rechecked every few minutes so the queries switch to them
+# after the migration like searchtables does for search_text
+@cached(ttl=300)
+def typedredditcolumns():
+    with get_cursor() as cur:
+        cur.execute("""
+            SELECT column_name FROM information_schema.columns
+            WHERE table_name = 'reddit_posts' AND column_name = ANY(%s);
+        """, (list(REDDITCOLUMNS),))
+        return {r[0] for r in cur.fetchall()}
+
+# the expression a query reads a column of a post table with, the typed reddit column when it
+# exists and its json expression otherwise. other columns are returned as they are
+def columnexpr(table, name):
+    if table != "reddit_posts" or name not in REDDITCOLUMNS or name in typedredditcolumns():
+        return name
+    return REDDITCOLUMNS[name]
+
+# source expressions per platform, the community key is the lower cased board or subreddit name.
+# use rollupsource to read them, it resolves the typed reddit columns
+ROLLUPSOURCES = {
+    "4chan": {
+        "table": "chan_posts",
+        "community": "LOWER(board_name)",
+        "length": "LENGTH(content)",
+        "author": "author_name",
+    },
+    "Reddit": {
+        "table": "reddit_posts",
+        "community": "subreddit_key",
+        "length": "text_length",
+        "author": "author_name",
+    },
+}
+
+def rollupsource(platform):
+    source = ROLLUPSOURCES[platform]
+    return {key: columnexpr(source["table"], value) for key, value in source.items()}
+
+refreshlock = threading.Lock()
+lastrefresh = 0.0
+schemaready = False
+
+def ensurerollupschema():
+    global schemaready
+    if schemaready:
+        return
+    with get_cursor(commit=True) as cur:
+        cur.execute(ROLLUPSCHEMA)
+    schemaready = True
+
+# this function rebuilds the rollup rows for one platform from the watermark onwards, the hours
+# at or after the watermark hour minus the lookback are deleted and re-aggregated in the same
+# transaction so readers keep seeing the old rows until the commit and a rerun is idempotent
+def refreshplatform(platform, full=False):
+    source = rollupsource(platform)
+    name = f"post_rollup_hourly:{platform}"
+    with get_cursor(commit=True) as cur:
+        # serialize concurrent refreshes of the same platform across processes
+        cur.execute("SELECT pg_advisory_xact_lock(hashtext(%s));", (name,))
+        cur.execute("SELECT watermark FROM rollup_watermarks WHERE name = %s;", (name,))
+        row = cur.fetchone()
+        since = None
+        if row is not None and not full:
+            since = (row[0] - timedelta(hours=lookbackhours)).replace(minute=0, second=0, microsecond=0)
+        if since is None:
+            cur.execute("DELETE FROM post_rollup_hourly WHERE platform = %s;", (platform,))
+            wherefilter, params = "", ()
+        else:
+            cur.execute("DELETE FROM post_rollup_hourly WHERE platform = %s AND bucket_hour >= %s;", (platform, since))
+            wherefilter, params = "WHERE created_at >= %s", (since,)
+        cur.execute(f"""
+            INSERT INTO post_rollup_hourly
+                (platform, community, bucket_hour, post_count, tox_sum, tox_count, length_sum, length_count)
+            SELECT %s,
+                   {source['community']} AS community,
+                   date_trunc('hour', created_at) AS bucket_hour,
+                   COUNT(*)::int,
+                   COALESCE(SUM(toxicityscore), 0)::float,
+                   COUNT(toxicityscore)::int,
+                   COALESCE(SUM({source['length']}), 0)::bigint,
+                   COUNT({source['length']})::int
+            FROM {source['table']}
+            {wherefilter}
+            GROUP BY community, bucket_hour;
+        """, (platform,) + params)
+        inserted = cur.rowcount
+        cur.execute(f"SELECT MAX(created_at) FROM {source['table']} {wherefilter};", params)
+        newwatermark = cur.fetchone()[0]
+        if newwatermark is not None:
+            cur.execute("""
+                INSERT INTO rollup_watermarks (name, watermark, refreshed_at)
+                VALUES (%s, %s, now())
+                ON CONFLICT (name) DO UPDATE SET watermark = EXCLUDED.watermark, refreshed_at = now();
+            """, (name, newwatermark))
+    logger.info(f"refreshed {platform} rollups from {since or 'the beginning'}: {inserted} hourly rows, watermark {newwatermark}")
+    return newwatermark
+
+# this function refreshes the rollups of both platforms, only the hours past each watermark
+# are re-aggregated unless full is set in which case everything is rebuilt from scratch.
+# with ifolderthan set the refresh is skipped when another thread refreshed recently
+def refreshrollups(full=False, ifolderthan=None):
+    global lastrefresh
+    ensurerollupschema()
+    with refreshlock:
+        if ifolderthan is not None and time.monotonic() - lastrefresh < ifolderthan:
+            return None
+        watermarks = {platform: refreshplatform(platform, full=full) for platform in ROLLUPSOURCES}
+        lastrefresh = time.monotonic()
+    return watermarks
+
+# the refresh the panels start, off the render path. lastattempt throttles retries when it fails
+refreshthread = None
+refreshthreadlock = threading.Lock()
+lastattempt = 0.0
+
+# tables derived from the rollups register a function here, it runs after every background
+# refresh that refreshed the rollups
+afterrefresh = []
+
+def backgroundrefresh():
+    try:
+        if refreshrollups(ifolderthan=refreshinterval) is None:
+            return
+    except Exception as e:
+        logger.error(f"rollup refresh failed: {e}")
+        return
+    for refresh in afterrefresh:
+        try:
+            refresh()
+        except Exception as e:
+            logger.error(f"{refresh.__name__} after the rollup refresh failed: {e}")
+
+# the panels call this before reading the rollups, it starts a refresh at most once every
+# refreshinterval seconds per process on a background thread and returns at once, the reader
+# reads the rollups as they are. the first refresh of a new database is a full build that can
+# take minutes, until it is done the panels show what is already aggregated (or nothing) and
+# the bucket cache stores nothing past the watermark. schema errors are logged like refresh
+# errors so a missing permission doesn't break the panel
+def refreshifstale():
+    global refreshthread, lastattempt
+    try:
+        ensurerollupschema()
+    except Exception as e:
+        logger.error(f"rollup schema check failed: {e}")
+        return
+    if time.monotonic() - max(lastrefresh, lastattempt) < refreshinterval or refreshlock.locked():
+        return
+    with refreshthreadlock:
+        if refreshthread is not None and refreshthread.is_alive():
+            return
+        lastattempt = time.monotonic()
+        refreshthread = threading.Thread(target=backgroundrefresh, name="rollup-refresh", daemon=True)
+        refreshthread.start()
+
+# the time up to which the rollups of every platform are final, the watermark of the platform
+# that is furthest behind minus the lookback the next refresh re-aggregates. datetime.min until
+# every platform has been refreshed once
+def settledthrough():
+    with get_cursor() as cur:
+        cur.execute("SELECT MIN(watermark), COUNT(*) FROM rollup_watermarks WHERE name LIKE 'post_rollup_hourly:%';")
+        watermark, refreshed = cur.fetchone()
+    if watermark is None or refreshed < len(ROLLUPSOURCES):
+        return datetime.min
+    return watermark - timedelta(hours=lookbackhours)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="refresh the hourly post rollups")
+    parser.add_argument("--full", action="store_true", help="rebuild every hour instead of only the ones past the watermark")
+    args = parser.parse_args()
+    try:
+        refreshrollups(full=args.full)
+    except Exception as e:
+        logger.error(f"rollup refresh failed: {e}")
+        sys.exit(1)
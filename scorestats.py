@@ -0,0 +1,115 @@
+import os
+import numpy as np
+
+# toxicity scores live in [0, 1] so a fixed width histogram over that range is a sketch that
+# can be added across topics, communities or date ranges without going back to the raw scores
+HISTOGRAMBINS = int(os.getenv("SCORE_HISTOGRAM_BINS", "20"))
+QUANTILES = (0.25, 0.5, 0.75)
+
+# this function wraps a query selecting (grp, score) rows into one that returns, per group,
+# the count, mean, min, max, the 25/50/75 percentiles and the binned histogram of the non null
+# scores, their standard deviation, the number of rows and the mean with null scores counted as
+# 0. with exact the
+# percentiles come from percentile_cont, otherwise the sort is skipped and they are read off
+# the histogram later. the result is a handful of numbers per group however many rows match
+def summarysql(matchedsql, exact=True):
+    quantiles = "ARRAY[" + ", ".join(str(q) for q in QUANTILES) + "]::float8[]"
+    percentiles = f"percentile_cont({quantiles}) WITHIN GROUP (ORDER BY score)" if exact else "NULL::float8[]"
+    return f"""
+        WITH matched AS ({matchedsql}),
+        binned AS (
+            SELECT grp,
+                   LEAST(GREATEST(width_bucket(score, 0, 1, {HISTOGRAMBINS}), 1), {HISTOGRAMBINS}) AS bin,
+                   COUNT(*)::bigint AS n
+            FROM matched
+            WHERE score IS NOT NULL
+            GROUP BY 1, 2
+        ),
+        histograms AS (
+            SELECT grp, jsonb_object_agg(bin, n) AS bins
+            FROM binned
+            GROUP BY grp
+        ),
+        stats AS (
+            SELECT grp, COUNT(score)::bigint AS n, AVG(score)::float AS mean,
+                   MIN(score)::float AS lo, MAX(score)::float AS hi,
+                   {percentiles} AS percentiles,
+                   COUNT(*)::bigint AS rowcount, AVG(COALESCE(score, 0))::float AS meanall,
+                   STDDEV_SAMP(score)::float AS sd
+            FROM matched
+            GROUP BY grp
+        )
+        SELECT stats.grp, stats.n, stats.mean, stats.lo, stats.hi, stats.percentiles, histograms.bins,
+               stats.rowcount, stats.meanall, stats.sd
+        FROM stats LEFT JOIN histograms USING (grp);
+    """
+
+# this function wraps a query selecting grp and several score columns into a summarysql query
+# over all of them. every matched row is unpivoted into one score per column so the table is
+# scanned once however many metrics are summarized, the grp of the result rows is the array
+# [grp, column]
+def multisummarysql(matchedsql, columns, exact=True):
+    values = ", ".join(f"('{column}', t.{column}::float8)" for column in columns)
+    return summarysql(f"""
+        SELECT ARRAY[t.grp::text, m.metric] AS grp, m.score
+        FROM ({matchedsql}) t
+        CROSS JOIN LATERAL (VALUES {values}) AS m(metric, score)
+    """, exact)
+
+def binedges():
+    return [i / HISTOGRAMBINS for i in range(HISTOGRAMBINS + 1)]
+
+# reads a quantile off a histogram by interpolating inside the bin where it falls
+def histogramquantile(histogram, q):
+    total = sum(histogram)
+    if total == 0:
+        return None
+    target = q * total
+    seen = 0
+    for i, n in enumerate(histogram):
+        if n and seen + n >= target:
+            return (i + (target - seen) / n) / HISTOGRAMBINS
+        seen += n
+    return 1.0
+
+def emptysummary():
+    return {"count": 0, "mean": None, "min": None, "max": None,
+            "quantiles": {q: None for q in QUANTILES}, "exact": False,
+            "histogram": [0] * HISTOGRAMBINS, "rows": 0, "meanwithnulls": None, "stddev": None}
+
+# this function turns a row of summarysql into the summary dict the panels use
+def summaryfromrow(row):
+    histogram = [0] * HISTOGRAMBINS
+    for b, n in (row[6] or {}).items():
+        histogram[int(b) - 1] = int(n)
+    if row[5] is not None:
+        quantiles = dict(zip(QUANTILES, row[5]))
+    else:
+        quantiles = {q: histogramquantile(histogram, q) for q in QUANTILES}
+    return {"count": int(row[1]), "mean": row[2], "min": row[3], "max": row[4],
+            "quantiles": quantiles, "exact": row[5] is not None, "histogram": histogram,
+            "rows": int(row[7]), "meanwithnulls": row[8], "stddev": row[9]}
+
+# the same summary computed in python from a series of scores (nan for missing ones), for the
+# snapshot backend. the bins follow width_bucket and the exact quantiles interpolate like
+# percentile_cont
+def summaryfromvalues(values, exact=True):
+    rows = len(values)
+    if not rows:
+        return emptysummary()
+    allscores = values.to_numpy(dtype=float)
+    scores = allscores[~np.isnan(allscores)]
+    histogram = [0] * HISTOGRAMBINS
+    if len(scores):
+        bins = np.clip(np.floor(scores * HISTOGRAMBINS).astype(int), 0, HISTOGRAMBINS - 1)
+        histogram = np.bincount(bins, minlength=HISTOGRAMBINS).tolist()
+    if exact and len(scores):
+        quantiles = dict(zip(QUANTILES, np.quantile(scores, QUANTILES).tolist()))
+    else:
+        quantiles = {q: histogramquantile(histogram, q) for q in QUANTILES}
+    scored = len(scores) > 0
+    return {"count": int(len(scores)), "mean": float(scores.mean()) if scored else None,
+            "min": float(scores.min()) if scored else None, "max": float(scores.max()) if scored else None,
+            "quantiles": quantiles, "exact": bool(exact and scored), "histogram": histogram,
+            "rows": rows, "meanwithnulls": float(np.nan_to_num(allscores).mean()),
+            "stddev": float(scores.std(ddof=1)) if len(scores) > 1 else None}
@@ -0,0 +1,274 @@
+import os
+import sys
+import json
+import argparse
+from datetime import datetime, timedelta
+import pandas as pd
+from db import get_cursor
+from columnar import fetchframe
+from rollups import rollupsource, REDDITTEXT
+from scorestats import summaryfromvalues
+from utils import getlogger
+
+logger = getlogger("snapshot")
+# the snapshots live in SNAPSHOT_DIR, one directory per platform with a month=YYYY-MM partition
+# per month of posts and a manifest.json describing the export
+snapshotdir = os.getenv("SNAPSHOT_DIR", "snapshots")
+SCORECOLUMNS = ["toxicityscore", "severetoxicityscore", "insultscore", "profanityscore",
+                "identityattackscore", "threatscore", "unsubstantialscore"]
+# only the columns the panels read are exported, with the community key, the text length and
+# the lower cased search text computed the same way the rollups and the topic search do
+SNAPSHOTTABLES = {
+    "4chan": {"table": "chan_posts", "searchcolumn": "COALESCE(content, '')"},
+    "Reddit": {"table": "reddit_posts", "searchcolumn": REDDITTEXT},
+}
+SNAPSHOTDTYPES = dict({"community": "object", "author_name": "object", "text_length": "Int64", "search_text": "object"},
+                      **{column: "float64" for column in SCORECOLUMNS})
+
+def snapshotschema():
+    import pyarrow as pa
+    return pa.schema([("community", pa.string()), ("author_name", pa.string()), ("created_at", pa.timestamp("us")),
+                      ("text_length", pa.int64()), ("search_text", pa.string())]
+                     + [(column, pa.float64()) for column in SCORECOLUMNS])
+
+def monthstarts(first, last):
+    month = first.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    while month <= last:
+        yield month
+        month = (month + timedelta(days=32)).replace(day=1)
+
+def manifestpath(directory):
+    return os.path.join(directory, "manifest.json")
+
+def readmanifest(directory):
+    try:
+        with open(manifestpath(directory)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {"tables": {}}
+
+# this function exports one platform's posts month by month, every month is read through COPY
+# into typed columns and written as one zstd parquet file. with since only the months from
+# there on are rewritten, older partitions are kept as they are. files are written under a
+# temporary name and moved into place so a reader never sees half a partition
+def exportplatform(platform, directory, since=None):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    source, columns = SNAPSHOTTABLES[platform], rollupsource(platform)
+    with get_cursor() as cur:
+        cur.execute(f"SELECT MIN(created_at), MAX(created_at) FROM {source['table']};")
+        first, last = cur.fetchone()
+    if first is None:
+        return {"rows": 0, "communities": []}
+    rows, communities = 0, set()
+    searchtext = f"lower({source['searchcolumn']})"
+    for month in monthstarts(max(first, since) if since else first, last):
+        nextmonth = (month + timedelta(days=32)).replace(day=1)
+        with get_cursor() as cur:
+            frame = fetchframe(cur, f"""
+                SELECT {columns['community']} AS community, {columns['author']} AS author_name, created_at,
+                       {columns['length']} AS text_length, {searchtext} AS search_text,
+                       {", ".join(SCORECOLUMNS)}
+                FROM {source['table']}
+                WHERE created_at >= %s AND created_at < %s
+                ORDER BY created_at
+            """, (month, nextmonth), dtypes=SNAPSHOTDTYPES, dates=("created_at",))
+        if frame.empty:
+            continue
+        partition = os.path.join(directory, platform, f"month={month:%Y-%m}")
+        os.makedirs(partition, exist_ok=True)
+        # parquet readers skip files starting with an underscore so the temporary file is invisible
+        temporary = os.path.join(partition, "_part-0.parquet.tmp")
+        pq.write_table(pa.Table.from_pandas(frame, schema=snapshotschema(), preserve_index=False),
+                       temporary, compression="zstd")
+        os.replace(temporary, os.path.join(partition, "part-0.parquet"))
+        rows += len(frame)
+        communities.update(c for c in frame["community"].dropna().unique() if c)
+        logger.info(f"exported {len(frame)} {platform} posts of {month:%Y-%m}")
+    return {"rows": rows, "communities": sorted(communities), "first": first.isoformat(), "last": last.isoformat()}
+
+# the rows of every exported month of a platform, read from the parquet footers
+def partitionrows(directory, platform):
+    import pyarrow.parquet as pq
+    rows = 0
+    path = os.path.join(directory, platform)
+    for partition in sorted(os.listdir(path)) if os.path.isdir(path) else []:
+        part = os.path.join(path, partition, "part-0.parquet")
+        if partition.startswith("month=") and os.path.exists(part):
+            rows += pq.ParquetFile(part).metadata.num_rows
+    return rows
+
+# this function exports both platforms and updates the manifest, the community lists of an
+# incremental export are merged with the ones already exported and the row counts are taken
+# from the partitions so rewritten months aren't counted twice
+def exportsnapshots(directory=None, since=None):
+    directory = directory or snapshotdir
+    manifest = readmanifest(directory)
+    for platform in SNAPSHOTTABLES:
+        exported = exportplatform(platform, directory, since)
+        previous = manifest["tables"].get(platform, {})
+        if since:
+            exported["communities"] = sorted(set(previous.get("communities", [])) | set(exported["communities"]))
+        exported["rows"] = partitionrows(directory, platform)
+        manifest["tables"][platform] = exported
+    manifest["exported_at"] = datetime.utcnow().isoformat()
+    os.makedirs(directory, exist_ok=True)
+    with open(manifestpath(directory) + ".tmp", "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(manifestpath(directory) + ".tmp", manifestpath(directory))
+    return manifest
+
+# python version of date_trunc over a column of timestamps, weeks start on monday
+def bucketfloor(timestamps, bucket):
+    if bucket == "week":
+        return (timestamps - pd.to_timedelta(timestamps.dt.dayofweek, unit="D")).dt.floor("D")
+    return timestamps.dt.floor({"minute": "min", "hour": "h", "day": "D"}[bucket])
+
+def optionalfloat(value):
+    return None if pd.isna(value) else float(value)
+
+# the snapshot backend answers the panel queries from the exported parquet files instead of the
+# database. every read memory maps the files of the months in the range and only the columns
+# it needs, and the aggregations are vectorized pandas/numpy over those columns. the methods
+# return the same shapes as the queries they stand in for
+class SnapshotBackend:
+    def __init__(self, directory):
+        self.directory = directory
+
+    def communities(self, platform):
+        return readmanifest(self.directory)["tables"].get(platform, {}).get("communities", [])
+
+    def loadtable(self, platform, columns, start, end, communities=None):
+        import pyarrow.parquet as pq
+        path = os.path.join(self.directory, platform)
+        if not os.path.isdir(path):
+            raise FileNotFoundError(f"no {platform} snapshot in {self.directory}, run python snapshot.py export")
+        filters = [("month", ">=", f"{start:%Y-%m}"), ("month", "<=", f"{end:%Y-%m}"),
+                   ("created_at", ">=", start), ("created_at", "<=", end)]
+        if communities is not None:
+            filters.append(("community", "in", list(communities)))
+        return pq.read_table(path, columns=columns, filters=filters, memory_map=True, partitioning="hive")
+
+    def load(self, platform, columns, start, end, communities=None):
+        return self.loadtable(platform, columns, start, end, communities).to_pandas()
+
+    # the buckets, days, weekdays and total parts of temporal.temporalquery for each scope
+    def temporal(self, bucket, start, end, parts, scopes):
+        platforms = {}
+        for scope in scopes:
+            communities = None if scope["community"] is None else [scope["community"]]
+            frame = self.load(scope["platform"], ["created_at", "toxicityscore", "text_length"], start, end, communities)
+            toxicity = frame["toxicityscore"].fillna(0) if scope["nulltoxzero"] else frame["toxicityscore"]
+            result = {"buckets": [], "days": [], "weekdays": [], "total": int(len(frame))}
+            if "buckets" in parts:
+                grouped = toxicity.groupby(bucketfloor(frame["created_at"], bucket))
+                counts, averages = grouped.size(), grouped.mean()
+                result["buckets"] = [{"t": t.to_pydatetime(), "count": int(n), "avg_tox": optionalfloat(m) or 0}
+                                     for t, n, m in zip(counts.index, counts, averages)]
+            if "days" in parts:
+                lengths = frame["text_length"].astype("float64").groupby(frame["created_at"].dt.floor("D")).mean()
+                result["days"] = [{"day": t.to_pydatetime(), "avg_len": optionalfloat(m)} for t, m in lengths.items()]
+            if "weekdays" in parts:
+                # postgres counts the days of the week from sunday
+                weekdays = ((frame["created_at"].dt.dayofweek + 1) % 7).value_counts().sort_index()
+                result["weekdays"] = [{"weekday": int(d), "count": int(n)} for d, n in weekdays.items()]
+            platforms[scope["platform"]] = result
+        return {"start": start, "end": end, "bucket": bucket, "platforms": platforms}
+
+    def authors(self, platform, community, start, end, columns):
+        communities = None if community is None else [community]
+        frame = self.load(platform, ["author_name"] + columns, start, end, communities)
+        frame["author_name"] = frame["author_name"].fillna("")
+        return frame
+
+    # the same results as authorprofiles.topauthors, longestauthors and hourpattern
+    def topauthors(self, platform, community, start, end, limit):
+        counts = self.authors(platform, community, start, end, [])["author_name"].value_counts().head(limit)
+        return pd.DataFrame({"author_name": counts.index, "count": counts.values.astype("int64")})
+
+    def longestauthors(self, platform, community, start, end, limit):
+        frame = self.authors(platform, community, start, end, ["text_length"])
+        grouped = frame.groupby("author_name")["text_length"]
+        result = pd.DataFrame({"avg_len": grouped.mean().astype("float64"), "count": grouped.size()}).reset_index()
+        return result.sort_values("avg_len", ascending=False, na_position="last").head(limit).reset_index(drop=True)
+
+    def hourpattern(self, platform, community, start, end, topn, excluded):
+        frame = self.authors(platform, community, start, end, ["created_at"])
+        frame = frame[frame["author_name"] != excluded]
+        top = frame["author_name"].value_counts().head(topn).index
+        frame = frame[frame["author_name"].isin(top)]
+        pivot = pd.crosstab(frame["author_name"], frame["created_at"].dt.hour)
+        pivot = pivot.reindex(index=top, columns=range(24), fill_value=0)
+        pivot.index.name, pivot.columns.name = "author_name", None
+        return pivot
+
+    # score summaries per metric and community like the summarysql query of gettoxicity, the
+    # columns of every metric are read in one load
+    def toxicitysummaries(self, platform, metrics, names, start, end):
+        if not names:
+            return {metric: {} for metric in metrics}
+        frame = self.load(platform, ["community"] + list(metrics), start, end, names)
+        groups = frame.groupby("community")
+        return {metric: {community: summaryfromvalues(group[metric]) for community, group in groups} for metric in metrics}
+
+    # the created_at and toxicity of the posts mentioning each topic, the text is matched on the
+    # memory mapped arrow column and only the matching rows are converted to pandas
+    def topicmatches(self, platform, topics, start, end):
+        import pyarrow.compute as pc
+        table = self.loadtable(platform, ["created_at", "toxicityscore", "search_text"], start, end)
+        matches = [table.filter(pc.match_substring(table["search_text"], topic.lower()))
+                        .select(["created_at", "toxicityscore"]).to_pandas().assign(topic=topic)
+                   for topic in topics]
+        return pd.concat(matches, ignore_index=True) if matches else pd.DataFrame(columns=["created_at", "toxicityscore", "topic"])
+
+    # bucketed counts and average toxicity per (platform, topic) like aitopicanalysis.topicpoints
+    def topicpoints(self, platforms, topics, bucket, start, end):
+        points = {}
+        for platform in platforms:
+            matched = self.topicmatches(platform, topics, start, end)
+            for topic in topics:
+                points[(platform, topic)] = []
+            if matched.empty:
+                continue
+            grouped = matched.groupby(["topic", bucketfloor(matched["created_at"], bucket)])["toxicityscore"]
+            for (topic, t), n, m in zip(grouped.size().index, grouped.size(), grouped.mean()):
+                points[(platform, topic)].append({"t": t.to_pydatetime(), "count": int(n), "averagetoxicity": optionalfloat(m) or None})
+        return points
+
+    # toxicity summaries per (platform, topic) of the scored matching posts
+    def topicstats(self, platform, topics, start, end, exact=True):
+        matched = self.topicmatches(platform, topics, start, end).dropna(subset=["toxicityscore"])
+        return {(platform, topic): summaryfromvalues(group["toxicityscore"], exact=exact)
+                for topic, group in matched.groupby("topic")}
+
+backend = None
+
+# returns the snapshot backend when DASHBOARD_BACKEND=snapshot, otherwise None and the panels
+# query postgres as usual
+def activebackend():
+    global backend
+    if os.getenv("DASHBOARD_BACKEND", "postgres") != "snapshot":
+        return None
+    if backend is None:
+        backend = SnapshotBackend(snapshotdir)
+        logger.info(f"panels read the snapshots in {snapshotdir}")
+    return backend
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="export parquet snapshots of the post tables for offline analysis")
+    parser.add_argument("command", choices=["export", "show"])
+    parser.add_argument("--dir", default=snapshotdir, help="snapshot directory")
+    parser.add_argument("--since", help="only rewrite the months from this one on (YYYY-MM)")
+    args = parser.parse_args()
+    try:
+        if args.command == "export":
+            since = datetime.strptime(args.since, "%Y-%m") if args.since else None
+            manifest = exportsnapshots(args.dir, since)
+        else:
+            manifest = readmanifest(args.dir)
+        for platform, table in manifest["tables"].items():
+            print(f"{platform}: {table.get('rows', 0)} posts in {len(table.get('communities', []))} communities "
+                  f"from {table.get('first')} to {table.get('last')}")
+    except Exception as e:
+        logger.error(f"snapshot {args.command} failed: {e}")
+        sys.exit(1)
@@ -3,6 +3,14 @@ import pandas as pd
 import plotly.express as px
 from datetime import datetime, timedelta
 from db import get_cursor
+from rollups import refreshifstale, settledthrough
+from querycache import cached
+from bucketcache import bucketcache
+from parallel import runparallel
+from bucketing import RESOLUTIONS, choosebucket, downsample
+import authorprofiles
+from snapshot import activebackend
+import livetail
 from utils import getlogger
 
 logger = getlogger("temporal_panel")
@@ -18,229 +26,240 @@ def parsedate(s, default=None):
     except:
         return default or datetime.utcnow()
 
-# in this function we retrieves time bucketed post activity for both 4chan and reddit
-# It will then groups posts by the chosen bucket  and calculates post counts and average
-# toxicity scores and it will return a structured series used for time-series charts
-def getpostspertime(bucket="day", start=None, end=None):
+# the temporal panel reads the hourly rollups instead of the raw tables, each platform is a
+# filter on post_rollup_hourly plus the count that divides the toxicity sum. 4chan averages
+# only the scored posts like AVG(toxicityscore) while reddit counts unscored posts as 0 like
+# AVG(COALESCE(toxicityscore,0)) did on the raw table. buckets finer than an hour can't come
+# from the rollups, those are counted on the raw table with the same scope and average
+ROLLUPSCOPES = [
+    {"platform": "4chan", "community": "g", "filter": "platform = '4chan' AND community = 'g'", "toxdivisor": "tox_count",
+     "table": "chan_posts", "rawfilter": "board_name = 'g'", "rawtox": "AVG(toxicityscore)", "nulltoxzero": False},
+    {"platform": "Reddit", "community": None, "filter": "platform = 'Reddit'", "toxdivisor": "post_count",
+     "table": "reddit_posts", "rawfilter": "TRUE", "rawtox": "AVG(COALESCE(toxicityscore, 0))", "nulltoxzero": True},
+]
+# the hours of a range are the ones that start before its end, from the hour its start falls in.
+# an end on the hour reads exactly the posts created_at BETWEEN start and end did on the raw
+# tables (bar posts at the very instant of the end) and never the hour that starts at the end,
+# an end or start within an hour reads that whole hour
+ROLLUPRANGE = "bucket_hour >= date_trunc('hour', %s::timestamp) AND bucket_hour < %s"
+
+# the temporal engine answers every question of the temporal panel in one grouped pass per
+# platform, each part below is one grouping set and the GROUPING() bitmask over
+# (bucket_ts, day, weekday) tells which set a result row belongs to
+TEMPORALPARTS = ("buckets", "days", "weekdays", "total")
+GROUPINGSETS = {"buckets": "(bucket_ts)", "days": "(day)", "weekdays": "(weekday)", "total": "()"}
+GROUPINGIDS = {3: "buckets", 5: "days", 6: "weekdays", 7: "total"}
+
+# this function runs the combined temporal query and returns the bucketed counts and average
+# toxicity, the average length per day, the counts per day of week and the total for each
+# platform. parts limits the grouping sets when a caller only needs some of them. with the
+# snapshot backend the same parts are computed from the parquet snapshots
+@cached(ttl=120)
+def temporalquery(bucket="day", start=None, end=None, parts=TEMPORALPARTS):
     enddate = parsedate(end, datetime.utcnow())
     startdate = parsedate(start, enddate - timedelta(days=defaultdays))
-    platformdatalist = []
+    backend = activebackend()
+    if backend is not None:
+        return backend.temporal(bucket, startdate, enddate, parts, ROLLUPSCOPES)
+    refreshifstale()
+    groupingsets = ", ".join(GROUPINGSETS[part] for part in parts)
+    platforms = {}
     with get_cursor() as cur:
-        sql = f"""
-            SELECT date_trunc('{bucket}', created_at) AS bucket_ts,
-                   COUNT(*)::int AS cnt,
-                   AVG(toxicityscore)::float AS avg_tox
-            FROM chan_posts
-            WHERE board_name = 'g'
-            AND created_at BETWEEN %s AND %s
-            GROUP BY bucket_ts
-            ORDER BY bucket_ts;
-        """
-        cur.execute(sql, (startdate, enddate))
-        datarows = cur.fetchall()
-        platformdatalist.append({
-            "platform": "4chan",
-            "points": [{"t": r[0], "count": r[1], "avg_tox": r[2] or 0} for r in datarows]
-        })
+        for scope in ROLLUPSCOPES:
+            cur.execute(f"""
+                SELECT bucket_ts, day, weekday,
+                       GROUPING(bucket_ts, day, weekday) AS grp,
+                       SUM(post_count)::int AS cnt,
+                       (SUM(tox_sum) / NULLIF(SUM(toxdivisor), 0))::float AS avg_tox,
+                       (SUM(length_sum)::float / NULLIF(SUM(length_count), 0))::float AS avg_len
+                FROM (
+                    SELECT date_trunc('{bucket}', bucket_hour) AS bucket_ts,
+                           date_trunc('day', bucket_hour) AS day,
+                           EXTRACT(DOW FROM bucket_hour)::int AS weekday,
+                           post_count, tox_sum, {scope['toxdivisor']} AS toxdivisor, length_sum, length_count
+                    FROM post_rollup_hourly
+                    WHERE {scope['filter']}
+                    AND {ROLLUPRANGE}
+                ) AS scoped
+                GROUP BY GROUPING SETS ({groupingsets})
+                ORDER BY grp, bucket_ts, day, weekday;
+            """, (startdate, enddate))
+            result = {"buckets": [], "days": [], "weekdays": [], "total": 0}
+            for r in cur.fetchall():
+                part = GROUPINGIDS[r[3]]
+                if part == "buckets":
+                    result["buckets"].append({"t": r[0], "count": r[4], "avg_tox": r[5] or 0})
+                elif part == "days":
+                    result["days"].append({"day": r[1], "avg_len": r[6]})
+                elif part == "weekdays":
+                    result["weekdays"].append({"weekday": r[2], "count": r[4]})
+                else:
+                    result["total"] = r[4] or 0
+            platforms[scope["platform"]] = result
+    return {"start": startdate, "end": enddate, "bucket": bucket, "platforms": platforms}
+
+# this function counts posts and averages toxicity per minute bucket on the raw tables for the
+# short windows the hourly rollups are too coarse for, shaped like the buckets of temporalquery
+def rawbuckets(bucket, startdate, enddate):
+    backend = activebackend()
+    if backend is not None:
+        result = backend.temporal(bucket, startdate, enddate, ("buckets",), ROLLUPSCOPES)
+        return {platform: data["buckets"] for platform, data in result["platforms"].items()}
+    platforms = {}
     with get_cursor() as cur:
-        sql = f"""
-            SELECT date_trunc('{bucket}', created_at) AS bucket_ts,
-                   COUNT(*)::int AS cnt,
-                   AVG(COALESCE(toxicityscore,0))::float AS avg_tox
-            FROM reddit_posts
-            WHERE created_at BETWEEN %s AND %s
-            GROUP BY bucket_ts
-            ORDER BY bucket_ts;
-        """
-        cur.execute(sql, (startdate, enddate))
-        datarows = cur.fetchall()
-        platformdatalist.append({
-            "platform": "Reddit",
-            "points": [{"t": r[0], "count": r[1], "avg_tox": r[2] or 0} for r in datarows]
-        })
-    return {"start": startdate, "end": enddate, "bucket": bucket, "series": platformdatalist}
+        for scope in ROLLUPSCOPES:
+            cur.execute(f"""
+                SELECT date_trunc('{bucket}', created_at) AS bucket_ts, COUNT(*)::int, {scope['rawtox']}::float
+                FROM {scope['table']}
+                WHERE {scope['rawfilter']} AND created_at BETWEEN %s AND %s
+                GROUP BY 1
+                ORDER BY 1;
+            """, (startdate, enddate))
+            platforms[scope["platform"]] = [{"t": r[0], "count": r[1], "avg_tox": r[2] or 0} for r in cur.fetchall()]
+    return platforms
+
+# in this function we retrieves time bucketed post activity for both 4chan and reddit
+# It will then groups posts by the chosen bucket  and calculates post counts and average
+# toxicity scores and it will return a structured series used for time-series charts.
+# without a precomputed result the series come from the bucket cache which only queries the
+# buckets of the range it has not stored yet, and only stores buckets the rollup watermark has
+# passed. bucket is one of the bucketing resolutions or auto, which picks the resolution from
+# the width of the range
+@cached(ttl=120, bypassargs=("result",))
+def getpostspertime(bucket="day", start=None, end=None, result=None):
+    if result is None:
+        enddate = parsedate(end, datetime.utcnow())
+        startdate = parsedate(start, enddate - timedelta(days=defaultdays))
+        bucket = choosebucket(startdate, enddate, bucket)
+        keys = {scope["platform"]: ("posts", scope["platform"], scope["community"], None, "toxicityscore") for scope in ROLLUPSCOPES}
+        def fetch(substart, subend):
+            if bucket == "minute":
+                return {keys[platform]: points for platform, points in rawbuckets(bucket, substart, subend).items()}
+            subresult = temporalquery.uncached(bucket=bucket, start=substart.isoformat(), end=subend.isoformat(), parts=("buckets",))
+            return {keys[platform]: data["buckets"] for platform, data in subresult["platforms"].items()}
+        # buckets from the rollups are only stored once the rollup watermark passed them, before
+        # that a refresh or late crawler rows can still change them
+        # minute buckets are counted on the raw tables, they aren't covered by the rollup
+        # watermark and settle like the other raw series, BUCKET_CACHE_SETTLE_SECONDS after they
+        # ended which is well past the lateness the live tail lookback allows for
+        settled = None
+        if activebackend() is None and bucket != "minute":
+            refreshifstale()
+            settled = settledthrough()
+        series = bucketcache.fetchseries(list(keys.values()), bucket, startdate, enddate, fetch, settled=settled)
+        result = {"start": startdate, "end": enddate, "bucket": bucket,
+                  "platforms": {platform: {"buckets": series[key]} for platform, key in keys.items()}}
+    platformdatalist = [{"platform": platform, "points": data["buckets"]} for platform, data in result["platforms"].items()]
+    return {"start": result["start"], "end": result["end"], "bucket": result["bucket"], "series": platformdatalist}
 
 #  function will returns a simple summary of total posts within the selected date range
-def gettemporalsummary(start=None, end=None):
-    enddate = parsedate(end, datetime.utcnow())
-    startdate = parsedate(start, enddate - timedelta(days=defaultdays))
-    sumarytable = {}
-    with get_cursor() as cur:
-        cur.execute("SELECT COUNT(*) FROM chan_posts WHERE board_name = 'g' AND created_at BETWEEN %s AND %s", (startdate, enddate))
-        sumarytable["4chan total posts"] = cur.fetchone()[0]
-        cur.execute("SELECT COUNT(*) FROM reddit_posts WHERE created_at BETWEEN %s AND %s", (startdate, enddate))
-        sumarytable["Reddit total posts"] = cur.fetchone()[0]
-    return sumarytable
+def gettemporalsummary(start=None, end=None, result=None):
+    result = result or temporalquery(start=start, end=end, parts=("total",))
+    return {f"{platform} total posts": data["total"] for platform, data in result["platforms"].items()}
 
 # this function computes posting frequency for each day of the week across both the platforms and 
 # it analyze weekday vs weekend behavior by returning counts grouped by date of the week and 
 # which is then used to build comparative bar charts
-def weekdayvsweekendstats(start=None, end=None):
-    enddate = parsedate(end, datetime.utcnow())
-    startdate = parsedate(start, enddate - timedelta(days=defaultdays))
-    result = []
-    with get_cursor() as cur:
-        cur.execute("""
-            SELECT EXTRACT(DOW FROM created_at)::int AS weekday,
-                   COUNT(*)::int AS cnt
-            FROM chan_posts
-            WHERE board_name = 'g'
-            AND created_at BETWEEN %s AND %s
-            GROUP BY weekday
-            ORDER BY weekday;
-        """, (startdate, enddate))
-        dataframe = pd.DataFrame(cur.fetchall(), columns=["weekday", "count"])
-        dataframe["platform"] = "4chan"
-        result.append(dataframe)
-        cur.execute("""
-            SELECT EXTRACT(DOW FROM created_at)::int AS weekday,
-                   COUNT(*)::int AS cnt
-            FROM reddit_posts
-            WHERE created_at BETWEEN %s AND %s
-            GROUP BY weekday
-            ORDER BY weekday;
-        """, (startdate, enddate))
-        dataframe = pd.DataFrame(cur.fetchall(), columns=["weekday", "count"])
-        dataframe["platform"] = "Reddit"
-        result.append(dataframe)
-    return pd.concat(result) if result else pd.DataFrame()
+def weekdayvsweekendstats(start=None, end=None, result=None):
+    result = result or temporalquery(start=start, end=end, parts=("weekdays",))
+    frames = []
+    for platform, data in result["platforms"].items():
+        dataframe = pd.DataFrame(data["weekdays"], columns=["weekday", "count"])
+        dataframe["platform"] = platform
+        frames.append(dataframe)
+    return pd.concat(frames) if frames else pd.DataFrame()
 
 # in this function i am  calculatiing how average post length changes over time for 4chan and reddit
 # it then aggregates daily averages and returns combined data 
-def postlengthovertime(start=None, end=None):
-    enddate = parsedate(end, datetime.utcnow())
-    startdate = parsedate(start, enddate - timedelta(days=defaultdays))
+def postlengthovertime(start=None, end=None, result=None):
+    result = result or temporalquery(start=start, end=end, parts=("days",))
     platformdatalist = []
-    with get_cursor() as cur:
-        cur.execute("""
-            SELECT date_trunc('day', created_at) AS day,
-                   AVG(LENGTH(content))::float AS avg_len
-            FROM chan_posts
-            WHERE board_name = 'g'
-            AND created_at BETWEEN %s AND %s
-            GROUP BY day
-            ORDER BY day;
-        """, (startdate, enddate))
-        dataframe = pd.DataFrame(cur.fetchall(), columns=["day", "avg_len"])
-        dataframe["platform"] = "4chan"
-        platformdatalist.append(dataframe)
-        cur.execute("""
-            SELECT date_trunc('day', created_at) AS day,
-                   AVG(
-                       LENGTH(
-                           COALESCE(data->>'body','') ||
-                           COALESCE(data->>'title','') ||
-                           COALESCE(data->>'selftext','')
-                       )
-                   )::float AS avg_len
-            FROM reddit_posts
-            WHERE created_at BETWEEN %s AND %s
-            GROUP BY day
-            ORDER BY day;
-        """, (startdate, enddate))
-        dataframe = pd.DataFrame(cur.fetchall(), columns=["day", "avg_len"])
-        dataframe["platform"] = "Reddit"
+    for platform, data in result["platforms"].items():
+        dataframe = pd.DataFrame(data["days"], columns=["day", "avg_len"])
+        dataframe["platform"] = platform
         platformdatalist.append(dataframe)
     return pd.concat(platformdatalist) if platformdatalist else pd.DataFrame()
 
+# the author functions read the per author daily profiles (see authorprofiles) with the same
+# platform and community scopes as the rollups, each platform's default author is left out of
+# the time patterns
+PATTERNEXCLUDED = {"4chan": "Anonymous", "Reddit": "AutoModerator"}
+
+# the profiles, brought up to date first, or the snapshot backend which answers the same calls
+def authorsource():
+    backend = activebackend()
+    if backend is not None:
+        return backend
+    authorprofiles.refreshprofilesifstale()
+    return authorprofiles
+
 # this function returns the top authors by post count for a selected date range
 # it queries both fourchans and reddit and aggregates counts and will returns dataframes for each platform
+@cached(ttl=120)
 def gettopauthors(start=None, end=None, limit=20):
     enddate = parsedate(end, datetime.utcnow())
     startdate = parsedate(start, enddate - timedelta(days=defaultdays))
-    results = {}
-    with get_cursor() as cur:
-        cur.execute("""
-            SELECT author_name, COUNT(*)::int AS cnt
-            FROM chan_posts
-            WHERE board_name = 'g' AND created_at BETWEEN %s AND %s
-            GROUP BY author_name
-            ORDER BY cnt DESC
-            LIMIT %s;
-        """, (startdate, enddate, limit))
-        rows = cur.fetchall()
-        results["4chan"] = pd.DataFrame(rows, columns=["author_name", "count"])
-    with get_cursor() as cur:
-        cur.execute("""
-            SELECT data->>'author' AS author_name, COUNT(*)::int AS cnt
-            FROM reddit_posts
-            WHERE created_at BETWEEN %s AND %s
-            GROUP BY author_name
-            ORDER BY cnt DESC
-            LIMIT %s;
-        """, (startdate, enddate, limit))
-        rows = cur.fetchall()
-        results["Reddit"] = pd.DataFrame(rows, columns=["author_name", "count"])
-    return results
+    source = authorsource()
+    return {scope["platform"]: source.topauthors(scope["platform"], scope["community"], startdate, enddate, limit)
+            for scope in ROLLUPSCOPES}
 
 # this function computes posting patterns by hour for the top authors
 # it will tell when the most active authors post happened by aggregated per hour of the day
+@cached(ttl=120)
 def authortimepattern(start=None, end=None, topn=10):
     enddate = parsedate(end, datetime.utcnow())
     startdate = parsedate(start, enddate - timedelta(days=defaultdays))
-    results = {}
-    with get_cursor() as cur:
-        cur.execute("""
-            SELECT author_name, DATE_PART('hour', created_at)::int AS hour, COUNT(*)::int AS cnt
-            FROM chan_posts
-            WHERE board_name = 'g' AND created_at BETWEEN %s AND %s
-            AND author_name != 'Anonymous'
-            GROUP BY author_name, hour
-            ORDER BY COUNT(*) DESC;
-        """, (startdate, enddate))
-        rows = cur.fetchall()
-        df = pd.DataFrame(rows, columns=["author_name", "hour", "count"])
-        topauthors = df.groupby("author_name")["count"].sum().sort_values(ascending=False).head(topn).index.tolist()
-        df = df[df["author_name"].isin(topauthors)]
-        pivot = df.pivot_table(index="author_name", columns="hour", values="count", fill_value=0)
-        results["4chan"] = pivot.reindex(index=topauthors).fillna(0)
-    with get_cursor() as cur:
-        cur.execute("""
-            SELECT data->>'author' AS author_name, DATE_PART('hour', created_at)::int AS hour, COUNT(*)::int AS cnt
-            FROM reddit_posts
-            WHERE created_at BETWEEN %s AND %s
-            AND data->>'author' != 'AutoModerator'
-            GROUP BY author_name, hour
-            ORDER BY COUNT(*) DESC;
-        """, (startdate, enddate))
-        rows = cur.fetchall()
-        df = pd.DataFrame(rows, columns=["author_name", "hour", "count"])
-        topauthors = df.groupby("author_name")["count"].sum().sort_values(ascending=False).head(topn).index.tolist()
-        df = df[df["author_name"].isin(topauthors)]
-        pivot = df.pivot_table(index="author_name", columns="hour", values="count", fill_value=0)
-        results["Reddit"] = pivot.reindex(index=topauthors).fillna(0)
-    return results
+    source = authorsource()
+    return {scope["platform"]: source.hourpattern(scope["platform"], scope["community"], startdate, enddate, topn,
+                                                  PATTERNEXCLUDED[scope["platform"]])
+            for scope in ROLLUPSCOPES}
 
 # this function calculates average post length by author for a given date range
+@cached(ttl=120)
 def averagepostlenghtbyauthor(start=None, end=None, limit=20):
     enddate = parsedate(end, datetime.utcnow())
     startdate = parsedate(start, enddate - timedelta(days=defaultdays))
-    results = {}
-    with get_cursor() as cur:
-        cur.execute("""
-            SELECT author_name, AVG(LENGTH(content))::float AS avg_len, COUNT(*)::int AS cnt
-            FROM chan_posts
-            WHERE board_name = 'g' AND created_at BETWEEN %s AND %s
-            GROUP BY author_name
-            ORDER BY avg_len DESC
-            LIMIT %s;
-        """, (startdate, enddate, limit))
-        rows = cur.fetchall()
-        results["4chan"] = pd.DataFrame(rows, columns=["author_name", "avg_len", "count"])
-    with get_cursor() as cur:
-        cur.execute("""
-            SELECT data->>'author' AS author_name,
-                   AVG(LENGTH(COALESCE(data->>'body','') || COALESCE(data->>'title','') || COALESCE(data->>'selftext','')))::float AS avg_len,
-                   COUNT(*)::int AS cnt
-            FROM reddit_posts
-            WHERE created_at BETWEEN %s AND %s
-            GROUP BY author_name
-            ORDER BY avg_len DESC
-            LIMIT %s;
-        """, (startdate, enddate, limit))
-        rows = cur.fetchall()
-        results["Reddit"] = pd.DataFrame(rows, columns=["author_name", "avg_len", "count"])
-    return results
+    source = authorsource()
+    return {scope["platform"]: source.longestauthors(scope["platform"], scope["community"], startdate, enddate, limit)
+            for scope in ROLLUPSCOPES}
+
+# live tail of the posts over time and toxicity charts. the last hours of both platforms are
+# kept in memory by livetail and the charts redraw every LIVE_TAIL_REFRESH_SECONDS with only the
+# posts since the last redraw folded in, counted on the raw tables like the minute buckets
+def rendertemporallive():
+    if activebackend() is not None:
+        st.info("Live tail follows the database and isn't available with the snapshot backend.")
+        return
+    hours = st.sidebar.selectbox("Live window (hours)", livetail.LIVEWINDOWS, index=1)
+    window = timedelta(hours=hours)
+    now = datetime.utcnow()
+    bucket = choosebucket(now - window, now)
+    platforms = [scope["platform"] for scope in ROLLUPSCOPES]
+    series = livetail.liveseries("temporal", (), platforms, bucket, window,
+                                 lambda since, until: rawbuckets(bucket, since, until))
+
+    @st.fragment(run_every=livetail.refreshseconds)
+    def drawlive():
+        try:
+            series.fold()
+        except Exception as e:
+            logger.error(f"live tail update failed: {e}")
+            st.warning("Live update failed, showing the last data received.")
+        st.caption(f"Live: posts per {bucket} over the last {hours} hours, updated {datetime.utcnow():%H:%M:%S} UTC")
+        frames = [pd.DataFrame(series.series(platform)).assign(platform=platform) for platform in platforms]
+        frames = [frame for frame in frames if not frame.empty]
+        if not frames:
+            st.warning("their is no data in the live window")
+            return
+        dataframeall = pd.concat(frames, ignore_index=True)
+        colors = {"4chan": "#57B9FA", "Reddit": "#ff6b6b"}
+        figure = px.line(dataframeall, x="t", y="count", color="platform", title="Posts over time", color_discrete_map=colors)
+        st.plotly_chart(figure, use_container_width=True, key="live-temporal-count")
+        toxicityfigure = px.line(dataframeall, x="t", y="avg_tox", color="platform", title="Avg toxicity over time",
+                                 color_discrete_map=colors)
+        st.plotly_chart(toxicityfigure, use_container_width=True, key="live-temporal-toxicity")
+
+    drawlive()
 
 # this function renders the entire temporal analytics panel 
 # it coordinates all temporal functions and allows selection of day/week option and 
@@ -249,11 +268,34 @@ def averagepostlenghtbyauthor(start=None, end=None, limit=20):
 # weekday vs weekend behavior and post length trends
 def rendertemporal(startdate=None, enddate=None):
     st.header("Temporal activity")
-    bucket = st.sidebar.selectbox("Aggregation", ["day", "week"], index=0)
+    if st.sidebar.checkbox("Live tail", value=False, help="Follow the last hours as the crawlers insert posts"):
+        rendertemporallive()
+        return
+    bucket = st.sidebar.selectbox("Aggregation", ["auto"] + RESOLUTIONS, index=0)
     getothers = st.sidebar.selectbox("Get others", ["None", "Top authors", "Author time patterns", "Avg post length by author"], index=0)
-    data = getpostspertime(bucket=bucket, start=startdate.isoformat(), end=enddate.isoformat())
+    # the time series come from the bucket cache so sliding the range only queries the new
+    # buckets, one grouped pass per platform feeds the remaining charts of the panel. these and
+    # the optional author query don't depend on each other so they run concurrently
+    start, end = startdate.isoformat(), enddate.isoformat()
+    tasks = {
+        "series": lambda: getpostspertime(bucket=bucket, start=start, end=end),
+        "temporal": lambda: temporalquery(start=start, end=end, parts=("days", "weekdays", "total")),
+    }
+    if getothers == "Top authors":
+        tasks["others"] = lambda: gettopauthors(start=start, end=end, limit=30)
+    elif getothers == "Author time patterns":
+        tasks["others"] = lambda: authortimepattern(start=start, end=end, topn=10)
+    elif getothers == "Avg post length by author":
+        tasks["others"] = lambda: averagepostlenghtbyauthor(start=start, end=end, limit=30)
+    queryresults = runparallel(tasks)
+    data = queryresults["series"]
+    temporalresult = queryresults["temporal"]
+    # long series are downsampled before charting into new lists, the cached result stays as it
+    # is. the count and toxicity charts are downsampled on their own value so the peaks of both
+    # survive
+    st.caption(f"Posts per {data['bucket']}")
     for s in data["series"]:
-        dataframe = pd.DataFrame(s["points"])
+        dataframe = pd.DataFrame(downsample(s["points"]))
         if dataframe.empty:
             st.warning(f"their is no data for {s['platform']}")
             continue
@@ -264,17 +306,18 @@ def rendertemporal(startdate=None, enddate=None):
             figure.update_traces(line_color="#57B9FA")
         st.plotly_chart(figure, use_container_width=True)
     st.subheader("Average toxicity over time")
-    dataframeall = pd.concat([pd.DataFrame(s["points"]).assign(platform=s["platform"]) for s in data["series"] if s["points"]], ignore_index=True)
+    dataframeall = pd.concat([pd.DataFrame(downsample(s["points"], y="avg_tox")).assign(platform=s["platform"])
+                              for s in data["series"] if s["points"]], ignore_index=True)
     if not dataframeall.empty:
         toxicityfigure = px.line(dataframeall, x="t", y="avg_tox", color="platform", title="Avg toxicity over time",
                                  color_discrete_map={"4chan": "#57B9FA", "Reddit": "#ff6b6b"})
         st.plotly_chart(toxicityfigure, use_container_width=True)
 
     st.subheader("sumary table")
-    sumarytable = gettemporalsummary(start=startdate.isoformat(), end=enddate.isoformat())
+    sumarytable = gettemporalsummary(result=temporalresult)
     st.json(sumarytable)
     st.subheader("Weekday and Weekend activity")
-    weekdaydataframe = weekdayvsweekendstats(start=startdate.isoformat(), end=enddate.isoformat())
+    weekdaydataframe = weekdayvsweekendstats(result=temporalresult)
 
     if not weekdaydataframe.empty:
         weekdaydataframe["day_name"] = weekdaydataframe["weekday"].apply(lambda x: ["Sun","Mon","Tue","Wed","Thu","Fri","Sat"][int(x)])
@@ -283,7 +326,7 @@ def rendertemporal(startdate=None, enddate=None):
                      color_discrete_map={"4chan": "#57B9FA", "Reddit": "#ff6b6b"})
         st.plotly_chart(figure, use_container_width=True)
     st.subheader("Post Length over time")
-    lengthofdataframe = postlengthovertime(start=startdate.isoformat(), end=enddate.isoformat())
+    lengthofdataframe = postlengthovertime(result=temporalresult)
     if not lengthofdataframe.empty:
         figure = px.line(lengthofdataframe, x="day", y="avg_len", color="platform",
                       title="Average post length over time",
@@ -292,7 +335,7 @@ def rendertemporal(startdate=None, enddate=None):
 
     if getothers == "Top authors":
         st.subheader("Top Frequent Authors (by post count)")
-        tops = gettopauthors(start=startdate.isoformat(), end=enddate.isoformat(), limit=30)
+        tops = queryresults["others"]
         column1, column2 = st.columns(2)
         with column1:
             st.markdown("#### 4chan top authors (/g/)")
@@ -327,7 +370,7 @@ def rendertemporal(startdate=None, enddate=None):
 
     if getothers == "Author time patterns":
         st.subheader("Author Posting Time Patterns (top authors)")
-        pats = authortimepattern(start=startdate.isoformat(), end=enddate.isoformat(), topn=10)
+        pats = queryresults["others"]
         column1, column2 = st.columns(2)
         with column1:
             st.markdown("#### 4chan hourly activity (top authors)")
@@ -364,7 +407,7 @@ def rendertemporal(startdate=None, enddate=None):
 
     if getothers == "Avg post length by author":
         st.subheader("Average Post Length by Author")
-        averages = averagepostlenghtbyauthor(start=startdate.isoformat(), end=enddate.isoformat(), limit=30)
+        averages = queryresults["others"]
         column1, column2 = st.columns(2)
         with column1:
             st.markdown("#### 4chan avg length")
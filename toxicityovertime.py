@@ -3,6 +3,12 @@ import pandas as pd
 import plotly.express as px
 from datetime import datetime, timedelta
 from db import get_cursor
+from querycache import cached
+from communitycatalog import catalogcommunities
+from scorestats import summarysql, multisummarysql, summaryfromrow, emptysummary, binedges
+import approximate
+from snapshot import SCORECOLUMNS, activebackend
+from rollups import columnexpr, refreshifstale, afterrefresh
 from utils import getlogger
 
 logger = getlogger("toxicity_panel")
@@ -17,95 +23,132 @@ def parsedate(s, default):
         return default
 # this function will  gathers all distinct reddit subreddits and 4chan boards present in the
 # database and it normalizes naming  so the UI can show a
-# unified list of communities for cross platform toxicity comparisons
+# unified list of communities for cross platform toxicity comparisons. the names come from the
+# community catalog which the background rollup refresh keeps up to date, this only reads it
+# and nudges that refresh when it is due
+@cached(ttl=300)
 def getthecommunities():
-    arr = []
-    bords = []
-    with get_cursor() as cur:
-        cur.execute("""
-            SELECT DISTINCT
-              COALESCE(
-                NULLIF(data->>'subreddit', ''),
-                NULLIF(data->>'subreddit_name_prefixed', '')
-              ) AS sub
-            FROM reddit_posts
-            WHERE (data->>'subreddit') IS NOT NULL OR (data->>'subreddit_name_prefixed') IS NOT NULL
-        """)
-        for row in cur.fetchall():
-            v = row[0]
-            if not v:
-                continue
-            if v.startswith("r/"):
-                v = v[2:]
-            arr.append(v.strip().lower())
-        cur.execute("SELECT DISTINCT board_name FROM chan_posts;")
-        for row in cur.fetchall():
-            bords.append(row[0].strip().lower())
+    backend = activebackend()
+    if backend is not None:
+        return backend.communities("Reddit") + backend.communities("4chan")
+    refreshifstale()
+    arr = [row["community"] for row in catalogcommunities("Reddit")]
+    bords = [row["community"] for row in catalogcommunities("4chan")]
     return arr + bords
 
+# the cached list is dropped after every background rollup refresh, which refreshed the catalog
+# just before, so new communities show up at once and an empty catalog read before the first
+# build of a fresh database isn't kept for the whole ttl
+afterrefresh.append(getthecommunities.invalidate)
+
+# optional sampling for gettoxicity, SYSTEM picks whole pages and is the cheapest while
+# BERNOULLI picks individual rows for a less clustered sample at the cost of reading every page
+SAMPLINGMETHODS = {"system": "SYSTEM", "bernoulli": "BERNOULLI"}
+
+def tablesample(sampling, samplepercent):
+    if not sampling:
+        return "", ()
+    return f"TABLESAMPLE {SAMPLINGMETHODS[sampling]} (%s)", (samplepercent,)
+
+# normalized community key of each post table, the same keys the rollups and the catalog use.
+# 4chan's lower cased board name has the expression index of migration 0002 and reddit the
+# generated subreddit_key column of 0003, both together with created_at. without migration 0003
+# reddit falls back to the json expression (see rollups.columnexpr)
+COMMUNITYKEYS = {"chan_posts": "LOWER(board_name)", "reddit_posts": "subreddit_key"}
+
 # in this function i am computing toxicity statistics for selected communities across reddit and
-# fourchann and this will calculates the average toxicity metric and samples a distribution of values
-# for histogram plotting by enabling side by side toxicity analysis between platforms
-def gettoxicity(platforms, communities, metric="toxicityscore", start=None, end=None):
-    maxdistintrows = 2000
+# fourchann and this will calculates the average toxicity metric and the distribution of values
+# for histogram plotting by enabling side by side toxicity analysis between platforms. the
+# distribution comes back from the database already binned with its exact percentiles (see
+# scorestats) and with sampling set the statistics are computed over a TABLESAMPLE of the table,
+# their counts scaled up to the whole range and the mean given a 95% interval.
+# all communities are passed as one array so each platform costs a single grouped query. the
+# snapshot backend computes the same summaries from the parquet snapshots, always unsampled
+@cached(ttl=300)
+def gettoxicity(platforms, communities, metric="toxicityscore", start=None, end=None, sampling=None, samplepercent=5.0):
+    return toxicitybymetric(platforms, communities, [metric], start, end, sampling, samplepercent)[metric]
+
+# the same statistics for all seven metrics at once, {metric: the result of gettoxicity}. every
+# platform is still scanned once, switching the metric in the panel then needs no query
+@cached(ttl=300)
+def gettoxicityallmetrics(platforms, communities, start=None, end=None, sampling=None, samplepercent=5.0):
+    return toxicitybymetric(platforms, communities, SCORECOLUMNS, start, end, sampling, samplepercent)
+
+def toxicitybymetric(platforms, communities, metrics, start, end, sampling, samplepercent):
     startdate = datetime.combine(parsedate(start, datetime.utcnow() - timedelta(days=defaultdays)), datetime.min.time())
     enddate = datetime.combine(parsedate(end, datetime.utcnow()), datetime.max.time())
-    results = []
-    with get_cursor() as cur:
-        for comm in communities:
-            name = comm.strip().lower()
-            if not name:
-                continue
-            if "chan" in platforms:
-                cur.execute("SELECT 1 FROM chan_posts WHERE LOWER(board_name) = %s LIMIT 1;", (name,))
-                ischan = cur.fetchone() is not None
-                if ischan:
-                    cur.execute(f"""
-                        SELECT AVG(COALESCE({metric},0))
-                        FROM chan_posts
-                        WHERE LOWER(board_name) = %s AND created_at BETWEEN %s AND %s
-                    """, (name, startdate, enddate))
-                    averagevalue = cur.fetchone()[0] or 0
-                    cur.execute(f"""
-                        SELECT {metric} FROM chan_posts
-                        WHERE LOWER(board_name) = %s AND created_at BETWEEN %s AND %s AND {metric} IS NOT NULL
-                        ORDER BY random() LIMIT {maxdistintrows}
-                    """, (name, startdate, enddate))
-                    distintrows = [r[0] for r in cur.fetchall()]
-                    results.append({
-                        "community": name,
-                        "platform": "4chan",
-                        "avg": averagevalue,
-                        "distribution": distintrows
-                    })
+    sample, sampleparams = tablesample(sampling, samplepercent)
+    samplesummary = (lambda summary: approximate.scaledsummary(summary, samplepercent)) if sampling else (lambda summary: summary)
+    names = []
+    for comm in communities:
+        name = comm.strip().lower()
+        if name.startswith("r/"):
+            name = name[2:]
+        if name and name not in names:
+            names.append(name)
+    chanstats, redditstats, chanboards = {}, {}, set()
+    backend = activebackend()
+    if backend is not None:
+        if "chan" in platforms:
+            chanboards = set(backend.communities("4chan")) & set(names)
+            chanstats = backend.toxicitysummaries("4chan", metrics, chanboards, startdate, enddate)
+        if "reddit" in platforms:
+            redditstats = backend.toxicitysummaries("Reddit", metrics, names, startdate, enddate)
+    else:
+        if "chan" in platforms:
+            # boards known to the catalog get an entry even without posts in the range
+            chanboards = {row["community"] for row in catalogcommunities("4chan")} & set(names)
+        # the keys are resolved before the cursor is opened, columnexpr may need a connection
+        # of its own on a cache miss
+        keys = {table: columnexpr(table, key) for table, key in COMMUNITYKEYS.items()}
+        with get_cursor() as cur:
+            if chanboards:
+                chanstats = metricsummaries(cur, "chan_posts", keys["chan_posts"], metrics, list(chanboards),
+                                            startdate, enddate, sample, sampleparams, samplesummary)
+            if "reddit" in platforms and names:
+                redditstats = metricsummaries(cur, "reddit_posts", keys["reddit_posts"], metrics, names,
+                                              startdate, enddate, sample, sampleparams, samplesummary)
+    results = {}
+    for metric in metrics:
+        results[metric] = []
+        for name in names:
+            if name in chanboards:
+                stats = chanstats.get(metric, {}).get(name, emptysummary())
+                results[metric].append({"community": name, "platform": "4chan", "avg": stats["meanwithnulls"] or 0, "stats": stats})
             if "reddit" in platforms:
-                subreddit_name = name
-                alt_prefixed = "r/" + subreddit_name if not subreddit_name.startswith("r/") else subreddit_name
-                cur.execute(f"""
-                    SELECT AVG(COALESCE({metric},0))
-                    FROM reddit_posts
-                    WHERE (LOWER(data->>'subreddit') = %s OR LOWER(data->>'subreddit_name_prefixed') = %s)
-                      AND created_at BETWEEN %s AND %s
-                """, (subreddit_name, alt_prefixed, startdate, enddate))
-                averagevalue = cur.fetchone()[0] or 0
-                cur.execute(f"""
-                    SELECT {metric} FROM reddit_posts
-                    WHERE (LOWER(data->>'subreddit') = %s OR LOWER(data->>'subreddit_name_prefixed') = %s)
-                      AND created_at BETWEEN %s AND %s AND {metric} IS NOT NULL
-                    ORDER BY random() LIMIT {maxdistintrows}
-                """, (subreddit_name, alt_prefixed, startdate, enddate))
-                distintrows = [r[0] for r in cur.fetchall()]
-                results.append({
-                    "community": name,
-                    "platform": "Reddit",
-                    "avg": averagevalue,
-                    "distribution": distintrows
-                })
+                stats = redditstats.get(metric, {}).get(name, emptysummary())
+                results[metric].append({"community": name, "platform": "Reddit", "avg": stats["meanwithnulls"] or 0, "stats": stats})
     return results
+
+# this function runs the summary query of one post table grouped on the community key expression
+# and returns {metric: {community: summary}}, a single metric is summarized directly and several
+# are unpivoted in the same scan
+def metricsummaries(cur, table, key, metrics, names, startdate, enddate, sample, sampleparams, samplesummary):
+    if len(metrics) == 1:
+        sql = summarysql(f"""
+            SELECT {key} AS grp, {metrics[0]} AS score
+            FROM {table} {sample}
+            WHERE {key} = ANY(%s) AND created_at BETWEEN %s AND %s
+        """)
+    else:
+        sql = multisummarysql(f"""
+            SELECT {key} AS grp, {', '.join(metrics)}
+            FROM {table} {sample}
+            WHERE {key} = ANY(%s) AND created_at BETWEEN %s AND %s
+        """, metrics)
+    cur.execute(sql, sampleparams + (names, startdate, enddate))
+    stats = {metric: {} for metric in metrics}
+    for r in cur.fetchall():
+        grp, metric = r[0] if len(metrics) > 1 else (r[0], metrics[0])
+        stats[metric][grp] = samplesummary(summaryfromrow(r))
+    return stats
+
 # this will renders the entire toxicity comparison section in Streamlit by gathering
 # user inputs such as date ranges, platforms, communities, toxicity metric and it will fetches toxicity
-# data and visualizes averages and distributions to highlight how toxic each community is
-def rendertoxicity(startdate=None, enddate=None):
+# data and visualizes averages and distributions to highlight how toxic each community is.
+# in the approximate and progressive query modes the first answer comes from a SYSTEM sample
+# of the tables unless a sampling method was already picked
+def rendertoxicity(startdate=None, enddate=None, querymode="exact"):
     st.header("Toxicity Comparison")
     if startdate is None:
         startdate = st.sidebar.date_input("Start date", datetime.utcnow() - timedelta(days=defaultdays))
@@ -113,37 +156,94 @@ def rendertoxicity(startdate=None, enddate=None):
         enddate = st.sidebar.date_input("End date", datetime.utcnow())
     platforms = st.sidebar.multiselect("Select platforms", ["chan", "reddit"], default=["chan", "reddit"])
     communities = st.sidebar.multiselect("Select boards/subreddits", getthecommunities())
-    metric = st.selectbox(
-        "Select toxicity metric",
-        ["toxicityscore", "severetoxicityscore", "insultscore",
-         "profanityscore", "identityattackscore", "threatscore", "unsubstantialscore"]
-    )
+    metric = st.selectbox("Select toxicity metric", SCORECOLUMNS)
+    allmetrics = st.sidebar.checkbox("All metrics in one pass", value=True,
+                                     help="Summarize every metric in one scan and keep them for this session, switching the metric doesn't query again")
+    sampling = st.sidebar.selectbox("Sampling", ["none", "system", "bernoulli"], index=0)
+    samplepercent = 5.0
+    if sampling != "none":
+        samplepercent = st.sidebar.slider("Sample percent", 0.1, 100.0, 5.0)
+        querymode = "exact"
     if not communities or not platforms:
         st.warning("Please select at least one platform and community.")
         return
-    toxicitydata = gettoxicity(platforms, communities, metric,
-                               start=startdate.isoformat(), end=enddate.isoformat())
+    arguments = dict(platforms=platforms, communities=communities,
+                     start=startdate.isoformat(), end=enddate.isoformat())
+    exactarguments = dict(arguments, sampling=None if sampling == "none" else sampling, samplepercent=samplepercent)
+    approximatearguments = dict(arguments, sampling="system", samplepercent=approximate.samplepercent)
+    if allmetrics:
+        rendertoxicitymetrics(querymode, metric, exactarguments, approximatearguments)
+        return
+    exactarguments["metric"] = approximatearguments["metric"] = metric
+    approximate.renderprogressive(querymode,
+                                  lambda: gettoxicity(**approximatearguments),
+                                  lambda: gettoxicity(**exactarguments),
+                                  lambda toxicitydata, sampled: drawtoxicity(toxicitydata, metric, sampled),
+                                  iscached=lambda: gettoxicity.iscached(**exactarguments))
+
+# exact results of all metrics are kept in the session under their arguments, the most recent
+# sessionentries of them. the metric selectbox reruns the script and the chosen metric is drawn
+# from the session without going through the query cache, which may have expired or evicted it
+sessionentries = 4
+
+def rendertoxicitymetrics(querymode, metric, exactarguments, approximatearguments):
+    stored = st.session_state.setdefault("toxicitymetrics", {})
+    key = repr(sorted(exactarguments.items()))
+    if key in stored:
+        drawtoxicity(stored[key][metric], metric)
+        return
+    # draws run on the script thread, the exact results are stored there and not in the query
+    # function which runs on the executor in progressive mode
+    def draw(toxicitydata, sampled):
+        if not sampled:
+            stored[key] = toxicitydata
+            while len(stored) > sessionentries:
+                stored.pop(next(iter(stored)))
+        drawtoxicity(toxicitydata[metric], metric, sampled)
+    approximate.renderprogressive(querymode,
+                                  lambda: gettoxicityallmetrics(**approximatearguments),
+                                  lambda: gettoxicityallmetrics(**exactarguments),
+                                  draw,
+                                  iscached=lambda: gettoxicityallmetrics.iscached(**exactarguments))
+
+# draws the statistics and distribution of every community, sampled data also shows the
+# estimated number of posts and the interval of the mean
+def drawtoxicity(toxicitydata, metric, sampled=False):
+    edges = binedges()
     for entry in toxicitydata:
         st.markdown(" ")
         with st.container(border=True): 
             st.subheader(f"{entry['platform']} — {entry['community']}")
-            if entry["avg"] is None or len(entry["distribution"]) == 0:
+            stats = entry["stats"]
+            if entry["avg"] is None or stats["count"] == 0:
                 st.info("No data available for this range.")
                 continue
-            dist = pd.Series(entry["distribution"])
             col1, col2 = st.columns(2)
             with col1:
-                st.metric("Median toxicity (50%)", f"{dist.quantile(0.5):.4f}")
-                st.metric("Minimum observed", f"{dist.min():.4f}")
+                st.metric("Median toxicity (50%)", f"{stats['quantiles'][0.5]:.4f}")
+                st.metric("Minimum observed", f"{stats['min']:.4f}")
             with col2:
                 st.metric("25% → 75% percentile",
-                          f"{dist.quantile(0.25):.4f} → {dist.quantile(0.75):.4f}")
-                st.metric("Maximum observed", f"{dist.max():.4f}")
+                          f"{stats['quantiles'][0.25]:.4f} → {stats['quantiles'][0.75]:.4f}")
+                st.metric("Maximum observed", f"{stats['max']:.4f}")
+            if sampled and "sampled" in stats:
+                col1, col2 = st.columns(2)
+                with col1:
+                    st.metric("Estimated scored posts (95%)",
+                              f"{stats['count']:,.0f}", help=f"{stats['countlow']:,.0f} → {stats['counthigh']:,.0f}")
+                with col2:
+                    st.metric("Mean toxicity (95% interval)",
+                              f"{stats['meanlow']:.4f} → {stats['meanhigh']:.4f}")
             st.markdown("---")
-            fig = px.histogram(
-                dist,
-                x=dist,
-                nbins=35,
+            # the bins come from the database so the chart draws them as they are
+            bins = pd.DataFrame({
+                "score": [(edges[i] + edges[i + 1]) / 2 for i in range(len(stats["histogram"]))],
+                "count": stats["histogram"],
+            })
+            fig = px.bar(
+                bins,
+                x="score",
+                y="count",
                 opacity=0.85,
                 title=f"{metric} distribution for {entry['community']} ({entry['platform']})",
             )
@@ -153,7 +253,9 @@ def rendertoxicity(startdate=None, enddate=None):
                 fig.update_traces(marker_color="#57B9FA")
             fig.update_layout(
                 bargap=0.05,
+                xaxis=dict(range=[0, 1]),
                 margin=dict(l=20, r=20, t=60, b=20),
                 showlegend=False,
             )
-            st.plotly_chart(fig, use_container_width=True)
+            st.plotly_chart(fig, use_container_width=True,
+                            key=f"toxicity-{entry['platform']}-{entry['community']}-{'sample' if sampled else 'exact'}")